@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""Headers per second of the bulk codec against a parse_simp_message() loop.
+
+Two corpora are generated with encode_records(): ACKs only (every record
+is a bare header, the uniform fast path) and chat with payloads of
+random length (boundaries found by the sequential scan).
+
+    python bench_codec.py --records 1000000
+"""
+
+import argparse
+import time
+import numpy as np
+from simp_common import *
+from simp_codec import encode_records, index_records, decode_headers
+
+
+def corpus(records: int, payloads: bool, seed: int = 1) -> tuple:
+    """Arguments for encode_records()."""
+    rng = np.random.default_rng(seed)
+    names = np.array([f"user{i}".encode('ascii') for i in range(16)], dtype='S32')
+    usernames = names[rng.integers(0, len(names), records)]
+    seqs = np.arange(records) % 2
+    if not payloads:
+        return (np.full(records, MessageType.CONTROL.value), np.full(records, OperationType.ACK.value),
+                seqs, usernames)
+    lengths = rng.integers(0, 64, records)
+    data = rng.integers(0x20, 0x7f, int(lengths.sum()), dtype=np.uint8).tobytes()
+    bounds = np.concatenate(([0], np.cumsum(lengths))).tolist()
+    return (np.full(records, MessageType.CHAT.value), np.full(records, OperationType.CHAT_MSG.value),
+            seqs, usernames, [data[a:b] for a, b in zip(bounds[:-1], bounds[1:])])
+
+
+def timed(fn, *args):
+    started = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - started
+
+
+def python_loop(buf: bytes, limit: int) -> int:
+    """The per-datagram baseline, over the first limit records."""
+    count = pos = 0
+    while pos < len(buf) and count < limit:
+        length = int.from_bytes(buf[pos + HEADER_SIZE - 4:pos + HEADER_SIZE], 'big')
+        parse_simp_message(buf[pos:pos + HEADER_SIZE + length])
+        pos += HEADER_SIZE + length
+        count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--records', type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    for name, payloads in (('acks', False), ('chat', True)):
+        buf, encode_s = timed(encode_records, *corpus(args.records, payloads))
+        offsets, index_s = timed(index_records, buf)
+        headers, decode_s = timed(decode_headers, buf, offsets)
+        loop_count, loop_s = timed(python_loop, buf, 200_000)
+        print(f"{name}: {len(headers)} records, {len(buf) / 1e6:.1f} MB")
+        print(f"  encode              {args.records / encode_s / 1e6:8.2f} M headers/s")
+        print(f"  index               {args.records / index_s / 1e6:8.2f} M headers/s")
+        print(f"  decode              {args.records / decode_s / 1e6:8.2f} M headers/s")
+        print(f"  index + decode      {args.records / (index_s + decode_s) / 1e6:8.2f} M headers/s")
+        print(f"  parse_simp_message  {loop_count / loop_s / 1e6:8.2f} M headers/s")
+
+
+if __name__ == "__main__":
+    main()
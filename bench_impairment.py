@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""Goodput and latency of the daemon's delivery path over an impaired link.
+
+Two in-process SimpDaemons on ephemeral ports chat through an
+ImpairmentProxy: A -> proxy -> B. A scripted client feeds A's send
+queue, a scripted client on B collects the 'message' notifications.
+Each payload carries its enqueue time, so delivery latency includes
+queueing, loss recovery and retransmissions. With --window 1 the next
+message is only queued once the previous one arrived, which isolates
+the stop-and-wait delivery path.
+
+    python bench_impairment.py --loss 0.05 --rtt 0.05 --messages 100
+"""
+
+import argparse
+import socket
+import threading
+import time
+from simp_common import *
+from simp_daemon import SimpDaemon
+from simp_proxy import ImpairmentProxy
+
+def percentile(values: list, p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+
+def attach_client(daemon: SimpDaemon, username: str) -> socket.socket:
+    """Register a scripted client with an in-process daemon."""
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.bind(('127.0.0.1', 0))
+    msg = build_client_daemon_message('connect', username=username)
+    client.sendto(msg.encode('ascii'), ('127.0.0.1', daemon.client_port))
+    client.recvfrom(4096)
+    return client
+
+
+def run(messages: int, loss: float, rtt: float, jitter: float, seed: int, size: int, window: int) -> dict:
+    sender = SimpDaemon(host='127.0.0.1', daemon_port=0, client_port=0)
+    receiver = SimpDaemon(host='127.0.0.1', daemon_port=0, client_port=0)
+    receiver.auto_accept = True
+    for daemon in (sender, receiver):
+        daemon.start()
+    proxy = ImpairmentProxy(('127.0.0.1', 0), ('127.0.0.1', receiver.daemon_port),
+                            loss=loss, delay=rtt / 2, jitter=jitter, seed=seed)
+    proxy.start()
+
+    sender_client = attach_client(sender, 'alice')
+    receiver_client = attach_client(receiver, 'bob')
+    receiver_client.settimeout(sender.timeout * MAX_RETRIES)
+
+    def command(cmd, **kwargs):
+        msg = build_client_daemon_message(cmd, **kwargs)
+        sender_client.sendto(msg.encode('ascii'), ('127.0.0.1', sender.client_port))
+
+    # The SYN or SYN+ACK may be lost as well, invite again until connected
+    while not sender.in_chat:
+        command('invite', ip='127.0.0.1', port=proxy.listen_addr[1])
+        time.sleep(rtt * 4 + 0.2)
+
+    # Client side: keep at most `window` messages queued or in flight
+    credit = threading.Semaphore(window)
+
+    def feed():
+        for i in range(messages):
+            credit.acquire()
+            command('send', text=f"{i}:{time.monotonic():.6f}:".ljust(size, 'x'))
+
+    started = time.monotonic()
+    threading.Thread(target=feed, daemon=True).start()
+
+    latencies = []
+    try:
+        while len(latencies) < messages:
+            data, _ = receiver_client.recvfrom(4096)
+            msg = parse_client_daemon_message(data.decode('ascii'))
+            if msg['command'] != 'message':
+                continue
+            latencies.append(time.monotonic() - float(msg['text'].split(':')[1]))
+            credit.release()
+    except socket.timeout:
+        print(f"Gave up after {len(latencies)} messages (delivery stalled)")
+    elapsed = time.monotonic() - started
+
+    for daemon in (sender, receiver):
+        daemon.stop()
+    proxy.stop()
+    sender_client.close()
+    receiver_client.close()
+    delivered = len(latencies)
+    return {
+        'delivered': delivered,
+        'elapsed_s': elapsed,
+        'goodput_msg_s': delivered / elapsed,
+        'goodput_kb_s': delivered * size / elapsed / 1024,
+        'lat_p50_ms': percentile(latencies, 50) * 1000 if latencies else 0,
+        'lat_p90_ms': percentile(latencies, 90) * 1000 if latencies else 0,
+        'lat_p99_ms': percentile(latencies, 99) * 1000 if latencies else 0,
+        'lat_max_ms': max(latencies) * 1000 if latencies else 0,
+        'proxy': proxy.stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=100)
+    parser.add_argument('--loss', type=float, default=0.05)
+    parser.add_argument('--rtt', type=float, default=0.05)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--size', type=int, default=64, help="payload bytes per message")
+    parser.add_argument('--window', type=int, default=1, help="messages queued at the daemon at once")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    result = run(args.messages, args.loss, args.rtt, args.jitter, args.seed, args.size, args.window)
+    print(f"loss={args.loss:.0%} rtt={args.rtt * 1000:.0f}ms messages={args.messages}")
+    for key, value in result.items():
+        print(f"  {key:14} {value:.2f}" if isinstance(value, float) else f"  {key:14} {value}")
+
+
+if __name__ == "__main__":
+    main()
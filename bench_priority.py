@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""ACK latency of the daemon while its receive path is saturated with chat.
+
+An in-process SimpDaemon chats with a scripted peer in a separate
+process. The peer floods the daemon with duplicate chat datagrams at
+--rate (each one is parsed and ACKed, but not delivered), while
+the daemon's client keeps a stream of real messages queued. The peer
+ACKs every real message at once and measures how long it takes until
+the next one arrives: that gap is dominated by how long the daemon
+needs to get to the ACK. The same run is done with a single FIFO
+dispatch queue (before) and with the priority queues (after).
+
+Pick a rate above what the handler thread can process but below what
+the listener can drain; beyond that the kernel socket buffer overflows
+and drops ACKs regardless of the dispatch order.
+
+    python bench_priority.py --messages 200
+"""
+
+import argparse
+import multiprocessing
+import select
+import socket
+import time
+from simp_common import *
+from simp_daemon import SimpDaemon
+from bench_impairment import attach_client, percentile
+
+
+def peer_main(daemon_addr: tuple, messages: int, rate: float, burst: int, conn):
+    """Scripted chat partner: handshake, flood, ACK and time the real messages."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+    sock.bind(('127.0.0.1', 0))
+    sock.settimeout(TIMEOUT)
+    sock.sendto(build_simp_message(MessageType.CONTROL, OperationType.SYN.value, 0, "flood"), daemon_addr)
+    sock.recvfrom(4096)
+    sock.sendto(build_simp_message(MessageType.CONTROL, OperationType.ACK.value, 0, "flood"), daemon_addr)
+    conn.send('connected')
+
+    # One thread does both: paced bursts of flood datagrams, and in between
+    # wait for the daemon's datagrams. seq 1 is never the expected one here:
+    # the daemon ACKs it as a duplicate but does not deliver it.
+    dup = build_simp_message(MessageType.CHAT, OperationType.CHAT_MSG.value, 1, "flood", "x" * 32)
+    chat = MessageType.CHAT.value
+    sock.setblocking(False)
+    gaps = []
+    acked_at = None
+    received = 0
+    sent = 0
+    started = time.perf_counter()
+    deadline = started + 60
+    while received < messages and time.perf_counter() < deadline:
+        due = int((time.perf_counter() - started) * rate) - sent
+        for _ in range(min(due, burst)):
+            try:
+                sock.sendto(dup, daemon_addr)
+            except OSError:
+                pass
+            sent += 1
+        select.select([sock], [], [], burst / rate)
+        while True:
+            try:
+                data, _ = sock.recvfrom(4096)
+            except (BlockingIOError, InterruptedError):
+                break
+            if data[0] != chat:
+                continue  # the daemon's ACKs for the flood
+            now = time.perf_counter()
+            if acked_at is not None:
+                gaps.append(now - acked_at)
+            received += 1
+            sock.sendto(build_simp_message(MessageType.CONTROL, OperationType.ACK.value, data[2], "flood"), daemon_addr)
+            acked_at = time.perf_counter()
+    conn.send(gaps)
+
+
+def run(priority: bool, messages: int, rate: float, burst: int) -> dict:
+    daemon = SimpDaemon(host='127.0.0.1', daemon_port=0, client_port=0, send_queue_size=messages)
+    daemon.dispatcher.priority = priority
+    daemon.auto_accept = True
+    daemon.start()
+    client = attach_client(daemon, 'alice')
+
+    parent, child = multiprocessing.Pipe()
+    peer = multiprocessing.Process(target=peer_main, args=(('127.0.0.1', daemon.daemon_port), messages, rate, burst, child))
+    peer.start()
+    parent.recv()
+    while not daemon.in_chat:
+        time.sleep(0.01)
+    time.sleep(0.2)  # let the flood saturate the queues
+
+    for i in range(messages):
+        msg = build_client_daemon_message('send', text=f"m{i}")
+        client.sendto(msg.encode('ascii'), ('127.0.0.1', daemon.client_port))
+    gaps = parent.recv()
+    peer.join()
+    stats = daemon.stats()
+    daemon.stop()
+    client.close()
+    return {
+        'acked': len(gaps) + 1 if gaps else 0,
+        'ack_p50_ms': percentile(gaps, 50) * 1000 if gaps else 0,
+        'ack_p90_ms': percentile(gaps, 90) * 1000 if gaps else 0,
+        'ack_p99_ms': percentile(gaps, 99) * 1000 if gaps else 0,
+        'ack_max_ms': max(gaps) * 1000 if gaps else 0,
+        'control_wait_mean_ms': stats['dispatch_control_wait_mean_ms'],
+        'chat_wait_mean_ms': stats['dispatch_chat_wait_mean_ms'],
+        'chat_dropped': stats['dispatch_chat_dropped'],
+        'retransmits': stats['retransmits'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--rate', type=float, default=60000, help="flood datagrams per second")
+    parser.add_argument('--burst', type=int, default=128, help="flood datagrams sent back to back")
+    args = parser.parse_args()
+
+    for name, priority in (('fifo (before)', False), ('priority (after)', True)):
+        result = run(priority, args.messages, args.rate, args.burst)
+        print(f"{name}:")
+        for key, value in result.items():
+            print(f"  {key:22} {value:.2f}" if isinstance(value, float) else f"  {key:22} {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""Stop-and-wait message rate of daemon pairs over each transport.
+
+Every pair is two in-process SimpDaemons in a chat; a driver thread per
+pair sends one message through the sender's client port and waits for
+the receiver's client to get it before sending the next. With the
+'memory' transport no datagram touches the kernel, so the rate is what
+the protocol engine itself costs; 'udp' and 'batched' add the socket
+system calls on the loopback interface.
+
+    python bench_transport.py --pairs 50 --messages 200 --transports memory,udp,batched
+"""
+
+import argparse
+import threading
+import time
+from simp_common import *
+from simp_daemon import SimpDaemon
+from simp_transport import MemoryNetwork, UdpTransport
+
+
+def attach(factory, daemon: SimpDaemon, username: str):
+    """A client endpoint registered with daemon, and the daemon's client address."""
+    endpoint = factory.bind('127.0.0.1', 0)
+    if hasattr(endpoint, 'sock'):
+        endpoint.sock.settimeout(TIMEOUT * MAX_RETRIES)
+    daemon_addr = ('127.0.0.1', daemon.client_port)
+    endpoint.send(build_client_daemon_message('connect', username=username).encode('ascii'), daemon_addr)
+    endpoint.receive()
+    return endpoint, daemon_addr
+
+
+def expect(endpoint, command: str) -> dict:
+    while True:
+        data, _ = endpoint.receive()
+        msg = parse_client_daemon_message(data.decode('ascii'))
+        if msg['command'] == command:
+            return msg
+
+
+def run(transport: str, pairs: int, messages: int, size: int) -> dict:
+    if transport == 'memory':
+        network = MemoryNetwork()
+        daemon_transport, client_factory = network, network
+    else:
+        daemon_transport, client_factory = transport, UdpTransport
+    daemons, drivers = [], []
+    for i in range(pairs):
+        sender, receiver = (SimpDaemon(host='127.0.0.1', daemon_port=0, client_port=0, keepalive_interval=0,
+                                       log_level='warning', transport=daemon_transport) for _ in range(2))
+        receiver.auto_accept = True
+        for daemon in (sender, receiver):
+            daemon.start()
+            daemons.append(daemon)
+        sender_client, sender_addr = attach(client_factory, sender, f"alice{i}")
+        receiver_client, _ = attach(client_factory, receiver, f"bob{i}")
+        sender_client.send(build_client_daemon_message('invite', ip='127.0.0.1', port=receiver.daemon_port)
+                           .encode('ascii'), sender_addr)
+        expect(sender_client, 'connected')
+        drivers.append((sender_client, sender_addr, receiver_client))
+
+    latencies = []
+
+    def drive(sender_client, sender_addr, receiver_client):
+        for n in range(messages):
+            sent_at = time.perf_counter()
+            msg = build_client_daemon_message('send', text=f"{n}:".ljust(size, 'x'))
+            sender_client.send(msg.encode('ascii'), sender_addr)
+            expect(receiver_client, 'message')
+            latencies.append(time.perf_counter() - sent_at)
+
+    threads = [threading.Thread(target=drive, args=driver, daemon=True) for driver in drivers]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    for daemon in daemons:
+        daemon.stop()
+    for endpoints in drivers:
+        endpoints[0].close()
+        endpoints[2].close()
+    latencies.sort()
+    return {
+        'messages': len(latencies),
+        'elapsed_s': elapsed,
+        'msg_s': len(latencies) / elapsed,
+        'lat_p50_ms': latencies[len(latencies) // 2] * 1000,
+        'lat_p99_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pairs', type=int, default=10, help="daemon pairs chatting at once")
+    parser.add_argument('--messages', type=int, default=200, help="messages per pair")
+    parser.add_argument('--size', type=int, default=64, help="payload bytes per message")
+    parser.add_argument('--transports', default='memory,udp,batched')
+    args = parser.parse_args()
+
+    print(f"pairs={args.pairs} messages/pair={args.messages}")
+    print(f"{'transport':>10} {'msg/s':>9} {'p50_ms':>8} {'p99_ms':>8}")
+    for transport in args.transports.split(','):
+        result = run(transport, args.pairs, args.messages, args.size)
+        print(f"{transport:>10} {result['msg_s']:9.0f} {result['lat_p50_ms']:8.3f} {result['lat_p99_ms']:8.3f}")
+
+
+if __name__ == "__main__":
+    main()
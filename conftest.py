@@ -0,0 +1,105 @@
+"""Shared pytest fixtures: in-process daemons on ephemeral ports and fake clients/peers.
+
+Daemons are started in-process with SimpDaemon.start(), which returns as
+soon as both sockets are listening, so no test has to sleep for startup
+and tests can run in parallel without port clashes.
+"""
+
+import socket
+import pytest
+from simp_common import *
+from simp_daemon import SimpDaemon
+
+
+class FakeClient:
+    """Client-daemon socket that registers with a daemon and reads its notifications."""
+
+    def __init__(self, daemon: SimpDaemon, username: str = 'tester'):
+        self.daemon_addr = ('127.0.0.1', daemon.client_port)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.settimeout(TIMEOUT)
+        if username:
+            self.command('connect', username=username)
+            assert self.recv()['command'] == 'ok'
+
+    def command(self, cmd: str, **kwargs):
+        msg = build_client_daemon_message(cmd, **kwargs)
+        self.sock.sendto(msg.encode('ascii'), self.daemon_addr)
+
+    def recv(self) -> dict:
+        data, _ = self.sock.recvfrom(4096)
+        return parse_client_daemon_message(data.decode('ascii'))
+
+    def expect(self, command: str) -> dict:
+        """Skip notifications until one with the given command arrives."""
+        while True:
+            msg = self.recv()
+            if msg['command'] == command:
+                return msg
+
+    def close(self):
+        self.sock.close()
+
+
+@pytest.fixture
+def make_daemon():
+    """Factory for started in-process daemons, all stopped at teardown."""
+    daemons = []
+
+    def factory(**kwargs) -> SimpDaemon:
+        kwargs.setdefault('host', '127.0.0.1')
+        kwargs.setdefault('daemon_port', 0)
+        kwargs.setdefault('client_port', 0)
+        daemon = SimpDaemon(**kwargs)
+        daemon.start()
+        daemons.append(daemon)
+        return daemon
+
+    yield factory
+    for daemon in daemons:
+        daemon.stop()
+
+
+@pytest.fixture
+def daemon(make_daemon) -> SimpDaemon:
+    """A daemon with default settings."""
+    return make_daemon()
+
+
+@pytest.fixture
+def daemon_addr(daemon) -> tuple:
+    """SIMP address of the `daemon` fixture."""
+    return ('127.0.0.1', daemon.daemon_port)
+
+
+@pytest.fixture
+def make_client():
+    """Factory for FakeClients connected to a daemon."""
+    clients = []
+
+    def factory(daemon: SimpDaemon, username: str = 'tester') -> FakeClient:
+        client = FakeClient(daemon, username)
+        clients.append(client)
+        return client
+
+    yield factory
+    for client in clients:
+        client.close()
+
+
+@pytest.fixture
+def make_peer():
+    """Factory for UDP sockets acting as remote SIMP daemons."""
+    socks = []
+
+    def factory() -> socket.socket:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.settimeout(TIMEOUT)
+        socks.append(sock)
+        return sock
+
+    yield factory
+    for sock in socks:
+        sock.close()
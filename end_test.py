@@ -3,14 +3,17 @@ import subprocess
 import time
 import socket
 import sys
-from simp_common import MessageType, build_simp_message, parse_simp_message, DAEMON_PORT, CLIENT_DAEMON_PORT, TIMEOUT, Test_PORT
+from simp_common import MessageType, build_simp_message, parse_simp_message, DAEMON_PORT, CLIENT_DAEMON_PORT, TIMEOUT
 
 DAEMON_ADDR = ("127.0.0.1", DAEMON_PORT)
 
 def start_daemon():
     print("[INFO] Starting simp_daemon.py ...")
-    proc = subprocess.Popen([sys.executable, "simp_daemon.py"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    time.sleep(1)  # give daemon time to start
+    proc = subprocess.Popen([sys.executable, "simp_daemon.py"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    # wait until the daemon reports that both ports are bound
+    for line in proc.stdout:
+        if line.startswith("READY"):
+            break
     return proc
 
 def start_client(username="testuser"):
@@ -35,7 +38,7 @@ def test_message_build_parse():
 def test_three_way_handshake():
     print("\n[TEST] Three-way handshake: SYN -> SYN+ACK -> ACK")
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.bind(('', Test_PORT))  # random client port
+    sock.bind(('', 0))  # random client port
     sock.settimeout(TIMEOUT)
     try:
         # send SYN
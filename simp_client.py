@@ -1,224 +1,593 @@
 #!/usr/bin/env python3
 
+import argparse
+import os
+import selectors
 import socket
 import sys
-import threading
+import termios
+import time
+import tty
+from collections import OrderedDict
 from simp_common import *
 
 
 
-class SimpClient:
-    def __init__(self, daemon_ip='127.0.0.1'):
+class ClientCore:
+    """Event-driven client core.
+
+    Multiplexes the daemon socket and any registered input (e.g. stdin)
+    with a selector. It can be used without the terminal UI:
+
+        core = ClientCore('127.0.0.1')
+        core.connect('bot')
+        core.on_message(lambda msg: core.send(msg['text'].upper()))
+        core.invite('10.0.0.2')
+        core.run()
+    """
+
+    def __init__(self, daemon_ip='127.0.0.1', daemon_port=None):
         self.daemon_ip = daemon_ip
+        self.daemon_port = env_setting('CLIENT_PORT', daemon_port, CLIENT_DAEMON_PORT)
         self.username = None
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.bind(('', 0))  # Bind to any available port
+        self.selector = selectors.DefaultSelector()
         self.in_chat = False
-        self.pending_invitation = None
+        self.partner = None
+        # Pending invitations by (ip, port) of the inviter, oldest first
+        self.invitations = OrderedDict()
+        self.busy = False
         self.running = True
-        
-    def start(self):
-        """Start the client."""
-        print("Welcome to SIMP Client 1.0.0")
-        print("=" * 50)
-        
-        # Get username
-        self.username = self.get_username()
-        
-        # Connect to daemon
-        if not self.connect_to_daemon():
-            print("Failed to connect to daemon")
-            return
-        
-        # Start listener thread for daemon messages
-        listener_thread = threading.Thread(target=self.listen_daemon, daemon=True)
-        listener_thread.start()
-        
-        # Main interaction loop
-        self.main_loop()
-    
-    def get_username(self) -> str:
-        """Get username from user."""
-        while True:
-            username = input("Please enter your username: ").strip()
-            if username and len(username) <= 32:
-                return username
-            print("Username must be non-empty and max 32 characters")
-    
-    def connect_to_daemon(self) -> bool:
-        """Connect to the local daemon."""
+        self.handlers = {}
+
+    def on(self, event: str, callback):
+        """Register callback(msg) for a daemon notification ('message', 'connected', ...)."""
+        self.handlers.setdefault(event, []).append(callback)
+
+    def on_message(self, callback):
+        """Register callback(msg) for incoming chat messages."""
+        self.on('message', callback)
+
+    def emit(self, event: str, msg: dict):
+        for callback in self.handlers.get(event, ()):
+            callback(msg)
+
+    def command(self, cmd: str, **kwargs):
+        """Send a command to the daemon."""
+        msg = build_client_daemon_message(cmd, **kwargs)
+        self.socket.sendto(msg.encode('ascii'), (self.daemon_ip, self.daemon_port))
+
+    def connect(self, username: str, timeout: float = 2.0) -> bool:
+        """Register with the local daemon. Blocks until it answers or timeout."""
+        self.username = username
         try:
-            msg = build_client_daemon_message('connect', username=self.username)
-            self.socket.sendto(msg.encode('ascii'), (self.daemon_ip, CLIENT_DAEMON_PORT))
-            
-            # Wait for response
-            self.socket.settimeout(2.0)
+            self.socket.settimeout(timeout)
+            self.command('connect', username=username)
             data, _ = self.socket.recvfrom(4096)
             response = parse_client_daemon_message(data.decode('ascii'))
-            self.socket.settimeout(None)
-            
-            if response['command'] == 'ok':
-                print(f"Connected to daemon as '{self.username}'")
-                return True
+        finally:
+            self.socket.setblocking(False)
+        if response['command'] != 'ok':
             return False
-        except Exception as e:
-            print(f"Error connecting to daemon: {e}")
+        self.selector.register(self.socket, selectors.EVENT_READ, self.read_daemon)
+        return True
+
+    def invite(self, target_ip: str, first_message: str = None, port: int = DAEMON_PORT):
+        """Ask the daemon to invite target_ip, optionally carrying a zero-RTT first message."""
+        kwargs = {'ip': target_ip, 'port': str(port)}
+        if first_message:
+            kwargs['text'] = first_message
+        self.command('invite', **kwargs)
+
+    @property
+    def pending_invitation(self) -> dict:
+        """The oldest pending invitation, or None."""
+        return next(iter(self.invitations.values()), None)
+
+    def _invitation_args(self, invitation: dict) -> dict:
+        invitation = invitation or self.pending_invitation
+        return {'ip': invitation['ip'], 'port': invitation['port']} if invitation else {}
+
+    def accept(self, invitation: dict = None):
+        """Accept an invitation, the oldest one by default."""
+        self.command('accept', **self._invitation_args(invitation))
+
+    def decline(self, invitation: dict = None):
+        """Decline an invitation, the oldest one by default."""
+        args = self._invitation_args(invitation)
+        self.command('decline', **args)
+        if args:
+            self.invitations.pop((args['ip'], args['port']), None)
+
+    def send(self, text: str, msg_id: str = None) -> bool:
+        """Send a chat message. Returns False while the daemon reports busy.
+
+        With a msg_id the daemon answers with a 'delivered' notification
+        (id, attempts, rtt_ms) once the partner has ACKed the message,
+        'dropped' (id) if a full send buffer pushed it out, or 'busy' (id)
+        if the buffer was full when it arrived.
+        """
+        if self.busy:
             return False
-    
-    def listen_daemon(self):
-        """Listen for messages from daemon."""
-        while self.running:
+        if msg_id is None:
+            self.command('send', text=text)
+        else:
+            self.command('send', text=text, id=msg_id)
+        return True
+
+    def send_file(self, path: str):
+        """Send a file to the chat partner; the daemon answers with file_* notifications."""
+        self.command('sendfile', path=os.path.abspath(path))
+
+    def end_chat(self):
+        """End the current chat."""
+        self.command('quit')
+        self.in_chat = False
+
+    def add_reader(self, fileobj, callback):
+        """Call callback() whenever fileobj becomes readable."""
+        self.selector.register(fileobj, selectors.EVENT_READ, callback)
+
+    def read_daemon(self):
+        """Drain the daemon socket."""
+        while True:
             try:
                 data, _ = self.socket.recvfrom(4096)
-                msg = parse_client_daemon_message(data.decode('ascii'))
-                self.handle_daemon_notification(msg)
-            except Exception as e:
-                if self.running:
-                    print(f"\nError in listener: {e}")
-    
+            except (BlockingIOError, InterruptedError):
+                return
+            self.handle_daemon_notification(parse_client_daemon_message(data.decode('ascii')))
+
     def handle_daemon_notification(self, msg: dict):
-        """Handle notifications from daemon."""
+        """Update state from a daemon notification, then run the callbacks."""
         cmd = msg['command']
-        
+
         if cmd == 'invitation':
-            self.pending_invitation = {
+            self.invitations[(msg['ip'], msg['port'])] = {
                 'username': msg['username'],
-                'ip': msg['ip']
+                'ip': msg['ip'],
+                'port': msg['port']
             }
-            print(f"\n{'='*50}")
-            print(f"📨 Incoming chat invitation!")
-            print(f"From: {msg['username']} ({msg['ip']})")
-            print(f"{'='*50}")
-            
+        elif cmd == 'invitation_expired':
+            self.invitations.pop((msg['ip'], msg['port']), None)
         elif cmd == 'connected':
             self.in_chat = True
-            self.pending_invitation = None
-            print(f"\n✓ Chat established with {msg['username']}")
-            print("Type your messages (or 'q' to quit chat)\n")
-            
+            self.partner = msg['username']
+            # The daemon turns the other inviters away
+            self.invitations.clear()
         elif cmd == 'disconnected':
             self.in_chat = False
-            print("\n✗ Chat ended")
-            
-        elif cmd == 'message':
-            print(f"\n[{msg['username']}]: {msg['text']}")
-            if self.in_chat:
-                print("You: ", end='', flush=True)
-                
-        elif cmd == 'error':
-            print(f"\n⚠ Error: {msg['message']}")
-    
-    def main_loop(self):
-        """Main interaction loop."""
+            self.partner = None
+            self.busy = False
+        elif cmd == 'busy':
+            self.busy = True
+        elif cmd == 'credit':
+            self.busy = False
+
+        self.emit(cmd, msg)
+
+    def poll(self, timeout: float = None):
+        """Wait for and dispatch one round of events."""
+        for key, _ in self.selector.select(timeout):
+            key.data()
+
+    def run(self):
+        """Dispatch events until close() is called."""
         while self.running:
-            try:
-                if self.pending_invitation:
-                    self.handle_invitation()
-                elif self.in_chat:
-                    self.chat_mode()
+            self.poll()
+
+    def close(self):
+        self.running = False
+        self.selector.close()
+        self.socket.close()
+
+
+class Renderer:
+    """Terminal output coalesced into frames, with the prompt and the line being typed kept last.
+
+    UI code queues lines with line() and sets the prompt with prompt();
+    flush() writes everything queued since the last frame in one write,
+    at most fps times per second. It erases the prompt line first and
+    redraws it, with the user's unfinished input, below the new lines:
+    on a terminal with a carriage return and an erase-line sequence,
+    elsewhere (pipes, files) by moving to a new line. A headless
+    renderer only counts the lines it would have written.
+    """
+
+    ERASE_LINE = "\r\x1b[K"
+
+    def __init__(self, stream=None, fps: float = 30, headless: bool = False, ansi: bool = None,
+                 clock=time.monotonic):
+        self.stream = stream or sys.stdout
+        self.interval = 1 / fps if fps else 0.0
+        self.headless = headless
+        self.ansi = self.stream.isatty() if ansi is None else ansi
+        self.clock = clock
+        self.lines = []
+        self.prompt_text = None
+        self.input = ''
+        self.shown = False  # prompt and input are on screen, the cursor right after them
+        self.dirty = False  # prompt or input changed since they were drawn
+        self.next_frame = 0.0
+        self.frames = 0
+        self.lines_rendered = 0
+
+    def line(self, text: str = ''):
+        """Queue text, which may span several lines, for the next frame."""
+        if self.headless:
+            self.lines_rendered += 1
+            return
+        self.lines.append(text)
+
+    def prompt(self, text: str):
+        self.prompt_text = text
+        self.dirty = True
+
+    def set_input(self, text: str):
+        """The user's unfinished input line, redrawn after the prompt."""
+        self.input = text
+        self.dirty = True
+
+    def commit_input(self):
+        """The user pressed Enter: leave the typed line on screen and continue below it."""
+        if self.headless:
+            return
+        if self.ansi:
+            self.lines.append((self.prompt_text or '') + self.input)
+            # Written in place of the prompt line, which is then erased as usual
+        elif self.shown:
+            # The input is not echoed into a pipe, just end the prompt line
+            self.lines.insert(0, '')
+            self.shown = False
+        self.input = ''
+        self.dirty = True
+
+    def pending(self) -> bool:
+        return bool(self.lines) or (self.prompt_text is not None and (self.dirty or not self.shown))
+
+    def timeout(self):
+        """Seconds until the next frame is due, None if there is nothing to write."""
+        if self.headless or not self.pending():
+            return None
+        return max(0.0, self.next_frame - self.clock())
+
+    def flush(self, force: bool = False):
+        """Write a frame if one is due (or force), in a single write."""
+        if self.headless or not self.pending():
+            return
+        now = self.clock()
+        if not force and now < self.next_frame:
+            return
+        parts = []
+        if self.shown:
+            parts.append(self.ERASE_LINE if self.ansi else '\n')
+        if self.lines:
+            parts.append('\n'.join(self.lines))
+            parts.append('\n')
+            self.lines_rendered += len(self.lines)
+            self.lines.clear()
+        self.shown = self.prompt_text is not None
+        if self.shown:
+            parts.append(self.prompt_text + self.input)
+        self.dirty = False
+        self.stream.write(''.join(parts))
+        self.stream.flush()
+        self.frames += 1
+        self.next_frame = now + self.interval
+
+
+class SimpClient(ClientCore):
+    """Terminal UI on top of ClientCore. Reads stdin through the same selector.
+
+    All output goes through a Renderer, so a burst of notifications costs
+    one terminal write per frame. On a terminal, stdin is switched to
+    cbreak mode and echoed by the renderer, which lets incoming messages
+    appear above the line being typed without breaking it up.
+    """
+
+    def __init__(self, daemon_ip='127.0.0.1', daemon_port=None, fps: float = 30, headless: bool = False):
+        super().__init__(daemon_ip, daemon_port)
+        self.state = 'username'
+        self.stdin_fd = sys.stdin.fileno()
+        self.input_buffer = b''
+        self.renderer = Renderer(sys.stdout, fps, headless)
+        self.out = self.renderer.line
+        # Saved terminal settings while we echo input ourselves
+        self.saved_tty = None
+        self.sent_count = 0
+        self.unconfirmed = {}
+        # (id, text) of lines typed while the daemon was busy, sent on 'credit'
+        self.held = []
+        self.on('invitation', self.show_invitation)
+        self.on('invitation_expired', self.show_invitation_expired)
+        self.on('connected', self.show_connected)
+        self.on('disconnected', self.show_disconnected)
+        self.on('message', self.show_message)
+        self.on('delivered', self.show_delivered)
+        self.on('dropped', self.show_dropped)
+        self.on('file_sent', lambda msg: self.show_file(f"Sent {msg['name']}", msg))
+        self.on('file_received', lambda msg: self.show_file(f"Received {msg['path']}", msg))
+        self.on('file_failed', lambda msg: self.out(f"✗ Transfer of {msg['name']} failed: {msg['reason']}"))
+        self.on('file_refused', lambda msg: self.out(f"✗ Refused {msg['name']} ({msg['size']} bytes), "
+                                                     "the daemon only takes files with --accept-files"))
+        self.on('busy', self.show_busy)
+        self.on('credit', self.show_credit)
+        self.on('error', lambda msg: self.out(f"⚠ Error: {msg['message']}"))
+
+    def start(self):
+        """Start the client."""
+        self.out("Welcome to SIMP Client 1.0.0")
+        self.out("=" * 50)
+        if os.isatty(self.stdin_fd) and not self.renderer.headless:
+            self.saved_tty = termios.tcgetattr(self.stdin_fd)
+            tty.setcbreak(self.stdin_fd)
+        self.add_reader(self.stdin_fd, self.read_stdin)
+        self.prompt()
+
+        # Main event loop
+        try:
+            self.run()
+        except KeyboardInterrupt:
+            self.out("")
+            self.out("Exiting...")
+            self.quit()
+        finally:
+            self.restore_tty()
+
+    def run(self):
+        """Dispatch events, writing a frame whenever one is due."""
+        while self.running:
+            self.poll(self.renderer.timeout())
+            self.renderer.flush()
+
+    def restore_tty(self):
+        if self.saved_tty is not None:
+            termios.tcsetattr(self.stdin_fd, termios.TCSADRAIN, self.saved_tty)
+            self.saved_tty = None
+
+    def read_stdin(self):
+        """Split raw stdin input into lines and dispatch them."""
+        data = os.read(self.stdin_fd, 4096)
+        if not data:
+            self.quit()
+            return
+        if self.saved_tty is not None:
+            data = self.edit_input(data)
+        self.input_buffer += data
+        while b'\n' in self.input_buffer:
+            line, self.input_buffer = self.input_buffer.split(b'\n', 1)
+            self.renderer.commit_input()
+            self.handle_line(line.decode('utf-8', 'replace').strip())
+            if not self.running:
+                return
+        if self.saved_tty is not None:
+            self.renderer.set_input(self.input_buffer.decode('utf-8', 'replace'))
+
+    def edit_input(self, data: bytes) -> bytes:
+        """Apply the line editing the terminal does in canonical mode: erase, Ctrl-D, Enter."""
+        kept = b''
+        for byte in data:
+            char = bytes([byte])
+            if char in (b'\x7f', b'\x08'):
+                if kept:
+                    kept = kept[:-1]
                 else:
-                    self.idle_mode()
-            except KeyboardInterrupt:
-                print("\n\nExiting...")
+                    self.input_buffer = self.input_buffer[:-1]
+            elif char == b'\x04' and not kept and not self.input_buffer:
                 self.quit()
-                break
-    
-    def handle_invitation(self):
-        """Handle pending invitation."""
-        inv = self.pending_invitation
-        
-        while True:
-            choice = input("Accept invitation? (y/n): ").strip().lower()
-            if choice == 'y':
-                msg = build_client_daemon_message('accept')
-                self.socket.sendto(msg.encode('ascii'), (self.daemon_ip, CLIENT_DAEMON_PORT))
-                print("Accepting invitation...")
-                break
-            elif choice == 'n':
-                msg = build_client_daemon_message('decline')
-                self.socket.sendto(msg.encode('ascii'), (self.daemon_ip, CLIENT_DAEMON_PORT))
-                self.pending_invitation = None
-                print("Invitation declined")
-                break
+            elif char in (b'\r', b'\n'):
+                kept += b'\n'
+            elif byte >= 0x20 or char == b'\t':
+                kept += char
+        return kept
+
+    def prompt(self):
+        """Show the prompt that belongs to the current state."""
+        if self.state == 'username':
+            self.renderer.prompt("Please enter your username: ")
+        elif self.state == 'menu':
+            self.out("")
+            self.out("=" * 50)
+            self.out("Options:")
+            self.out("  1. Start a new chat")
+            self.out("  2. Wait for incoming chat requests")
+            self.out("  q. Quit")
+            self.out("=" * 50)
+            self.renderer.prompt("Your choice: ")
+        elif self.state == 'target':
+            self.renderer.prompt("Enter remote user's IP address (ip[:port]): ")
+        elif self.state == 'invitation':
+            invitation = self.pending_invitation
+            waiting = f" ({len(self.invitations) - 1} more waiting)" if len(self.invitations) > 1 else ""
+            self.renderer.prompt(f"Accept invitation from {invitation['username']}{waiting}? (y/n): ")
+        elif self.state == 'chat':
+            self.renderer.prompt("You: ")
+        else:
+            self.renderer.prompt("")
+
+    def handle_line(self, line: str):
+        """Handle one line of user input according to the current state."""
+        if self.state == 'username':
+            if not line or len(line) > 32:
+                self.out("Username must be non-empty and max 32 characters")
+            elif self.connect_to_daemon(line):
+                self.state = 'menu'
             else:
-                print("Please enter 'y' or 'n'")
-    
-    def chat_mode(self):
-        """Active chat mode."""
-        try:
-            message = input("You: ").strip()
-            
-            if message.lower() == 'q':
+                self.out("Failed to connect to daemon")
+                self.quit()
+                return
+
+        elif self.state == 'invitation':
+            if line.lower() == 'y':
+                self.accept()
+                self.out("Accepting invitation...")
+                self.state = 'waiting'
+                self.prompt()
+                return
+            elif line.lower() == 'n':
+                self.decline()
+                self.out("Invitation declined")
+                # Ask about the next one, if any
+                if not self.invitations:
+                    self.state = 'menu'
+            else:
+                self.out("Please enter 'y' or 'n'")
+
+        elif self.state == 'chat':
+            if line.lower() == 'q':
                 self.end_chat()
-            elif message:
-                msg = build_client_daemon_message('send', text=message)
-                self.socket.sendto(msg.encode('ascii'), (self.daemon_ip, CLIENT_DAEMON_PORT))
-        except EOFError:
-            self.end_chat()
-    
-    def idle_mode(self):
-        """Idle mode - waiting for action."""
-        print("\n" + "="*50)
-        print("Options:")
-        print("  1. Start a new chat")
-        print("  2. Wait for incoming chat requests")
-        print("  q. Quit")
-        print("="*50)
-        
-        choice = input("Your choice: ").strip()
-        
-        if choice == '1':
-            self.start_new_chat()
-        elif choice == '2':
-            print("Waiting for incoming requests...")
-            print("(You can press Ctrl+C to return to menu)")
-            try:
-                while not self.pending_invitation and not self.in_chat:
-                    import time
-                    time.sleep(0.5)
-            except KeyboardInterrupt:
-                print("\nReturning to menu...")
-        elif choice.lower() == 'q':
-            self.quit()
-    
-    def start_new_chat(self):
-        """Initiate a new chat."""
-        target_ip = input("Enter remote user's IP address: ").strip()
-        
-        if not target_ip:
-            print("Invalid IP address")
-            return
-        
-        print(f"Connecting to {target_ip}...")
-        msg = build_client_daemon_message('invite', ip=target_ip, port=str(DAEMON_PORT))
-        self.socket.sendto(msg.encode('ascii'), (self.daemon_ip, CLIENT_DAEMON_PORT))
-        print("Invitation sent. Waiting for response...")
-    
-    def end_chat(self):
-        """End current chat."""
-        msg = build_client_daemon_message('quit')
-        self.socket.sendto(msg.encode('ascii'), (self.daemon_ip, CLIENT_DAEMON_PORT))
-        self.in_chat = False
-        print("Chat ended")
-    
+                self.out("Chat ended")
+                self.state = 'menu'
+            elif line.startswith('/file '):
+                self.send_file(line[6:].strip())
+            elif line:
+                self.sent_count += 1
+                msg_id = str(self.sent_count)
+                # Behind held lines even if the daemon is ready again, to keep the order
+                if not self.held and self.send(line, msg_id):
+                    self.unconfirmed[msg_id] = line
+                else:
+                    self.hold(msg_id, line)
+
+        elif self.state == 'target':
+            target_ip, _, port = line.partition(':')
+            if target_ip and (not port or port.isdigit()):
+                self.out(f"Connecting to {line}...")
+                self.invite(target_ip, port=int(port or DAEMON_PORT))
+                self.out("Invitation sent. Waiting for response...")
+            else:
+                self.out("Invalid IP address")
+            self.state = 'menu'
+
+        elif self.state == 'waiting':
+            # Any input while waiting returns to the menu
+            self.state = 'menu'
+
+        else:
+            if line == '1':
+                self.state = 'target'
+            elif line == '2':
+                self.out("Waiting for incoming requests...")
+                self.out("(Press Enter to return to menu)")
+                self.state = 'waiting'
+                self.prompt()
+                return
+            elif line.lower() == 'q':
+                self.quit()
+                return
+
+        self.prompt()
+
+    def connect_to_daemon(self, username: str) -> bool:
+        """Connect to the local daemon."""
+        # Show what is queued before blocking on the daemon's answer
+        self.renderer.flush(force=True)
+        try:
+            if self.connect(username):
+                self.out(f"Connected to daemon as '{self.username}'")
+                return True
+            return False
+        except Exception as e:
+            self.out(f"Error connecting to daemon: {e}")
+            return False
+
+    def show_invitation(self, msg: dict):
+        self.out("=" * 50)
+        self.out("📨 Incoming chat invitation!")
+        self.out(f"From: {msg['username']} ({msg['ip']}:{msg['port']})")
+        self.out("=" * 50)
+        if self.state != 'chat':
+            self.state = 'invitation'
+            self.prompt()
+
+    def show_invitation_expired(self, msg: dict):
+        self.out(f"✗ Invitation from {msg['username']} expired")
+        if self.state == 'invitation':
+            if not self.invitations:
+                self.state = 'menu'
+            self.prompt()
+
+    def show_connected(self, msg: dict):
+        self.out(f"✓ Chat established with {msg['username']}")
+        self.out("Type your messages, '/file <path>' to send a file (or 'q' to quit chat)")
+        self.out("")
+        self.state = 'chat'
+        self.prompt()
+
+    def show_disconnected(self, msg: dict):
+        self.unconfirmed.clear()
+        if self.held:
+            self.out(f"✗ {len(self.held)} message(s) not sent")
+            self.held.clear()
+        if msg.get('reason') == 'timeout':
+            self.out("✗ Chat ended (peer not responding)")
+        else:
+            self.out("✗ Chat ended")
+        self.state = 'menu'
+        self.prompt()
+
+    def show_message(self, msg: dict):
+        self.out(f"[{msg['username']}]: {msg['text']}")
+
+    def show_delivered(self, msg: dict):
+        text = self.unconfirmed.pop(msg['id'], None)
+        if text is not None:
+            self.out(f"✓ Delivered: {text[:20]} ({msg['rtt_ms']} ms)")
+
+    def hold(self, msg_id: str, text: str):
+        """Keep a line the daemon has no room for, in the order it was typed."""
+        self.held.append((msg_id, text))
+        self.held.sort(key=lambda item: int(item[0]))
+        self.out(f"⚠ Daemon busy, sending once it is ready: {text[:20]}")
+
+    def show_busy(self, msg: dict):
+        text = self.unconfirmed.pop(msg.get('id'), None)
+        if text is not None:
+            self.hold(msg['id'], text)
+
+    def show_credit(self, msg: dict):
+        self.out(f"✓ Daemon ready again ({msg['available']} free)")
+        # No more than the daemon has room for, the rest waits for the next credit
+        for _ in range(min(len(self.held), int(msg['available']))):
+            msg_id, text = self.held.pop(0)
+            self.send(text, msg_id)
+            self.unconfirmed[msg_id] = text
+
+    def show_dropped(self, msg: dict):
+        text = self.unconfirmed.pop(msg['id'], None)
+        if text is not None:
+            self.out(f"✗ Dropped, send buffer full: {text[:20]}")
+
+    def show_file(self, text: str, msg: dict):
+        self.out(f"✓ {text}: {msg['bytes']} bytes in {msg['seconds']} s ({msg['mb_s']} MB/s)")
+
     def quit(self):
         """Quit the client."""
         if self.in_chat:
             self.end_chat()
-        self.running = False
-        self.socket.close()
-        print("Goodbye!")
+        self.close()
+        self.out("Goodbye!")
+        self.renderer.prompt_text = None
+        self.renderer.flush(force=True)
+        self.restore_tty()
         sys.exit(0)
 
 
 def main():
-    if len(sys.argv) < 2:
+    parser = argparse.ArgumentParser(description="SIMP chat client")
+    parser.add_argument('daemon_ip', nargs='?', help="IP of the local daemon (default 127.0.0.1)")
+    parser.add_argument('--port', type=int, help=f"client port of the daemon (default {CLIENT_DAEMON_PORT})")
+    parser.add_argument('--fps', type=float, default=30, help="screen updates per second at most (default 30)")
+    parser.add_argument('--headless', action='store_true', help="render nothing, e.g. for benchmark runs")
+    args = parser.parse_args()
+
+    daemon_ip = args.daemon_ip
+    if daemon_ip is None:
         daemon_ip = '127.0.0.1'
-        print(f"Using default daemon IP: {daemon_ip}")
-    else:
-        daemon_ip = sys.argv[1]
-    
-    client = SimpClient(daemon_ip)
+        if not args.headless:
+            print(f"Using default daemon IP: {daemon_ip}")
+
+    client = SimpClient(daemon_ip, args.port, args.fps, args.headless)
     client.start()
 
 
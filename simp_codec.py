@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""Bulk decoding and encoding of SIMP datagram logs with NumPy.
+
+A log is a file of SIMP datagrams written back to back, each one its
+39-byte header followed by its payload. DatagramLog maps the file,
+finds the record boundaries and exposes all headers as one structured
+array, so analysis runs as array operations instead of a
+parse_simp_message() call per datagram:
+
+    with DatagramLog('capture.simp') as log:
+        h = log.headers
+        acks = np.count_nonzero((h['type'] == 1) & (h['operation'] == 4))
+        users, counts = np.unique(h['username'], return_counts=True)
+
+Usernames are kept as the raw 32 space-padded bytes of the header.
+encode_records() builds such a log from field arrays, e.g. to generate
+test corpora; python simp_codec.py FILE prints a summary of a log.
+"""
+
+import argparse
+import mmap
+import os
+import struct
+import numpy as np
+from simp_common import *
+
+HEADER_DTYPE = np.dtype([
+    ('type', 'u1'),
+    ('operation', 'u1'),
+    ('seq', 'u1'),
+    ('username', 'S32'),
+    ('length', '>u4'),
+])
+assert HEADER_DTYPE.itemsize == HEADER_SIZE
+LENGTH_OFFSET = HEADER_DTYPE.fields['length'][1]
+
+
+def _uniform_offsets(data: np.ndarray):
+    """Offsets if every record has the payload length of the first one, else None.
+
+    Checked with array operations only, this is the fast path for
+    corpora of ACKs or fixed-size messages.
+    """
+    first = int.from_bytes(data[LENGTH_OFFSET:HEADER_SIZE].tobytes(), 'big')
+    size = HEADER_SIZE + first
+    if len(data) % size:
+        return None
+    lengths = data.reshape(-1, size)[:, LENGTH_OFFSET:HEADER_SIZE].copy().view('>u4')
+    if np.any(lengths != first):
+        return None
+    return np.arange(0, len(data), size, dtype=np.int64)
+
+
+def index_records(buf) -> np.ndarray:
+    """Start offsets of all records in buf, in one pass. Raises ValueError on a truncated log."""
+    data = np.frombuffer(buf, dtype=np.uint8)
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.int64)
+    if len(data) >= HEADER_SIZE:
+        offsets = _uniform_offsets(data)
+        if offsets is not None:
+            return offsets
+    # Every boundary depends on the previous length field, so this part is sequential
+    offsets = []
+    append = offsets.append
+    unpack_length = struct.Struct('>I').unpack_from
+    end = len(data) - HEADER_SIZE
+    pos = 0
+    while pos <= end:
+        append(pos)
+        pos += HEADER_SIZE + unpack_length(buf, pos + LENGTH_OFFSET)[0]
+    if pos != len(data):
+        raise ValueError(f"Truncated record at offset {offsets[-1] if pos > len(data) else pos}")
+    return np.array(offsets, dtype=np.int64)
+
+
+def _header_mask(offsets: np.ndarray, size: int) -> np.ndarray:
+    """Boolean mask of the header bytes of the records at ascending offsets in size bytes."""
+    # Runs of False (bytes before, between and after headers) and True (headers) alternate
+    runs = np.empty(2 * len(offsets) + 1, dtype=np.int64)
+    runs[0] = offsets[0] if len(offsets) else size
+    runs[1::2] = HEADER_SIZE
+    runs[2::2] = np.diff(offsets, append=size) - HEADER_SIZE
+    values = np.zeros(len(runs), dtype=bool)
+    values[1::2] = True
+    return np.repeat(values, runs)
+
+
+def decode_headers(buf, offsets: np.ndarray) -> np.ndarray:
+    """The headers at ascending offsets as a HEADER_DTYPE array."""
+    data = np.frombuffer(buf, dtype=np.uint8)
+    if len(offsets) and offsets[-1] - offsets[0] == (len(offsets) - 1) * HEADER_SIZE:
+        # Header-only records lie back to back: a view, no copy
+        start = int(offsets[0])
+        return data[start:start + len(offsets) * HEADER_SIZE].view(HEADER_DTYPE)
+    return data[_header_mask(offsets, len(data))].view(HEADER_DTYPE)
+
+
+def encode_records(types, operations, seqs, usernames, payloads=None) -> bytes:
+    """Build a log from per-record fields; the inverse of index_records() and decode_headers().
+
+    types, operations and seqs are integer arrays, usernames a sequence of
+    str or bytes of at most 32 characters and payloads an optional
+    sequence of bytes, empty by default.
+    """
+    count = len(types)
+    headers = np.zeros(count, dtype=HEADER_DTYPE)
+    headers['type'] = types
+    headers['operation'] = operations
+    headers['seq'] = seqs
+    headers['username'] = usernames
+    # Pad with spaces like build_simp_message, NumPy pads with NUL
+    names = headers.view(np.uint8).reshape(count, HEADER_SIZE)[:, 3:3 + USERNAME_SIZE]
+    names[names == 0] = ord(' ')
+    if payloads is None:
+        return headers.tobytes()
+    lengths = np.fromiter(map(len, payloads), dtype=np.int64, count=count)
+    headers['length'] = lengths
+    sizes = HEADER_SIZE + lengths
+    offsets = np.zeros(count, dtype=np.int64)
+    np.cumsum(sizes[:-1], out=offsets[1:])
+    out = np.empty(int(sizes.sum()), dtype=np.uint8)
+    is_header = _header_mask(offsets, len(out))
+    out[is_header] = headers.view(np.uint8)
+    out[~is_header] = np.frombuffer(b"".join(payloads), dtype=np.uint8)
+    return out.tobytes()
+
+
+class DatagramLog:
+    """A memory-mapped log of SIMP datagrams with its headers as a structured array."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        self.offsets = index_records(self.mm)
+        self.headers = decode_headers(self.mm, self.offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def payload(self, i: int) -> bytes:
+        start = int(self.offsets[i]) + HEADER_SIZE
+        return self.mm[start:start + int(self.headers['length'][i])]
+
+    def message(self, i: int) -> dict:
+        """Record i as parse_simp_message() returns it."""
+        start = int(self.offsets[i])
+        return parse_simp_message(self.mm[start:start + HEADER_SIZE + int(self.headers['length'][i])])
+
+    def close(self):
+        # Drop the arrays first, they may still export the mapping
+        self.headers = self.offsets = None
+        if self.mm:
+            self.mm.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def summary(headers: np.ndarray) -> dict:
+    """Counts for a quick look at a log: datagrams, ACK ratio, chat volume per user."""
+    control = headers['type'] == MessageType.CONTROL.value
+    chat = headers['type'] == MessageType.CHAT.value
+    acks = control & (headers['operation'] == OperationType.ACK.value)
+    users, counts = np.unique(headers['username'][chat], return_counts=True)
+    return {
+        'datagrams': len(headers),
+        'control': int(np.count_nonzero(control)),
+        'chat': int(np.count_nonzero(chat)),
+        'ack_ratio': round(np.count_nonzero(acks) / max(1, np.count_nonzero(chat)), 3),
+        'payload_bytes': int(headers['length'].sum(dtype=np.int64)),
+        'chat_by_user': {u.decode('ascii').strip(): int(c) for u, c in zip(users, counts)},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize a log of concatenated SIMP datagrams")
+    parser.add_argument('path')
+    args = parser.parse_args()
+    with DatagramLog(args.path) as log:
+        for key, value in summary(log.headers).items():
+            print(f"{key:16} {value}")
+
+
+if __name__ == "__main__":
+    main()
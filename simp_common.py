@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import os
 import socket
 import struct
 from enum import Enum
@@ -16,11 +17,57 @@ DAEMON_PORT = 7777
 DAEMON_ADDR = ("127.0.0.1", 7777)
 CLIENT_DAEMON_PORT = 7778
 TIMEOUT = 2
+MAX_RETRIES = 5
+HANDSHAKE_TIMEOUT = 10
+INVITATION_TTL = 30
+INVITATION_QUEUE_SIZE = 8  # pending invitations per daemon, further SYNs are refused
+KEEPALIVE_INTERVAL = 15
+KEEPALIVE_PROBES = 3
+SEND_QUEUE_SIZE = 64
+SESSION_BUFFER = 256 << 10  # bytes preallocated per session for queued outgoing messages
+BUFFER_POLICY = 'reject'  # when the session buffer is full: reject, drop_oldest or spill
+MEMORY_BUDGET = 16 << 20  # bytes for a daemon's session buffer and received datagrams waiting
+CLIENT_RCVBUF = 1 << 20
+SOURCE_RATE = 20  # datagrams per second from one address, burst of twice that
+GLOBAL_RATE = 1000  # datagrams per second from all addresses but the chat partner
+RATE_TABLE_SIZE = 4096  # source addresses tracked by the rate limiter
+COOKIE_LIFETIME = 10
+DISPATCH_QUEUE_SIZE = 1024  # received datagrams waiting per priority class
+CONTROL_BURST = 16  # control datagrams served in a row before waiting chat gets a turn
+# Header extensions a daemon offers in its SYN and accepts in its SYN+ACK
+SUPPORTED_EXTENSIONS = ('receipts', 'files', 'compact')
+# 'receipts': chat payloads start with an 8 hex digit message id and the
+# 16 hex digit send time in microseconds since the epoch; the ACK echoes the id
+RECEIPT_ID_SIZE = 8
+RECEIPT_SIZE = RECEIPT_ID_SIZE + 16
+MAX_ONE_WAY_LATENCY = 60  # seconds, beyond that (or negative) the clocks are not synchronized
+# 'files': chunked file transfer in FILE datagrams, see simp_transfer.py
+FILE_MTU = 1500  # chunks are sized so a FILE datagram fits one Ethernet frame
+FILE_CHUNK_HEADER_SIZE = 16  # transfer id, offset, CRC-32 in front of the chunk
+FILE_CHUNK_SIZE = FILE_MTU - 28 - HEADER_SIZE - FILE_CHUNK_HEADER_SIZE  # 28: IPv4 + UDP headers
+FILE_WINDOW = 64  # chunks in flight
+# 'compact': SYN and SYN+ACK carry a sid option, the 16-bit session ID the
+# sender will put in place of its username. Datagrams inside the session
+# then use a 7-byte header: type | 0x80, operation, seq, session ID, length
+COMPACT_FLAG = 0x80
+COMPACT_HEADER = struct.Struct('>BBBHH')
+COMPACT_HEADER_SIZE = COMPACT_HEADER.size
+
+
+def env_setting(name: str, value=None, default=None, cast=int):
+    """Resolve a setting: explicit value first, then $SIMP_<name>, then default."""
+    if value is not None:
+        return value
+    env = os.environ.get(f"SIMP_{name}")
+    if env:
+        return cast(env)
+    return default
 
 
 class MessageType(Enum):
     CONTROL = 0x01
     CHAT = 0x02
+    FILE = 0x03  # binary payload, only between daemons that negotiated 'files'
 
 
 class OperationType(Enum):
@@ -28,11 +75,13 @@ class OperationType(Enum):
     SYN = 0x02
     ACK = 0x04
     FIN = 0x08
+    PING = 0x10  # Keepalive probe, answered with PING | ACK
+    RETRY = 0x03  # SYN | ERR: daemon under load, repeat the SYN with the cookie in the payload
     CHAT_MSG = 0x01  # For chat messages
 
 
-def build_simp_message(msg_type: MessageType, operation: int, seq: int, username: str, payload: str = "") -> bytes:
-    """Build a SIMP protocol message."""
+def build_simp_header(msg_type: MessageType, operation: int, seq: int, username: str, payload_len: int) -> bytes:
+    """Build the 39-byte SIMP header for a payload of payload_len bytes."""
     type_byte = msg_type.value.to_bytes(1, byteorder='big')
     op_byte = operation.to_bytes(1, byteorder='big')
     seq_byte = seq.to_bytes(1, byteorder='big')
@@ -40,16 +89,58 @@ def build_simp_message(msg_type: MessageType, operation: int, seq: int, username
     # Pad username to 32 bytes
     username_bytes = username[:32].ljust(32).encode('ascii')
     
-    # Encode payload
-    payload_bytes = payload.encode('ascii')
-    payload_len = len(payload_bytes).to_bytes(4, byteorder='big')
+    payload_len = payload_len.to_bytes(4, byteorder='big')
     
-    return type_byte + op_byte + seq_byte + username_bytes + payload_len + payload_bytes
+    return type_byte + op_byte + seq_byte + username_bytes + payload_len
 
 
+def build_simp_message(msg_type: MessageType, operation: int, seq: int, username: str, payload="") -> bytes:
+    """Build a SIMP protocol message. The payload is ASCII text, or bytes for FILE messages."""
+    payload_bytes = payload if isinstance(payload, bytes) else payload.encode('ascii')
+    return build_simp_header(msg_type, operation, seq, username, len(payload_bytes)) + payload_bytes
 
-def parse_simp_message(data: bytes) -> dict:
-    """Parse a SIMP protocol message."""
+
+
+def build_compact_header(msg_type: MessageType, operation: int, seq: int, session_id: int, payload_len: int) -> bytes:
+    """Build the 7-byte compact header, see COMPACT_FLAG."""
+    return COMPACT_HEADER.pack(msg_type.value | COMPACT_FLAG, operation, seq, session_id, payload_len)
+
+
+def build_compact_message(msg_type: MessageType, operation: int, seq: int, session_id: int, payload="") -> bytes:
+    """Build a SIMP message with the compact header, for a session that negotiated it."""
+    payload_bytes = payload if isinstance(payload, bytes) else payload.encode('ascii')
+    return build_compact_header(msg_type, operation, seq, session_id, len(payload_bytes)) + payload_bytes
+
+
+def parse_compact_message(data: bytes, sessions: dict) -> dict:
+    """Parse a compact message, resolving its session ID to the username through sessions."""
+    if len(data) < COMPACT_HEADER_SIZE:
+        raise ValueError("Message too short")
+    msg_type, operation, seq, session_id, payload_len = COMPACT_HEADER.unpack_from(data)
+    username = sessions.get(session_id)
+    if username is None:
+        raise ValueError(f"Unknown session {session_id:04x}")
+    if len(data) < COMPACT_HEADER_SIZE + payload_len:
+        raise ValueError("Incomplete payload")
+    msg_type &= ~COMPACT_FLAG
+    payload = data[COMPACT_HEADER_SIZE:COMPACT_HEADER_SIZE + payload_len]
+    if msg_type != MessageType.FILE.value:
+        payload = payload.decode('ascii')
+    return {
+        'type': msg_type,
+        'operation': operation,
+        'seq': seq,
+        'username': username,
+        'length': payload_len,
+        'payload': payload,
+        'session_id': session_id
+    }
+
+
+def parse_simp_message(data: bytes, sessions: dict = None) -> dict:
+    """Parse a SIMP protocol message; compact ones are resolved through sessions {session ID: username}."""
+    if data[:1] and data[0] & COMPACT_FLAG:
+        return parse_compact_message(data, sessions or {})
     if len(data) < HEADER_SIZE:
         raise ValueError("Message too short")
     
@@ -62,7 +153,9 @@ def parse_simp_message(data: bytes) -> dict:
     if len(data) < HEADER_SIZE + payload_len:
         raise ValueError("Incomplete payload")
     
-    payload = data[39:39+payload_len].decode('ascii')
+    payload = data[39:39+payload_len]
+    if msg_type != MessageType.FILE.value:
+        payload = payload.decode('ascii')
     
     return {
         'type': msg_type,
@@ -74,6 +167,49 @@ def parse_simp_message(data: bytes) -> dict:
     }
 
 
+def add_syn_cookie(cookie: str, payload: str = "") -> str:
+    """Prefix a SYN payload with the cookie from a RETRY."""
+    return f"\x02{cookie}\x02{payload}"
+
+
+def split_syn_cookie(payload: str) -> tuple:
+    """Split a SYN payload into (cookie or None, rest)."""
+    if payload.startswith("\x02"):
+        cookie, sep, rest = payload[1:].partition("\x02")
+        if sep:
+            return cookie, rest
+    return None, payload
+
+
+def add_syn_options(options: dict, payload: str = "") -> str:
+    """Prefix a SYN or SYN+ACK payload with handshake options, e.g. {'ext': 'receipts'}."""
+    if not options:
+        return payload
+    return "\x01" + ";".join(f"{key}={value}" for key, value in options.items()) + "\x01" + payload
+
+
+def split_syn_options(payload: str) -> tuple:
+    """Split a SYN or SYN+ACK payload into (options dict, rest). Peers without options send none."""
+    if payload.startswith("\x01"):
+        block, sep, rest = payload[1:].partition("\x01")
+        if sep:
+            options = dict(item.split("=", 1) for item in block.split(";") if "=" in item)
+            return options, rest
+    return {}, payload
+
+
+def add_receipt(msg_id: int, sent_us: int, text: str) -> str:
+    """Prefix a chat payload with the 'receipts' extension header."""
+    return f"{msg_id:08x}{sent_us:016x}{text}"
+
+
+def split_receipt(payload: str) -> tuple:
+    """Split a 'receipts' chat payload into (msg_id, sent_us, text)."""
+    if len(payload) < RECEIPT_SIZE:
+        raise ValueError("Chat payload too short for a receipt header")
+    return int(payload[:RECEIPT_ID_SIZE], 16), int(payload[RECEIPT_ID_SIZE:RECEIPT_SIZE], 16), payload[RECEIPT_SIZE:]
+
+
 def build_client_daemon_message(cmd: str, **kwargs) -> str:
     """Build internal client-daemon protocol message."""
     parts = [cmd]
@@ -1,68 +1,246 @@
 #!/usr/bin/env python3
 
+import argparse
+import os
+import random
 import socket
 import sys
 import threading
 import time
+from collections import OrderedDict
 from simp_common import *
+from simp_timer import TimerWheel
+from simp_ratelimit import RateLimiter, SynCookies
+from simp_dispatch import PriorityDispatcher, WorkerTimers
+from simp_log import LEVELS, EventLog, fmt_addr
+from simp_profile import Profiler, HandlerTimers
+from simp_metrics import LatencyStats
+from simp_transfer import TransferEngine
+from simp_ring import RingBuffer, MemoryBudget
+from simp_restart import HandoverServer, write_snapshot, send_handover, receive_handover, encode_bytes, decode_bytes
+from simp_transport import TRANSPORTS
+
+# Client commands only taken from the client that registered with 'connect'
+REGISTERED_ONLY = ('sendfile', 'profile', 'timing')
 
 
 class SimpDaemon:
-    def __init__(self, host='0.0.0.0'):
-        self.host = host
+    def __init__(self, host=None, daemon_port=None, client_port=None, client_host=None,
+                 timeout=None, handshake_timeout=None, invitation_ttl=None,
+                 keepalive_interval=None, keepalive_probes=None, send_queue_size=None,
+                 source_rate=None, global_rate=None, rate_table_size=None, dispatch_queue_size=None,
+                 log_level=None, log_sample=None, log_file=None, extensions=None, download_dir=None,
+                 invitation_queue_size=None, handover_socket=None, sockets=None,
+                 session_buffer=None, buffer_policy=None, memory_budget=None, transport=None,
+                 clock=None, timers=None, profile_dir=None, accept_files=None, rng=None):
+        # Settings: constructor argument, then $SIMP_<NAME>, then the protocol default
+        self.host = env_setting('HOST', host, '0.0.0.0', str)
+        # The client port takes commands such as sendfile, it is only reachable from other hosts on request
+        self.client_host = env_setting('CLIENT_HOST', client_host, '127.0.0.1', str)
+        self.timeout = env_setting('TIMEOUT', timeout, TIMEOUT, float)
+        self.handshake_timeout = env_setting('HANDSHAKE_TIMEOUT', handshake_timeout, HANDSHAKE_TIMEOUT, float)
+        self.invitation_ttl = env_setting('INVITATION_TTL', invitation_ttl, INVITATION_TTL, float)
+        self.invitation_queue_size = env_setting('INVITATION_QUEUE_SIZE', invitation_queue_size, INVITATION_QUEUE_SIZE)
+        # A keepalive_interval of 0 disables keepalives
+        self.keepalive_interval = env_setting('KEEPALIVE_INTERVAL', keepalive_interval, KEEPALIVE_INTERVAL, float)
+        self.keepalive_probes = env_setting('KEEPALIVE_PROBES', keepalive_probes, KEEPALIVE_PROBES)
+        self.send_queue_size = env_setting('SEND_QUEUE_SIZE', send_queue_size, SEND_QUEUE_SIZE)
+        self.session_buffer = env_setting('SESSION_BUFFER', session_buffer, SESSION_BUFFER)
+        self.buffer_policy = env_setting('BUFFER_POLICY', buffer_policy, BUFFER_POLICY, str)
+        # A MemoryBudget instance can be shared by several daemons in one process
+        memory_budget = env_setting('MEMORY_BUDGET', memory_budget, MEMORY_BUDGET)
+        self.budget = memory_budget if isinstance(memory_budget, MemoryBudget) else MemoryBudget(memory_budget)
+        self.source_rate = env_setting('SOURCE_RATE', source_rate, SOURCE_RATE, float)
+        self.global_rate = env_setting('GLOBAL_RATE', global_rate, GLOBAL_RATE, float)
+        self.rate_table_size = env_setting('RATE_TABLE_SIZE', rate_table_size, RATE_TABLE_SIZE)
+        self.dispatch_queue_size = env_setting('DISPATCH_QUEUE_SIZE', dispatch_queue_size, DISPATCH_QUEUE_SIZE)
+        # Header extensions offered to and accepted from peers, '' for none
+        extensions = env_setting('EXTENSIONS', extensions, ",".join(SUPPORTED_EXTENSIONS), str)
+        self.extensions = {ext for ext in extensions.split(",") if ext in SUPPORTED_EXTENSIONS}
+        # Where files received from the partner are written
+        self.download_dir = env_setting('DOWNLOAD_DIR', download_dir, '.', str)
+        # Files offered by the partner are written there without asking, so this is opt-in
+        self.accept_files = env_setting('ACCEPT_FILES', accept_files, False, lambda v: v not in ('0', 'no', 'false'))
+        # Where profiling results are written, under names the daemon picks
+        self.profile_dir = env_setting('PROFILE_DIR', profile_dir, '.', str)
+        log_file = env_setting('LOG_FILE', log_file, None, str)
+        # JSON-lines event log on stderr (or a file, closed by stop()), stdout stays for the READY line
+        self.log_stream = open(log_file, 'a') if log_file else None
+        self.log = EventLog(self.log_stream,
+                            env_setting('LOG_LEVEL', log_level, 'info', str),
+                            env_setting('LOG_SAMPLE', log_sample, 1.0, float))
         self.username = None
         self.in_chat = False
         self.chat_partner = None
         self.chat_partner_username = None
+        self.session_id = 0
+        self.session_extensions = set()
+        # Compact headers: our session ID, and the table resolving the partner's to its username
+        self.local_sid = None
+        self.session_table = {}
         self.seq_num = 0
         self.expected_seq = 0
-        self.pending_invitation = None
+        # Pending invitations by inviter address, oldest first
+        self.invitations = OrderedDict()
+        self.invitation_lock = threading.RLock()
+        # Our outgoing handshake, see initiate_chat()
+        self.connecting = None
+        self.unacked = None
+        # Outgoing messages waiting for their turn, in a buffer allocated once for all sessions
+        self.send_queue = RingBuffer(self.session_buffer, self.send_queue_size, self.buffer_policy,
+                                     self.budget, on_drop=self.message_dropped)
+        self.send_lock = threading.RLock()
+        self.send_blocked = False
+        self.next_msg_id = 0
+        self.keepalive_timer = None
+        self.last_heard = 0.0
+        self.missed_probes = 0
+        # A simulation passes its virtual clock, timers and seeded random numbers, see simp_sim.py
+        self.clock = clock or time.monotonic
+        self.rng = rng or random.Random()
+        # For one-way latency, only meaningful between synchronized hosts; all share a virtual clock
+        self.wallclock = clock or time.time
+        self.ack_rtt = LatencyStats()
+        self.one_way_latency = LatencyStats()
+        self.connect_latency = LatencyStats()  # SYN to SYN+ACK, retransmissions included
+        self.timers = timers or TimerWheel(clock=self.clock, on_error=self.callback_failed)
+        # Flood protection for everything but the chat partner
+        self.limiter = RateLimiter(self.source_rate, self.global_rate, self.rate_table_size, clock=self.clock)
+        self.cookies = SynCookies(COOKIE_LIFETIME)
+        self.counters = {'syn_cookies_sent': 0, 'syn_cookies_valid': 0, 'syn_cookies_invalid': 0, 'retransmits': 0,
+                         'delivered': 0, 'one_way_skewed': 0, 'syn_retransmits': 0, 'syn_ack_retransmits': 0,
+                         'final_acks_resent': 0, 'connect_timeouts': 0}
+        # Control datagrams are handled ahead of queued chat traffic
+        self.dispatcher = PriorityDispatcher(self.handle_daemon_message, self.dispatch_queue_size, CONTROL_BURST,
+                                             budget=self.budget, on_error=self.callback_failed)
+        # Session state is owned by the dispatcher worker: timers and client
+        # commands run there as tasks, never concurrently with a handler
+        self.session_timers = WorkerTimers(self.timers, self.dispatcher)
+        # File transfers with the chat partner, chunks are sent straight from the mmapped file
+        self.transfers = TransferEngine(self.send_parts, self.notify_client, self.session_timers, self.download_dir,
+                                        timeout=self.timeout, send_many=self.send_many,
+                                        post=self.dispatcher.submit, accept=self.accept_files, rng=self.rng)
+        # Runtime profiling, switched on and off with the 'profile' and 'timing' commands
+        self.profiler = Profiler(self.profile_dir)
+        self.handler_timers = HandlerTimers(self, ('handle_daemon_message', 'handle_chat_message',
+                                                   'send_chat_message', 'handle_client_message'))
         self.client_socket = None
-        self.daemon_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.daemon_socket.bind((self.host, DAEMON_PORT))
-        self.client_daemon_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.client_daemon_socket.bind((self.host, CLIENT_DAEMON_PORT))
+        # All datagrams go through transports, see simp_transport.py: 'udp',
+        # 'batched', or a factory with bind() such as a MemoryNetwork
+        transport = env_setting('TRANSPORT', transport, 'udp', str)
+        factory = TRANSPORTS[transport] if isinstance(transport, str) else transport
+        if sockets:
+            # Bound sockets inherited from the daemon we take over from, see simp_restart.py
+            self.daemon_transport, self.client_transport = (factory(sock) for sock in sockets)
+        else:
+            self.daemon_transport = factory.bind(self.host, env_setting('DAEMON_PORT', daemon_port, DAEMON_PORT))
+            # Room for bursts of client commands while the daemon is busy
+            self.client_transport = factory.bind(self.client_host,
+                                                 env_setting('CLIENT_PORT', client_port, CLIENT_DAEMON_PORT),
+                                                 CLIENT_RCVBUF)
+        # Port 0 binds an ephemeral port, report the one actually chosen
+        self.daemon_port = self.daemon_transport.local_address()[1]
+        self.client_port = self.client_transport.local_address()[1]
+        self.listeners = []
+        # A successor can take over our sockets and sessions through this Unix socket
+        handover_socket = env_setting('HANDOVER_SOCKET', handover_socket, None, str)
+        if handover_socket and not hasattr(self.daemon_transport, 'sock'):
+            raise ValueError("A hot restart hands over sockets, it needs the 'udp' or 'batched' transport")
+        self.handover = HandoverServer(handover_socket, self.hand_over) if handover_socket else None
         self.running = True
+        self.ready = threading.Event()
+        self.stopped = threading.Event()
         self.auto_accept = False  # For testing: auto-accept invitations
 
     def start(self):
-        """Start the daemon with both listeners."""
+        """Start the timer wheel and both listeners, return once they are running.
+        
+        The sockets are bound in the constructor, so datagrams that arrive
+        before start() are queued by the kernel and not lost.
+        """
         print(f"SIMP Daemon started on {self.host}")
-        print(f"Listening for SIMP on port {DAEMON_PORT}")
-        print(f"Listening for clients on port {CLIENT_DAEMON_PORT}")
+        print(f"Listening for SIMP on port {self.daemon_port}")
+        print(f"Listening for clients on {self.client_host} port {self.client_port}")
         
-        # Start daemon-to-daemon listener
-        daemon_thread = threading.Thread(target=self.listen_daemon, daemon=True)
-        daemon_thread.start()
+        self.log.start()
+        # Retransmissions and timeouts are driven by the timer wheel
+        self.timers.start()
+        self.dispatcher.start()
         
-        # Start client-daemon listener in main thread
-        self.listen_client()
+        self.start_listeners()
+        if self.handover:
+            self.handover.start()
+        self.ready.set()
+
+    def serve_forever(self):
+        """Start the daemon and block until stop() is called."""
+        self.start()
+        self.stopped.wait()
+
+    def ready_line(self) -> str:
+        """Readiness announcement with the ports actually bound."""
+        return f"READY daemon_port={self.daemon_port} client_port={self.client_port}"
+
+    def start_listeners(self):
+        """Start the daemon-to-daemon and client-daemon listeners."""
+        self.listeners = [threading.Thread(target=self.listen_daemon, daemon=True),
+                          threading.Thread(target=self.listen_client, daemon=True)]
+        for thread in self.listeners:
+            thread.start()
+
+    def stop_listeners(self):
+        """Make both listeners return after what they already received, leaving the transports open."""
+        for transport in (self.daemon_transport, self.client_transport):
+            transport.interrupt()
+        for thread in self.listeners:
+            thread.join()
 
     def listen_daemon(self):
         """Listen for incoming SIMP messages from other daemons."""
         while self.running:
             try:
-                data, addr = self.daemon_socket.recvfrom(4096)
-                threading.Thread(target=self.handle_daemon_message, args=(data, addr), daemon=True).start()
+                item = self.daemon_transport.receive()
+                if not self.running or item is None:
+                    break
+                data, addr = item
+                # Drop floods before they take up queue space
+                if addr != self.chat_partner and not self.limiter.allow(addr):
+                    continue
+                self.dispatcher.put(data, addr)
             except Exception as e:
                 if self.running:
-                    print(f"Error in daemon listener: {e}")
+                    self.log.error('listener_error', error=str(e))
 
     def listen_client(self):
         """Listen for messages from local client."""
         while self.running:
             try:
-                data, addr = self.client_daemon_socket.recvfrom(4096)
-                self.client_socket = addr
-                self.handle_client_message(data.decode('ascii'), addr)
+                item = self.client_transport.receive()
+                if not self.running or item is None:
+                    break
+                data, addr = item
+                self.dispatcher.submit(self.handle_client_message, data.decode('ascii'), addr)
             except Exception as e:
                 if self.running:
-                    print(f"Error in client listener: {e}")
+                    self.log.error('client_listener_error', error=str(e))
+
+    def callback_failed(self, error: Exception, fn):
+        """A timer callback or dispatched task raised: log it rather than printing from that thread."""
+        self.log.error('callback_error', callback=getattr(fn, '__qualname__', repr(fn)), error=str(error))
 
     def handle_daemon_message(self, data: bytes, addr: tuple):
         """Handle incoming SIMP protocol messages."""
+        if self.profiler.pending:
+            self.profiler.sync()
         try:
-            msg = parse_simp_message(data)
+            msg = parse_simp_message(data, self.session_table)
+            if self.log.enabled('debug'):
+                self.log.debug('recv', peer=fmt_addr(addr), type=msg['type'], op=msg['operation'], seq=msg['seq'])
+            
+            if self.in_chat and addr == self.chat_partner:
+                # Any datagram from the partner proves it is alive
+                self.last_heard = self.clock()
+                self.missed_probes = 0
             
             if msg['type'] == MessageType.CONTROL.value:
                 if msg['operation'] == OperationType.SYN.value:
@@ -75,106 +253,309 @@ class SimpDaemon:
                     self.handle_fin(msg, addr)
                 elif msg['operation'] == OperationType.ERR.value:
                     self.handle_error(msg, addr)
+                elif msg['operation'] == OperationType.PING.value:
+                    self.handle_ping(msg, addr)
+                elif msg['operation'] == OperationType.RETRY.value:
+                    self.handle_retry(msg, addr)
                     
             elif msg['type'] == MessageType.CHAT.value:
                 self.handle_chat_message(msg, addr)
                 
+            elif msg['type'] == MessageType.FILE.value:
+                if self.in_chat and addr == self.chat_partner and 'files' in self.session_extensions:
+                    self.transfers.handle(msg)
+                
         except Exception as e:
-            print(f"Error handling daemon message: {e}")
+            self.log.error('handler_error', peer=fmt_addr(addr), error=str(e))
 
     def handle_syn(self, msg: dict, addr: tuple):
         """Handle SYN (connection request)."""
+        if self.in_chat and addr == self.chat_partner:
+            # Retransmitted SYN of the chat we already have, nothing to do
+            return
         if self.in_chat:
-            # Already in chat, send error
-            error_msg = build_simp_message(
-                MessageType.CONTROL,
-                OperationType.ERR.value,
-                0,
-                self.username or "unknown",
-                "User already in another chat"
-            )
-            self.daemon_socket.sendto(error_msg, addr)
-            fin_msg = build_simp_message(
-                MessageType.CONTROL,
-                OperationType.FIN.value,
-                0,
-                self.username or "unknown"
-            )
-            self.daemon_socket.sendto(fin_msg, addr)
-        else:
-            # Store invitation
-            self.pending_invitation = {
-                'addr': addr,
-                'username': msg['username'],
-                'seq': msg['seq']
-            }
-            
-            # Notify client if connected
-            if self.client_socket:
-                notification = build_client_daemon_message(
-                    'invitation',
-                    username=msg['username'],
-                    ip=addr[0]
-                )
-                self.client_daemon_socket.sendto(notification.encode('ascii'), self.client_socket)
+            self.refuse_syn(addr, msg['seq'], "User already in another chat")
+            return
+        with self.invitation_lock:
+            inv = self.invitations.get(addr)
+            cookie, msg['payload'] = split_syn_cookie(msg['payload'])
+            # Every SYN has seq 0, but a retransmission repeats the payload: its
+            # options (with a fresh sid each handshake) and the first message
+            duplicate = inv is not None and inv.get('syn') == msg['payload']
+            if not duplicate and not self.check_syn_cookie(cookie, msg, addr):
+                return
+            if not duplicate:
+                if inv:
+                    # A new handshake from the same peer replaces its old invitation
+                    self.cancel_invitation_timers(inv)
+                    del self.invitations[addr]
+                elif len(self.invitations) >= self.invitation_queue_size:
+                    self.refuse_syn(addr, msg['seq'], "Too many pending invitations")
+                    return
+                # Store invitation, the rest of a SYN payload is the zero-RTT first message
+                options, early_data = split_syn_options(msg['payload'])
+                offered = set(options.get('ext', '').split(','))
+                inv = {
+                    'addr': addr,
+                    'username': msg['username'],
+                    'seq': msg['seq'],
+                    'syn': msg['payload'],
+                    'early_data': early_data or None,
+                    'extensions': offered & self.extensions,
+                    'accepted': False
+                }
+                self.bind_session_ids(inv, options)
+                inv['timer'] = self.session_timers.schedule(self.invitation_ttl, self.expire_invitation, inv)
+                self.invitations[addr] = inv
+                
+                # Notify client if connected
+                self.notify_client('invitation', username=msg['username'], ip=addr[0], port=addr[1])
             
             # For testing: if no client is connected, auto-accept
             # This allows testing the protocol without a full client
             if not self.client_socket or self.auto_accept:
-                print(f"Auto-accepting invitation from {msg['username']} at {addr}")
-                syn_ack_msg = build_simp_message(
-                    MessageType.CONTROL,
-                    OperationType.SYN.value | OperationType.ACK.value,
-                    msg['seq'],
-                    self.username or "daemon"
-                )
-                self.daemon_socket.sendto(syn_ack_msg, addr)
+                if not duplicate:
+                    self.log.info('auto_accept', peer=fmt_addr(addr), username=msg['username'])
+                    self.deliver_early_data(inv)
+                self.send_syn_ack(inv)
+            elif duplicate and inv['accepted']:
+                # Our SYN+ACK was lost
+                self.send_syn_ack(inv)
 
-    def handle_syn_ack(self, msg: dict, addr: tuple):
-        """Handle SYN-ACK (connection accepted)."""
-        # Send final ACK to complete handshake
-        ack_msg = build_simp_message(
+    def refuse_syn(self, addr: tuple, seq: int, reason: str):
+        """Turn down a handshake with ERR and FIN, so the inviter does not wait for its timeout."""
+        error_msg = build_simp_message(
             MessageType.CONTROL,
-            OperationType.ACK.value,
+            OperationType.ERR.value,
+            seq,
+            self.username or "unknown",
+            reason
+        )
+        self.daemon_transport.send(error_msg, addr)
+        self.send_fin(addr, seq)
+
+    def send_syn_ack(self, inv: dict):
+        """Accept an invitation, listing the header extensions we agree to."""
+        options = {'ext': ",".join(sorted(inv['extensions']))} if inv['extensions'] else {}
+        if inv['local_sid'] is not None:
+            options['sid'] = f"{inv['local_sid']:04x}"
+        syn_ack_msg = build_simp_message(
+            MessageType.CONTROL,
+            OperationType.SYN.value | OperationType.ACK.value,
+            inv['seq'],
+            self.username or "daemon",
+            add_syn_options(options)
+        )
+        inv['accepted'] = True
+        self.daemon_transport.send(syn_ack_msg, inv['addr'])
+        # Resend with backoff until the final ACK arrives, the invitation TTL ends the attempts
+        inv['synack_attempts'] = inv.get('synack_attempts', 0) + 1
+        self.session_timers.cancel(inv.get('synack_timer'))
+        inv['synack_timer'] = None
+        if inv['synack_attempts'] <= MAX_RETRIES:
+            inv['synack_timer'] = self.session_timers.schedule(self.timeout * 2 ** (inv['synack_attempts'] - 1),
+                                                       self.retransmit_syn_ack, inv)
+
+    def retransmit_syn_ack(self, inv: dict):
+        """No final ACK for our SYN+ACK yet, send it again."""
+        with self.invitation_lock:
+            if self.invitations.get(inv['addr']) is not inv:
+                return
+            self.counters['syn_ack_retransmits'] += 1
+            self.log.info('syn_ack_retransmit', peer=fmt_addr(inv['addr']), attempt=inv['synack_attempts'])
+            self.send_syn_ack(inv)
+
+    def refuse_invitations(self):
+        """A session is opening: turn down every pending invitation instead of letting it expire."""
+        with self.invitation_lock:
+            others = list(self.invitations.values())
+            self.invitations.clear()
+        for other in others:
+            self.cancel_invitation_timers(other)
+            self.refuse_syn(other['addr'], other['seq'], "User already in another chat")
+
+    def cancel_invitation_timers(self, inv: dict):
+        """Stop the expiry and SYN+ACK retransmission timers of an invitation leaving the queue."""
+        self.session_timers.cancel(inv['timer'])
+        self.session_timers.cancel(inv.get('synack_timer'))
+
+    def bind_session_ids(self, conn: dict, options: dict):
+        """Pick our session ID for a handshake, and take the peer's from its SYN or SYN+ACK options.
+
+        'compact' stays negotiated only if the peer sent an ID.
+        """
+        conn.setdefault('local_sid', None)
+        conn['peer_sid'] = None
+        if 'compact' in conn['extensions'] and 'sid' in options:
+            if conn['local_sid'] is None:
+                conn['local_sid'] = self.rng.getrandbits(16)
+            conn['peer_sid'] = int(options['sid'], 16)
+        else:
+            conn['extensions'].discard('compact')
+
+    def check_syn_cookie(self, cookie: str, msg: dict, addr: tuple) -> bool:
+        """Under load, only SYNs that prove their source address may create an invitation.
+        
+        Others get a stateless RETRY carrying a cookie, which a genuine
+        peer echoes in its next SYN. Spoofed SYNs never see the cookie and
+        so cannot evict the pending invitation.
+        """
+        if cookie is not None:
+            if self.cookies.check(cookie, addr, msg['username']):
+                self.counters['syn_cookies_valid'] += 1
+                return True
+            self.counters['syn_cookies_invalid'] += 1
+        elif not self.limiter.under_load():
+            return True
+        retry_msg = build_simp_message(
+            MessageType.CONTROL,
+            OperationType.RETRY.value,
             msg['seq'],
+            self.username or "daemon",
+            self.cookies.make(addr, msg['username'])
+        )
+        self.daemon_transport.send(retry_msg, addr)
+        self.counters['syn_cookies_sent'] += 1
+        return False
+
+    def expire_invitation(self, inv: dict):
+        """Drop an invitation that was not answered in time and tell the inviter with a FIN."""
+        with self.invitation_lock:
+            if self.invitations.get(inv['addr']) is not inv:
+                return
+            del self.invitations[inv['addr']]
+            self.cancel_invitation_timers(inv)
+        self.log.info('invitation_expired', peer=fmt_addr(inv['addr']), username=inv['username'])
+        self.send_fin(inv['addr'], inv['seq'])
+        self.notify_client('invitation_expired', username=inv['username'], ip=inv['addr'][0], port=inv['addr'][1])
+
+    def send_fin(self, addr: tuple, seq: int = 0):
+        """FIN outside a session: declined, expired or refused invitations."""
+        fin_msg = build_simp_message(
+            MessageType.CONTROL,
+            OperationType.FIN.value,
+            seq,
             self.username or "daemon"
         )
-        self.daemon_socket.sendto(ack_msg, addr)
+        self.daemon_transport.send(fin_msg, addr)
+
+    def find_invitation(self, ip: str = None, port: str = None) -> dict:
+        """The pending invitation from ip (and port), or the oldest one if none is given."""
+        with self.invitation_lock:
+            for addr, inv in self.invitations.items():
+                if ip in (None, addr[0]) and port in (None, str(addr[1])):
+                    return inv
+        return None
+
+    def deliver_early_data(self, inv: dict):
+        """Forward the zero-RTT message of an invitation to the client, once."""
+        if not inv or not inv.get('early_data'):
+            return
+        self.notify_client('message', username=inv['username'], text=inv['early_data'])
+        inv['early_data'] = None
+
+    def handle_syn_ack(self, msg: dict, addr: tuple):
+        """Handle SYN-ACK (connection accepted)."""
+        if self.in_chat and addr == self.chat_partner:
+            # The partner resent its SYN+ACK, so our final ACK was lost
+            self.counters['final_acks_resent'] += 1
+            self.send_final_ack(addr, msg['seq'])
+            return
+        if self.in_chat:
+            # Too late, we are chatting with someone else: the peer must not wait for our final ACK
+            self.send_fin(addr, msg['seq'])
+            return
+        conn = self.connecting
+        if not conn or conn['addr'] != addr:
+            # Late or unsolicited, we are not waiting for this peer
+            return
+        self.end_connect()
+        self.refuse_invitations()
+        self.connect_latency.add(self.clock() - conn['started'])
+        self.log.debug('handshake', peer=fmt_addr(addr), attempts=conn['attempts'],
+                       latency_ms=round((self.clock() - conn['started']) * 1000, 3))
+        options, _ = split_syn_options(msg['payload'])
+        accepted = {'extensions': set(options.get('ext', '').split(',')) & self.extensions,
+                    'local_sid': conn['local_sid']}
+        self.bind_session_ids(accepted, options)
+        
+        # Send final ACK to complete handshake
+        self.send_final_ack(addr, msg['seq'])
         
         # Connection established
-        self.in_chat = True
-        self.chat_partner = addr
-        self.chat_partner_username = msg['username']
-        self.seq_num = 0
-        self.expected_seq = 0
+        self.open_session(addr, msg['username'], accepted['extensions'], accepted['local_sid'], accepted['peer_sid'])
         
         # Notify client
-        if self.client_socket:
-            notification = build_client_daemon_message('connected', username=msg['username'])
-            self.client_daemon_socket.sendto(notification.encode('ascii'), self.client_socket)
+        self.notify_client('connected', username=msg['username'])
+
+    def send_final_ack(self, addr: tuple, seq: int):
+        """The ACK completing a handshake, answering the peer's SYN+ACK."""
+        ack_msg = build_simp_message(
+            MessageType.CONTROL,
+            OperationType.ACK.value,
+            seq,
+            self.username or "daemon"
+        )
+        self.daemon_transport.send(ack_msg, addr)
 
     def handle_ack(self, msg: dict, addr: tuple):
         """Handle ACK."""
-        if not self.in_chat and self.pending_invitation:
+        inv = self.invitations.get(addr)
+        if not self.in_chat and inv and inv['accepted']:
             # This is the final ACK of handshake (we sent SYN-ACK)
-            self.in_chat = True
-            self.chat_partner = addr
-            self.chat_partner_username = msg['username']
-            self.seq_num = 0
-            self.expected_seq = 0
-            self.pending_invitation = None
+            with self.invitation_lock:
+                if self.invitations.pop(addr, None) is not inv:
+                    return
+                self.cancel_invitation_timers(inv)
+            self.refuse_invitations()
+            # Withdraw our own invitation, its SYN+ACK may still be on the way
+            conn = self.end_connect()
+            if conn:
+                self.send_fin(conn['addr'])
+            self.open_session(addr, msg['username'], inv['extensions'], inv['local_sid'], inv['peer_sid'])
             
             # Notify client
-            if self.client_socket:
-                notification = build_client_daemon_message('connected', username=msg['username'])
-                self.client_daemon_socket.sendto(notification.encode('ascii'), self.client_socket)
-        else:
+            self.notify_client('connected', username=msg['username'])
+            
+            # Zero-RTT: the first message rode on the SYN, hand it over now
+            self.deliver_early_data(inv)
+        elif self.in_chat and addr == self.chat_partner:
             # ACK for a chat message - toggle sequence number
-            if msg['seq'] == self.seq_num:
-                self.seq_num = 1 - self.seq_num
+            with self.send_lock:
+                unacked = self.unacked
+                if unacked and msg['seq'] == unacked['seq']:
+                    if unacked['msg_id'] is not None and msg['payload'] and msg['payload'] != f"{unacked['msg_id']:08x}":
+                        return  # a late ACK for an earlier message with the same seq
+                    self.session_timers.cancel(unacked['timer'])
+                    self.unacked = None
+                    self.message_delivered(unacked)
+                    self.seq_num = 1 - self.seq_num
+                    self.transmit_next()
+
+    def message_delivered(self, unacked: dict):
+        """Account the ACK RTT of a message and send the client its receipt."""
+        now = self.clock()
+        self.counters['delivered'] += 1
+        if unacked['attempts'] == 1:
+            # Only unambiguous samples: a retransmitted message may be ACKed for either copy
+            self.ack_rtt.add(now - unacked['sent_at'])
+            self.log.debug('ack', session=self.session_id, peer=fmt_addr(self.chat_partner), seq=unacked['seq'],
+                           latency_ms=round((now - unacked['sent_at']) * 1000, 3))
+        if unacked['client_id'] is not None:
+            self.notify_client('delivered', id=unacked['client_id'], attempts=unacked['attempts'],
+                               rtt_ms=round((now - unacked['first_sent']) * 1000, 3))
 
     def handle_fin(self, msg: dict, addr: tuple):
-        """Handle FIN (connection termination)."""
+        """Handle FIN: the partner ends the chat, an invitee declines or an inviter gives up."""
+        if self.in_chat and addr == self.chat_partner:
+            reason = None
+        elif self.connecting and addr == self.connecting['addr']:
+            reason = 'declined'
+        elif addr in self.invitations:
+            reason = 'withdrawn'
+        else:
+            return
+        
         # Send ACK
         ack_msg = build_simp_message(
             MessageType.CONTROL,
@@ -182,190 +563,738 @@ class SimpDaemon:
             msg['seq'],
             self.username or "unknown"
         )
-        self.daemon_socket.sendto(ack_msg, addr)
+        self.daemon_transport.send(ack_msg, addr)
+        
+        if reason == 'withdrawn':
+            with self.invitation_lock:
+                inv = self.invitations.pop(addr, None)
+            if inv:
+                self.cancel_invitation_timers(inv)
+                self.notify_client('invitation_expired', username=inv['username'], ip=addr[0], port=addr[1])
+            return
+        
+        if reason == 'declined':
+            # A FIN in reply to our SYN means the invitation was declined
+            self.end_connect()
+            self.notify_client('disconnected', reason=reason)
+            return
         
         # Clear chat state
-        self.in_chat = False
-        self.chat_partner = None
-        self.chat_partner_username = None
-        self.seq_num = 0
-        self.expected_seq = 0
+        self.close_session()
         
         # Notify client
-        if self.client_socket:
-            notification = build_client_daemon_message('disconnected')
-            self.client_daemon_socket.sendto(notification.encode('ascii'), self.client_socket)
+        self.notify_client('disconnected')
+
+    def handle_ping(self, msg: dict, addr: tuple):
+        """Answer a keepalive probe from the chat partner."""
+        if not self.in_chat or addr != self.chat_partner:
+            return
+        pong_msg = self.session_message(
+            MessageType.CONTROL,
+            OperationType.PING.value | OperationType.ACK.value,
+            msg['seq']
+        )
+        self.daemon_transport.send(pong_msg, addr)
 
     def handle_error(self, msg: dict, addr: tuple):
-        """Handle ERR message."""
-        print(f"Error from {addr}: {msg['payload']}")
-        if self.client_socket:
-            notification = build_client_daemon_message('error', message=msg['payload'])
-            self.client_daemon_socket.sendto(notification.encode('ascii'), self.client_socket)
+        """Handle ERR message: a refused handshake, or an error from the partner."""
+        self.log.warning('peer_error', peer=fmt_addr(addr), message=msg['payload'])
+        if self.connecting and addr == self.connecting['addr']:
+            self.end_connect()
+        elif not (self.in_chat and addr == self.chat_partner):
+            return
+        self.notify_client('error', message=msg['payload'])
 
     def handle_chat_message(self, msg: dict, addr: tuple):
         """Handle incoming chat message."""
         if not self.in_chat or addr != self.chat_partner:
             return
         
-        # Check sequence number
+        receipt = 'receipts' in self.session_extensions
+        text = msg['payload']
+        if receipt:
+            msg_id, sent_us, text = split_receipt(text)
+        
+        # Send ACK, also for a retransmission whose first ACK was lost
+        ack_msg = self.session_message(
+            MessageType.CONTROL,
+            OperationType.ACK.value,
+            msg['seq'],
+            f"{msg_id:08x}" if receipt else ""
+        )
+        self.daemon_transport.send(ack_msg, addr)
+        
+        # Check sequence number, duplicates are not delivered again
         if msg['seq'] == self.expected_seq:
-            # Send ACK
-            ack_msg = build_simp_message(
-                MessageType.CONTROL,
-                OperationType.ACK.value,
-                msg['seq'],
-                self.username or "daemon"
-            )
-            self.daemon_socket.sendto(ack_msg, addr)
-            
             # Toggle expected sequence
             self.expected_seq = 1 - self.expected_seq
             
+            if receipt:
+                self.record_one_way_latency(sent_us)
+            
             # Forward to client
-            if self.client_socket:
-                notification = build_client_daemon_message(
-                    'message',
-                    username=msg['username'],
-                    text=msg['payload']
-                )
-                self.client_daemon_socket.sendto(notification.encode('ascii'), self.client_socket)
+            self.notify_client('message', username=msg['username'], text=text)
+
+    def record_one_way_latency(self, sent_us: int):
+        """Sender-to-receiver latency from the sender's wall clock, if the clocks look synchronized."""
+        latency = self.wallclock() - sent_us / 1e6
+        if 0 <= latency < MAX_ONE_WAY_LATENCY:
+            self.one_way_latency.add(latency)
+        else:
+            self.counters['one_way_skewed'] += 1
+
+    def send_parts(self, parts: list, addr: tuple):
+        """Send one datagram gathered from several buffers, without joining them first."""
+        self.daemon_transport.send_parts(parts, addr)
+
+    def send_many(self, datagrams: list, addr: tuple):
+        """Send several datagrams, each a list of buffers, in as few system calls as the transport can."""
+        self.daemon_transport.send_many(datagrams, addr)
+
+    def session_message(self, msg_type: MessageType, operation: int, seq: int, payload="") -> bytes:
+        """A datagram for the chat partner, with the compact header if the session negotiated it."""
+        if self.local_sid is not None:
+            return build_compact_message(msg_type, operation, seq, self.local_sid, payload)
+        return build_simp_message(msg_type, operation, seq, self.username or "daemon", payload)
+
+    def notify_client(self, cmd: str, **kwargs):
+        """Send a notification to the local client, if one is connected."""
+        if not self.client_socket:
+            return
+        notification = build_client_daemon_message(cmd, **kwargs)
+        self.client_transport.send(notification.encode('ascii'), self.client_socket)
 
     def handle_client_message(self, msg: str, addr: tuple):
         """Handle messages from local client."""
+        if self.profiler.pending:
+            self.profiler.sync()
         try:
             parsed = parse_client_daemon_message(msg)
             cmd = parsed['command']
             
-            if cmd == 'connect':
+            if cmd in REGISTERED_ONLY and addr != self.client_socket:
+                # Anyone who can reach the client port could otherwise profile the daemon
+                self.log.warning('client_refused', source=fmt_addr(addr), command=cmd)
+                response = build_client_daemon_message('error', message="Only the registered client may do that")
+                self.client_transport.send(response.encode('ascii'), addr)
+                
+            elif cmd == 'connect':
+                # The sender becomes our client: notifications go there from now on
+                self.client_socket = addr
                 self.username = parsed.get('username', 'anonymous')
                 response = build_client_daemon_message('ok')
-                self.client_daemon_socket.sendto(response.encode('ascii'), addr)
+                self.client_transport.send(response.encode('ascii'), addr)
                 
             elif cmd == 'invite':
                 target_ip = parsed['ip']
                 target_port = int(parsed.get('port', DAEMON_PORT))
-                self.initiate_chat(target_ip, target_port)
+                self.initiate_chat(target_ip, target_port, parsed.get('text'))
                 
             elif cmd == 'accept':
-                self.accept_invitation()
+                self.accept_invitation(parsed.get('ip'), parsed.get('port'))
                 
             elif cmd == 'decline':
-                self.decline_invitation()
+                self.decline_invitation(parsed.get('ip'), parsed.get('port'))
                 
             elif cmd == 'send':
                 text = parsed['text']
-                self.send_chat_message(text)
+                self.send_chat_message(text, parsed.get('id'))
+                
+            elif cmd == 'sendfile':
+                self.send_file(parsed['path'])
+                
+            elif cmd == 'stats':
+                response = build_client_daemon_message('stats', **self.stats())
+                self.client_transport.send(response.encode('ascii'), addr)
+                
+            elif cmd == 'profile':
+                self.handle_profile_command(parsed, addr)
+                
+            elif cmd == 'timing':
+                self.set_handler_timing(parsed.get('action') == 'on')
+                response = build_client_daemon_message('ok')
+                self.client_transport.send(response.encode('ascii'), addr)
                 
             elif cmd == 'quit':
                 self.terminate_chat()
                 response = build_client_daemon_message('ok')
-                self.client_daemon_socket.sendto(response.encode('ascii'), addr)
+                self.client_transport.send(response.encode('ascii'), addr)
                 
         except Exception as e:
-            print(f"Error handling client message: {e}")
+            self.log.error('client_error', error=str(e))
+
+    def handle_profile_command(self, parsed: dict, addr: tuple):
+        """Start or stop a profiling session and tell the requester how it went."""
+        try:
+            if parsed.get('action') == 'start':
+                mode = parsed.get('mode', 'cprofile')
+                self.profiler.start(mode, float(parsed.get('interval', 0.005)))
+                reply = {'status': 'started', 'mode': mode}
+            else:
+                reply = {'status': 'stopped'}
+                reply.update(self.profiler.stop())
+            self.log.info('profile', **reply)
+        except (RuntimeError, ValueError, OSError) as e:
+            reply = {'status': 'error', 'message': str(e)}
+        response = build_client_daemon_message('profile', **reply)
+        self.client_transport.send(response.encode('ascii'), addr)
+
+    def set_handler_timing(self, on: bool):
+        """Switch the per-handler timing counters on or off."""
+        if on:
+            self.handler_timers.enable()
+        else:
+            self.handler_timers.disable()
+        # The dispatcher holds a bound method, hand it the (un)wrapped one
+        self.dispatcher.handler = self.handle_daemon_message
 
-    def initiate_chat(self, target_ip: str, target_port: int):
-        """Initiate a chat connection (send SYN)."""
+    def initiate_chat(self, target_ip: str, target_port: int, first_message: str = None):
+        """Initiate a chat connection (send SYN).
+        
+        If first_message is given it is carried as the SYN payload (zero-RTT),
+        so the peer can deliver it without waiting for the handshake.
+        """
+        addr = (socket.gethostbyname(target_ip), target_port)
+        # Offer our header extensions ahead of the zero-RTT first message
+        options = {'ext': ",".join(sorted(self.extensions))} if self.extensions else {}
+        local_sid = None
+        if 'compact' in self.extensions:
+            local_sid = self.rng.getrandbits(16)
+            options['sid'] = f"{local_sid:04x}"
+        payload = add_syn_options(options, first_message or "")
+        self.end_connect()
+        conn = {'addr': addr, 'payload': payload, 'retried': False, 'local_sid': local_sid,
+                'attempts': 0, 'started': self.clock(), 'timer': None}
+        # The SYN is resent with backoff, the handshake timeout is the overall deadline
+        conn['deadline'] = self.session_timers.schedule(self.handshake_timeout, self.connect_expired, conn)
+        self.connecting = conn
+        self.send_syn(conn)
+
+    def send_syn(self, conn: dict):
+        """Send the SYN of our handshake and arm its retransmission, doubling the wait each time."""
         syn_msg = build_simp_message(
             MessageType.CONTROL,
             OperationType.SYN.value,
             0,
-            self.username or "daemon"
+            self.username or "daemon",
+            conn['payload']
         )
-        self.daemon_socket.sendto(syn_msg, (target_ip, target_port))
+        self.daemon_transport.send(syn_msg, conn['addr'])
+        conn['attempts'] += 1
+        self.session_timers.cancel(conn['timer'])
+        conn['timer'] = None
+        if conn['attempts'] <= MAX_RETRIES:
+            conn['timer'] = self.session_timers.schedule(self.timeout * 2 ** (conn['attempts'] - 1), self.retransmit_syn, conn)
+
+    def retransmit_syn(self, conn: dict):
+        """No SYN+ACK yet: the SYN or the answer was lost, try again."""
+        if self.connecting is not conn:
+            return
+        self.counters['syn_retransmits'] += 1
+        self.log.info('syn_retransmit', peer=fmt_addr(conn['addr']), attempt=conn['attempts'])
+        self.send_syn(conn)
+
+    def handle_retry(self, msg: dict, addr: tuple):
+        """The peer is under load: repeat our SYN once, carrying its cookie."""
+        conn = self.connecting
+        if not conn or conn['addr'] != addr or conn['retried']:
+            return
+        conn['retried'] = True
+        # Retransmissions carry the cookie too
+        conn['payload'] = add_syn_cookie(msg['payload'], conn['payload'])
+        self.send_syn(conn)
+
+    def connect_expired(self, conn: dict):
+        """No SYN+ACK arrived before the handshake deadline."""
+        if self.connecting is not conn:
+            return
+        self.end_connect()
+        self.counters['connect_timeouts'] += 1
+        self.log.warning('connect_timeout', peer=fmt_addr(conn['addr']), attempts=conn['attempts'])
+        # Withdraw the invitation in case only the answers were lost
+        self.send_fin(conn['addr'])
+        if not self.in_chat:
+            self.notify_client('error', message="Connection timed out")
+
+    def end_connect(self) -> dict:
+        """Forget our outgoing handshake and stop its timers, returning it."""
+        conn, self.connecting = self.connecting, None
+        if conn:
+            self.session_timers.cancel(conn['timer'])
+            self.session_timers.cancel(conn['deadline'])
+        return conn
 
-    def accept_invitation(self):
-        """Accept a pending invitation."""
-        if not self.pending_invitation:
+    def accept_invitation(self, ip: str = None, port: str = None):
+        """Accept the invitation from ip (and port), or the oldest one."""
+        if self.in_chat:
+            self.notify_client('error', message="Already in a chat")
+            return
+        if self.connecting:
+            self.notify_client('error', message="Still waiting for an answer to our invitation")
+            return
+        inv = self.find_invitation(ip, port)
+        if not inv:
+            self.notify_client('error', message="No such invitation")
             return
         
-        inv = self.pending_invitation
-        syn_ack_msg = build_simp_message(
-            MessageType.CONTROL,
-            OperationType.SYN.value | OperationType.ACK.value,
-            inv['seq'],
-            self.username or "daemon"
-        )
-        self.daemon_socket.sendto(syn_ack_msg, inv['addr'])
+        self.send_syn_ack(inv)
 
-    def decline_invitation(self):
-        """Decline a pending invitation."""
-        if not self.pending_invitation:
+    def decline_invitation(self, ip: str = None, port: str = None):
+        """Decline the invitation from ip (and port), or the oldest one."""
+        inv = self.find_invitation(ip, port)
+        if not inv:
             return
         
-        inv = self.pending_invitation
-        fin_msg = build_simp_message(
-            MessageType.CONTROL,
-            OperationType.FIN.value,
-            inv['seq'],
-            self.username or "daemon"
-        )
-        self.daemon_socket.sendto(fin_msg, inv['addr'])
-        self.pending_invitation = None
+        with self.invitation_lock:
+            if self.invitations.pop(inv['addr'], None) is not inv:
+                return
+        self.cancel_invitation_timers(inv)
+        self.send_fin(inv['addr'], inv['seq'])
 
-    def send_chat_message(self, text: str):
-        """Send a chat message with stop-and-wait."""
+    def send_file(self, path: str):
+        """Offer a file to the chat partner, progress is reported with file_* notifications."""
         if not self.in_chat:
-            return
+            self.notify_client('error', message="Not in a chat")
+        elif 'files' not in self.session_extensions:
+            self.notify_client('error', message="Peer does not support file transfer")
+        else:
+            try:
+                self.transfers.offer(path)
+            except OSError as e:
+                self.notify_client('error', message=f"Cannot send {path}: {e.strerror}")
+
+    def send_chat_message(self, text: str, client_id: str = None) -> bool:
+        """Queue a chat message for stop-and-wait delivery.
         
-        chat_msg = build_simp_message(
+        Returns False and tells the client 'busy' (with the client_id) if the
+        send queue is full; a 'credit' notification follows once the queue
+        has drained. With
+        the drop_oldest buffer policy the oldest queued message makes room
+        instead, with spill it waits on disk. With a client_id the client
+        gets a 'delivered' notification once the partner has ACKed the
+        message, or 'dropped' if it was dropped.
+        """
+        with self.send_lock:
+            if not self.in_chat:
+                return False
+            if not self.send_queue.append(pack_outgoing(text, client_id)):
+                self.send_blocked = True
+                if client_id is None:
+                    self.notify_client('busy', queued=len(self.send_queue))
+                else:
+                    self.notify_client('busy', queued=len(self.send_queue), id=client_id)
+                return False
+            self.transmit_next()
+            return True
+
+    def transmit_next(self):
+        """Send the head of the queue if no message is waiting for its ACK.
+        
+        Must be called with send_lock held.
+        """
+        if self.unacked or not self.send_queue or not self.in_chat:
+            return
+        text, client_id = unpack_outgoing(self.send_queue.popleft())
+        msg_id = None
+        if 'receipts' in self.session_extensions:
+            msg_id = self.next_msg_id
+            self.next_msg_id = (msg_id + 1) & 0xFFFFFFFF
+            text = add_receipt(msg_id, int(self.wallclock() * 1e6), text)
+        chat_msg = self.session_message(
             MessageType.CHAT,
             OperationType.CHAT_MSG.value,
             self.seq_num,
-            self.username or "daemon",
             text
         )
+        now = self.clock()
+        unacked = {
+            'seq': self.seq_num,
+            'data': chat_msg,
+            'attempts': 1,
+            'msg_id': msg_id,
+            'client_id': client_id,
+            'first_sent': now,
+            'sent_at': now
+        }
+        self.unacked = unacked
+        self.daemon_transport.send(chat_msg, self.chat_partner)
+        unacked['timer'] = self.session_timers.schedule(self.timeout, self.retransmit, unacked)
         
-        # Stop-and-wait: retry until ACK received
-        max_retries = 5
-        for attempt in range(max_retries):
-            self.daemon_socket.sendto(chat_msg, self.chat_partner)
-            
-            # Wait for ACK with timeout
-            self.daemon_socket.settimeout(TIMEOUT)
-            try:
-                # ACK will be handled by handle_ack which toggles seq_num
-                # Just wait a bit for the ACK handler to process
-                time.sleep(0.1)
-                break
-            except socket.timeout:
-                print(f"Timeout, retrying... (attempt {attempt + 1})")
-        
-        self.daemon_socket.settimeout(None)
+        if self.send_blocked and len(self.send_queue) <= self.send_queue_size // 2:
+            self.send_blocked = False
+            self.notify_client('credit', available=self.send_queue_size - len(self.send_queue))
+
+    def message_dropped(self, record: bytes):
+        """The drop_oldest policy pushed a queued message out of the session buffer."""
+        text, client_id = unpack_outgoing(record)
+        self.log.debug('send_dropped', session=self.session_id, length=len(text))
+        if client_id is not None:
+            self.notify_client('dropped', id=client_id)
+
+    def retransmit(self, unacked: dict):
+        """Retransmission timer for an unacknowledged chat message."""
+        with self.send_lock:
+            if self.unacked is not unacked:
+                return
+            if unacked['attempts'] >= MAX_RETRIES:
+                # Skipping the message would leave our sequence bit out of step with the
+                # partner's if only its ACKs were lost, so the session ends instead
+                self.log.warning('retries_exhausted', session=self.session_id, peer=fmt_addr(self.chat_partner),
+                                 seq=unacked['seq'], attempts=unacked['attempts'])
+                self.terminate_chat()
+                self.notify_client('disconnected', reason='timeout')
+                return
+            self.log.info('retransmit', session=self.session_id, peer=fmt_addr(self.chat_partner),
+                          seq=unacked['seq'], attempt=unacked['attempts'])
+            unacked['attempts'] += 1
+            self.counters['retransmits'] += 1
+            unacked['sent_at'] = self.clock()
+            self.daemon_transport.send(unacked['data'], self.chat_partner)
+            unacked['timer'] = self.session_timers.schedule(self.timeout, self.retransmit, unacked)
+
+    def abort_unacked(self):
+        """Give up on the message in flight and everything queued, e.g. when the chat ends."""
+        with self.send_lock:
+            unacked = self.unacked
+            if unacked:
+                self.session_timers.cancel(unacked['timer'])
+                self.unacked = None
+            self.send_queue.clear()
+            self.send_blocked = False
 
     def terminate_chat(self):
         """Terminate current chat."""
         if not self.in_chat:
             return
         
-        fin_msg = build_simp_message(
+        fin_msg = self.session_message(
             MessageType.CONTROL,
             OperationType.FIN.value,
-            0,
-            self.username or "daemon"
+            0
         )
-        self.daemon_socket.sendto(fin_msg, self.chat_partner)
-        
+        self.daemon_transport.send(fin_msg, self.chat_partner)
+        self.close_session()
+
+    def open_session(self, addr: tuple, username: str, extensions: set = frozenset(),
+                     local_sid: int = None, peer_sid: int = None):
+        """Enter chat state with addr and start keepalives.
+
+        With 'compact' negotiated we send local_sid in place of our
+        username and resolve the partner's peer_sid to its username.
+        """
+        self.session_id += 1
+        self.session_extensions = set(extensions)
+        if 'compact' in extensions:
+            self.local_sid = local_sid
+            self.session_table = {peer_sid: username}
+        self.log.info('session_open', session=self.session_id, peer=fmt_addr(addr), username=username,
+                      extensions=sorted(extensions))
+        self.in_chat = True
+        self.chat_partner = addr
+        self.chat_partner_username = username
+        if 'files' in self.session_extensions:
+            self.transfers.open(addr, self.username, self.local_sid)
+        self.seq_num = 0
+        self.expected_seq = 0
+        self.last_heard = self.clock()
+        self.missed_probes = 0
+        self.session_timers.cancel(self.keepalive_timer)
+        self.keepalive_timer = None
+        if self.keepalive_interval:
+            self.keepalive_timer = self.session_timers.schedule(self.keepalive_interval, self.keepalive, self.session_id)
+
+    def close_session(self):
+        """Leave chat state and release everything held for the session."""
+        if self.in_chat:
+            self.log.info('session_close', session=self.session_id, peer=fmt_addr(self.chat_partner))
+        self.abort_unacked()
+        self.transfers.close()
+        self.session_timers.cancel(self.keepalive_timer)
+        self.keepalive_timer = None
         self.in_chat = False
         self.chat_partner = None
         self.chat_partner_username = None
+        self.session_extensions = set()
+        self.local_sid = None
+        self.session_table = {}
+        self.seq_num = 0
+        self.expected_seq = 0
+
+    def keepalive(self, session_id: int):
+        """Keepalive timer: probe an idle partner, tear down a dead one."""
+        if not self.in_chat or session_id != self.session_id:
+            return
+        self.keepalive_timer = None
+        if self.clock() - self.last_heard < self.keepalive_interval:
+            self.missed_probes = 0
+        elif self.missed_probes >= self.keepalive_probes:
+            self.log.warning('peer_dead', session=self.session_id, peer=fmt_addr(self.chat_partner),
+                             probes=self.missed_probes)
+            self.close_session()
+            self.notify_client('disconnected', reason='timeout')
+            return
+        else:
+            ping_msg = self.session_message(
+                MessageType.CONTROL,
+                OperationType.PING.value,
+                0
+            )
+            self.daemon_transport.send(ping_msg, self.chat_partner)
+            self.missed_probes += 1
+        self.keepalive_timer = self.session_timers.schedule(self.keepalive_interval, self.keepalive, session_id)
+
+    def stats(self) -> dict:
+        """Return daemon counters for the 'stats' command."""
+        stats = {'in_chat': int(self.in_chat)}
+        stats.update(self.timers.stats())
+        stats.update(self.limiter.stats())
+        stats.update(self.dispatcher.stats())
+        stats.update(self.log.stats())
+        stats.update(self.handler_timers.stats())
+        stats.update(self.ack_rtt.stats('ack_rtt'))
+        stats.update(self.one_way_latency.stats('one_way'))
+        stats.update(self.connect_latency.stats('connect'))
+        stats.update(self.transfers.stats())
+        stats.update(self.send_queue.stats('send_buffer'))
+        stats.update(self.budget.stats())
+        stats.update(self.counters)
+        return stats
+
+    def checkpoint(self) -> dict:
+        """Session state for a successor, see restore(). Timers are saved as the time they have left."""
+        now = self.clock()
+        state = {
+            'username': self.username,
+            'client_socket': self.client_socket,
+            'session_id': self.session_id,
+            'next_msg_id': self.next_msg_id,
+            'counters': self.counters,
+            'session': None,
+            'invitations': [],
+            'connecting': None
+        }
+        if self.in_chat:
+            unacked = self.unacked
+            state['session'] = {
+                'partner': self.chat_partner,
+                'username': self.chat_partner_username,
+                'extensions': sorted(self.session_extensions),
+                'local_sid': self.local_sid,
+                'peer_sid': next(iter(self.session_table), None),
+                'seq_num': self.seq_num,
+                'expected_seq': self.expected_seq,
+                'send_queue': [unpack_outgoing(record) for record in self.send_queue.items()],
+                'send_blocked': self.send_blocked,
+                'unacked': unacked and {
+                    'seq': unacked['seq'],
+                    'data': encode_bytes(unacked['data']),
+                    'attempts': unacked['attempts'],
+                    'msg_id': unacked['msg_id'],
+                    'client_id': unacked['client_id'],
+                    'age': now - unacked['first_sent'],
+                    'sent_age': now - unacked['sent_at']
+                }
+            }
+        for inv in self.invitations.values():
+            saved = {key: inv[key] for key in ('addr', 'username', 'seq', 'syn', 'early_data', 'accepted',
+                                               'local_sid', 'peer_sid')}
+            saved['extensions'] = sorted(inv['extensions'])
+            saved['synack_attempts'] = inv.get('synack_attempts', 0)
+            saved['ttl'] = inv['timer'].deadline - now
+            state['invitations'].append(saved)
+        conn = self.connecting
+        if conn:
+            state['connecting'] = {key: conn[key] for key in ('addr', 'payload', 'retried', 'local_sid', 'attempts')}
+            state['connecting']['age'] = now - conn['started']
+            state['connecting']['deadline'] = conn['deadline'].deadline - now
+        return state
+
+    def restore(self, state: dict):
+        """Resume the sessions of a checkpoint() taken by our predecessor. Call before start()."""
+        now = self.clock()
+        self.username = state['username']
+        self.client_socket = tuple(state['client_socket']) if state['client_socket'] else None
+        self.next_msg_id = state['next_msg_id']
+        self.counters.update(state['counters'])
+        self.session_id = state['session_id']
+        session = state['session']
+        if session:
+            # open_session() counts the session ID up again
+            self.session_id -= 1
+            self.open_session(tuple(session['partner']), session['username'], session['extensions'],
+                              session['local_sid'], session['peer_sid'])
+            self.seq_num = session['seq_num']
+            self.expected_seq = session['expected_seq']
+            for text, client_id in session['send_queue']:
+                self.send_queue.append(pack_outgoing(text, client_id))
+            self.send_blocked = session['send_blocked']
+            saved = session['unacked']
+            if saved:
+                unacked = {
+                    'seq': saved['seq'],
+                    'data': decode_bytes(saved['data']),
+                    'attempts': saved['attempts'],
+                    'msg_id': saved['msg_id'],
+                    'client_id': saved['client_id'],
+                    'first_sent': now - saved['age'],
+                    'sent_at': now - saved['sent_age']
+                }
+                self.unacked = unacked
+                unacked['timer'] = self.session_timers.schedule(max(0, self.timeout - saved['sent_age']),
+                                                                self.retransmit, unacked)
+        for saved in state['invitations']:
+            inv = dict(saved, addr=tuple(saved['addr']), extensions=set(saved['extensions']))
+            del inv['ttl']
+            inv['timer'] = self.session_timers.schedule(max(0, saved['ttl']), self.expire_invitation, inv)
+            if inv['accepted']:
+                inv['synack_timer'] = self.session_timers.schedule(self.timeout, self.retransmit_syn_ack, inv)
+            self.invitations[inv['addr']] = inv
+        saved = state['connecting']
+        if saved:
+            conn = dict(saved, addr=tuple(saved['addr']), started=now - saved['age'])
+            del conn['age']
+            conn['deadline'] = self.session_timers.schedule(max(0, saved['deadline']), self.connect_expired, conn)
+            conn['timer'] = self.session_timers.schedule(self.timeout, self.retransmit_syn, conn)
+            self.connecting = conn
+        self.log.info('restored', session=self.session_id if session else None,
+                      invitations=len(self.invitations), connecting=bool(saved))
+
+    def hand_over(self, conn: socket.socket) -> bool:
+        """Pass our sockets and sessions to a successor connected on the handover socket.
+
+        Returns True once the successor confirmed and we are stopped. If
+        it fails before that, we carry on serving.
+        """
+        started = self.clock()
+        self.log.info('handover_start')
+        self.stop_listeners()
+        self.timers.stop()
+        # Handle what was already received, it is in no snapshot otherwise
+        self.dispatcher.drain()
+        self.transfers.close('restart')
+        write_snapshot(self.handover.snapshot_path, self.checkpoint())
+        try:
+            send_handover(conn, (self.daemon_transport.sock, self.client_transport.sock), self.handover.snapshot_path)
+            confirmed = conn.recv(16) == b'ok'
+        except OSError:
+            confirmed = False
+        if not confirmed:
+            self.log.warning('handover_failed')
+            self.timers.start()
+            self.dispatcher.start()
+            self.start_listeners()
+            return False
+        self.log.info('handover_done', ms=round((self.clock() - started) * 1000, 3))
+        self.stop(handover=True)
+        return True
 
-    def stop(self):
-        """Stop the daemon."""
+    def stop(self, handover: bool = False):
+        """Stop the daemon. After a handover the sockets belong to the successor and stay open."""
         self.running = False
-        self.daemon_socket.close()
-        self.client_daemon_socket.close()
+        self.ready.clear()
+        if self.handover:
+            self.handover.stop()
+        self.timers.stop()
+        self.dispatcher.stop()
+        self.transfers.close()
+        self.send_queue.close()
+        for transport in (self.daemon_transport, self.client_transport):
+            # Closing wakes up a listener blocked in receive()
+            transport.close(shutdown=not handover)
+        # Last, so the events of everything above are written
+        self.log.stop()
+        if self.log_stream:
+            self.log_stream.close()
+        self.stopped.set()
+
+
+def pack_outgoing(text: str, client_id: str = None) -> bytes:
+    """A queued outgoing message as one record for the session buffer."""
+    return f"{client_id or ''}\x00{text}".encode('ascii')
+
+
+def unpack_outgoing(record: bytes) -> tuple:
+    """(text, client_id or None) of a pack_outgoing() record."""
+    client_id, _, text = record.decode('ascii').partition('\x00')
+    return text, client_id or None
+
+
+def announce_ready(daemon: SimpDaemon, ready_fd: int = None, ready_file: str = None):
+    """Tell whoever started us that both sockets are listening."""
+    line = daemon.ready_line() + "\n"
+    print(line, end='', flush=True)
+    if ready_fd is not None:
+        os.write(ready_fd, line.encode('ascii'))
+        os.close(ready_fd)
+    if ready_file:
+        tmp = f"{ready_file}.tmp"
+        with open(tmp, 'w') as f:
+            f.write(line)
+        os.replace(tmp, ready_file)
 
 
 def main():
-    if len(sys.argv) < 1:
-        print("Usage: simp_daemon.py")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="SIMP daemon. Settings can also be given as SIMP_<NAME> environment variables.")
+    parser.add_argument('--host', help="bind address for SIMP traffic (default 0.0.0.0)")
+    parser.add_argument('--port', type=int, help=f"SIMP port, 0 for ephemeral (default {DAEMON_PORT})")
+    parser.add_argument('--client-host', help="bind address for the local client, e.g. 0.0.0.0 to expose it (default 127.0.0.1)")
+    parser.add_argument('--client-port', type=int, help=f"client port, 0 for ephemeral (default {CLIENT_DAEMON_PORT})")
+    parser.add_argument('--timeout', type=float, help=f"retransmission timeout in seconds (default {TIMEOUT})")
+    parser.add_argument('--handshake-timeout', type=float, help=f"connect deadline in seconds, the SYN is resent with backoff until then (default {HANDSHAKE_TIMEOUT})")
+    parser.add_argument('--invitation-ttl', type=float, help=f"invitation lifetime in seconds (default {INVITATION_TTL})")
+    parser.add_argument('--invitation-queue-size', type=int,
+                        help=f"pending invitations kept at once (default {INVITATION_QUEUE_SIZE})")
+    parser.add_argument('--keepalive-interval', type=float, help=f"0 disables keepalives (default {KEEPALIVE_INTERVAL})")
+    parser.add_argument('--keepalive-probes', type=int, help=f"missed probes before a peer is dead (default {KEEPALIVE_PROBES})")
+    parser.add_argument('--source-rate', type=float, help=f"datagrams/s accepted per source address (default {SOURCE_RATE})")
+    parser.add_argument('--global-rate', type=float, help=f"datagrams/s accepted from all sources (default {GLOBAL_RATE})")
+    parser.add_argument('--session-buffer', type=int,
+                        help=f"bytes preallocated for queued outgoing messages (default {SESSION_BUFFER})")
+    parser.add_argument('--buffer-policy', choices=('reject', 'drop_oldest', 'spill'),
+                        help=f"what a full session buffer does with new messages (default {BUFFER_POLICY})")
+    parser.add_argument('--memory-budget', type=int,
+                        help=f"bytes for the session buffer and waiting datagrams (default {MEMORY_BUDGET})")
+    parser.add_argument('--extensions', help=f"header extensions to negotiate, '' for none (default {','.join(SUPPORTED_EXTENSIONS)})")
+    parser.add_argument('--download-dir', help="directory for received files (default: current directory)")
+    parser.add_argument('--accept-files', action='store_true', default=None,
+                        help="write every file the chat partner sends to --download-dir (default: refuse them)")
+    parser.add_argument('--profile-dir', help="directory for profiling results (default: current directory)")
+    parser.add_argument('--log-level', choices=LEVELS, help="event log level (default info)")
+    parser.add_argument('--log-sample', type=float, help="fraction of debug/info events kept (default 1.0)")
+    parser.add_argument('--log-file', help="append the JSON-lines event log here instead of stderr")
+    parser.add_argument('--transport', choices=sorted(TRANSPORTS),
+                        help="'batched' reads and writes bursts of datagrams with recvmmsg/sendmmsg (default udp)")
+    parser.add_argument('--handover-socket', help="Unix socket on which a successor can take over this daemon")
+    parser.add_argument('--take-over', metavar='PATH',
+                        help="take over the sockets and sessions of the daemon whose --handover-socket is PATH")
+    parser.add_argument('--ready-fd', type=int, help="write the READY line to this file descriptor and close it")
+    parser.add_argument('--ready-file', help="atomically write the READY line to this file once listening")
+    args = parser.parse_args()
     
-    daemon = SimpDaemon()
+    handover, sockets = None, None
+    if args.take_over:
+        handover, sockets, state = receive_handover(args.take_over)
+    daemon = SimpDaemon(args.host, args.port, args.client_port, args.client_host,
+                        args.timeout, args.handshake_timeout, args.invitation_ttl,
+                        args.keepalive_interval, args.keepalive_probes,
+                        source_rate=args.source_rate, global_rate=args.global_rate,
+                        log_level=args.log_level, log_sample=args.log_sample, log_file=args.log_file,
+                        extensions=args.extensions, download_dir=args.download_dir,
+                        invitation_queue_size=args.invitation_queue_size,
+                        handover_socket=args.handover_socket, sockets=sockets,
+                        session_buffer=args.session_buffer, buffer_policy=args.buffer_policy,
+                        memory_budget=args.memory_budget, transport=args.transport,
+                        profile_dir=args.profile_dir, accept_files=args.accept_files)
     try:
+        if handover:
+            daemon.restore(state)
         daemon.start()
+        if handover:
+            # The old daemon stops once it reads this
+            handover.sendall(b'ok')
+            handover.close()
+        announce_ready(daemon, args.ready_fd, args.ready_file)
+        daemon.stopped.wait()
     except KeyboardInterrupt:
         print("\nShutting down daemon...")
         daemon.stop()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+import logging
+import threading
+import time
+from collections import deque
+from simp_common import COMPACT_FLAG, MessageType
+
+logger = logging.getLogger(__name__)
+
+CONTROL = 0
+CHAT = 1
+CLASS_NAMES = ('control', 'chat')
+
+
+class PriorityDispatcher:
+    """Hands received datagrams from the socket listener to a worker thread.
+
+    Datagrams are classified on their type byte alone: control traffic
+    (SYN, ACK, FIN, PING, ...) goes to a high-priority queue, chat to a
+    low-priority one, and the worker always serves control first. So an
+    ACK is never stuck behind a backlog of chat datagrams. To keep a
+    control flood from starving chat, one chat datagram is served after
+    every control_burst control datagrams while chat is waiting.
+
+    Both queues are bounded; a datagram arriving at a full queue, or
+    beyond the byte budget if one is given, is dropped and counted, as
+    the kernel would drop it at a full socket buffer. With priority=False
+    there is a single FIFO for both classes, which is useful as a
+    baseline in benchmarks.
+
+    The worker is also the one executor of the daemon's session state:
+    timers and the client listener submit() their work to it instead of
+    touching that state from their own threads, so handlers need no
+    locks and never interleave. Submitted tasks run ahead of queued
+    datagrams and are never dropped. A task that raises is reported to
+    on_error(exception, fn), if given, and logged otherwise.
+    """
+
+    def __init__(self, handler, queue_size: int = 1024, control_burst: int = 16,
+                 priority: bool = True, clock=time.monotonic, budget=None, on_error=None):
+        self.handler = handler
+        self.on_error = on_error
+        self.budget = budget
+        self.queue_size = queue_size
+        self.control_burst = control_burst
+        self.priority = priority
+        self.clock = clock
+        self.queues = (deque(), deque())
+        self.tasks = deque()
+        self._cond = threading.Condition()
+        self._burst = 0
+        self._running = False
+        self._thread = None
+        self.enqueued = [0, 0]
+        self.dropped = [0, 0]
+        self.served = [0, 0]
+        self.wait_total = [0.0, 0.0]
+        self.wait_max = [0.0, 0.0]
+        self.tasks_run = 0
+        self.task_errors = 0
+
+    @staticmethod
+    def classify(data: bytes) -> int:
+        # Compact headers set the high bit of the type byte
+        return CONTROL if data[:1] and data[0] & ~COMPACT_FLAG == MessageType.CONTROL.value else CHAT
+
+    def put(self, data: bytes, addr: tuple) -> bool:
+        """Queue one datagram, False if its queue is full."""
+        cls = self.classify(data)
+        queue = self.queues[cls if self.priority else CHAT]
+        with self._cond:
+            if len(queue) >= self.queue_size or (self.budget and not self.budget.reserve(len(data))):
+                self.dropped[cls] += 1
+                return False
+            queue.append((cls, self.clock(), data, addr))
+            self.enqueued[cls] += 1
+            self._cond.notify()
+        return True
+
+    def submit(self, fn, *args):
+        """Run fn(*args) on the worker thread, after the tasks already submitted."""
+        with self._cond:
+            self.tasks.append((fn, args))
+            self._cond.notify()
+
+    def run_tasks(self) -> int:
+        """Run the submitted tasks, returning how many ran. Called by the worker."""
+        ran = 0
+        while self.tasks:
+            fn, args = self.tasks.popleft()
+            try:
+                fn(*args)
+            except Exception as e:
+                self.task_errors += 1
+                if self.on_error:
+                    self.on_error(e, fn)
+                else:
+                    logger.exception("Error in dispatched task %r", fn)
+            ran += 1
+        self.tasks_run += ran
+        return ran
+
+    def get(self, timeout: float = None):
+        """Next (data, addr) by priority, or None if nothing arrived in time."""
+        control, chat = self.queues
+        with self._cond:
+            if not control and not chat and not self.tasks:
+                self._cond.wait(timeout)
+            if control and (not chat or self._burst < self.control_burst):
+                item = control.popleft()
+                self._burst += 1
+            elif chat:
+                item = chat.popleft()
+                self._burst = 0
+            else:
+                return None
+            cls, queued_at, data, addr = item
+            if self.budget:
+                self.budget.release(len(data))
+            wait = self.clock() - queued_at
+            self.served[cls] += 1
+            self.wait_total[cls] += wait
+            if wait > self.wait_max[cls]:
+                self.wait_max[cls] = wait
+        return data, addr
+
+    def run(self):
+        while self._running:
+            if self.tasks:
+                self.run_tasks()
+            item = self.get(timeout=0.1)
+            if item:
+                self.handler(*item)
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        with self._cond:
+            self._cond.notify_all()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join(timeout=1)
+
+    def drain(self, timeout: float = 1.0):
+        """Stop the worker once every queued datagram and task has been handled."""
+        deadline = time.monotonic() + timeout
+        while (self.tasks or self.queues[CONTROL] or self.queues[CHAT]) and time.monotonic() < deadline:
+            time.sleep(0.001)
+        self.stop()
+
+    def stats(self) -> dict:
+        with self._cond:
+            stats = {}
+            for cls, name in enumerate(CLASS_NAMES):
+                served = self.served[cls]
+                stats[f"dispatch_{name}_queued"] = sum(1 for item in self.queues[CHAT if not self.priority else cls]
+                                                      if item[0] == cls)
+                stats[f"dispatch_{name}_served"] = served
+                stats[f"dispatch_{name}_dropped"] = self.dropped[cls]
+                stats[f"dispatch_{name}_wait_mean_ms"] = self.wait_total[cls] / served * 1000 if served else 0.0
+                stats[f"dispatch_{name}_wait_max_ms"] = self.wait_max[cls] * 1000
+            stats['dispatch_tasks_run'] = self.tasks_run
+            stats['dispatch_task_errors'] = self.task_errors
+            return stats
+
+
+class WorkerTimers:
+    """Schedules timers on a TimerWheel whose callbacks run as tasks on a dispatcher's worker.
+
+    A timer cancelled after it fired may still have its task queued, so
+    callbacks check that what they were armed for is still current.
+    """
+
+    def __init__(self, timers, dispatcher: PriorityDispatcher):
+        self.timers = timers
+        self.dispatcher = dispatcher
+
+    def schedule(self, delay: float, callback, *args):
+        return self.timers.schedule(delay, self.dispatcher.submit, callback, *args)
+
+    def cancel(self, timer):
+        self.timers.cancel(timer)
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""Synthetic SIMP load from thousands of emulated peers in one process.
+
+Every emulated peer owns a UDP socket (so the daemon sees a distinct
+address) and runs a scenario script. A script yields the datagrams to
+send together with the operations it expects back; the generator paces
+all sends to the target rate, matches responses, times out lost
+exchanges on a timer wheel and reports achieved rate, errors and the
+latency distribution per exchange.
+
+    python simp_loadgen.py --scenario syn_storm --peers 2000 --rate 5000 --duration 10
+"""
+
+import argparse
+import resource
+import selectors
+import socket
+import time
+from collections import deque
+from simp_common import *
+from simp_timer import TimerWheel
+
+SYN = OperationType.SYN.value
+ACK = OperationType.ACK.value
+FIN = OperationType.FIN.value
+ERR = OperationType.ERR.value
+PING = OperationType.PING.value
+RETRY = OperationType.RETRY.value
+SYN_ACK = SYN | ACK
+
+SCENARIOS = ('syn_storm', 'chat', 'churn', 'busy')
+
+
+def control(op: int, name: str, seq: int = 0, payload: str = "") -> bytes:
+    return build_simp_message(MessageType.CONTROL, op, seq, name, payload)
+
+
+def open_chat(name: str):
+    """SYN, answering a RETRY of a daemon under load with its cookie. Returns the final response."""
+    response = yield 'syn', control(SYN, name), {SYN_ACK, ERR, RETRY}
+    if response['operation'] == RETRY:
+        response = yield 'syn', control(SYN, name, payload=add_syn_cookie(response['payload'])), {SYN_ACK, ERR}
+    return response
+
+
+def syn_storm_script(name: str, messages: int):
+    """Send SYNs forever, each answered by SYN+ACK, a busy ERR or a RETRY under load.
+    
+    RETRYs are not followed up, like the SYNs of a spoofed flood.
+    """
+    while True:
+        yield 'syn', control(SYN, name), {SYN_ACK, ERR, RETRY}
+
+
+def chat_script(name: str, messages: int):
+    """Open one chat and keep it busy with stop-and-wait messages."""
+    response = yield from open_chat(name)
+    if response['operation'] != SYN_ACK:
+        return
+    yield 'ack', control(ACK, name), None
+    seq = 0
+    while True:
+        chat = build_simp_message(MessageType.CHAT, OperationType.CHAT_MSG.value, seq, name, "x" * 32)
+        yield 'chat', chat, {ACK}
+        seq = 1 - seq
+
+
+def churn_script(name: str, messages: int):
+    """Repeatedly open a chat, exchange a few messages and close it."""
+    while True:
+        response = yield from open_chat(name)
+        if response['operation'] != SYN_ACK:
+            continue
+        yield 'ack', control(ACK, name), None
+        for i in range(messages):
+            chat = build_simp_message(MessageType.CHAT, OperationType.CHAT_MSG.value, i % 2, name, f"m{i}")
+            yield 'chat', chat, {ACK}
+        yield 'fin', control(FIN, name), {ACK}
+
+
+def busy_script(name: str, messages: int):
+    """Invite a daemon that is already chatting and expect the busy ERR."""
+    while True:
+        yield 'busy', control(SYN, name), {ERR}
+
+
+class Peer:
+    __slots__ = ('name', 'sock', 'target', 'script', 'label', 'data', 'expected', 'sent_at', 'timer')
+
+    def __init__(self, name: str, target: tuple, script):
+        self.name = name
+        self.target = target
+        self.script = script
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('', 0))
+        self.sock.setblocking(False)
+        self.label = None
+        self.data = None
+        self.expected = None
+        self.sent_at = 0.0
+        self.timer = None
+
+
+class LoadGenerator:
+    def __init__(self, targets: list, scenario: str = 'syn_storm', peers: int = 100, rate: float = 1000,
+                 duration: float = 10, timeout: float = TIMEOUT, messages: int = 5):
+        if scenario not in SCENARIOS:
+            raise ValueError(f"Unknown scenario {scenario}")
+        if scenario == 'chat':
+            # A daemon holds one chat at a time: one long-lived chat per target
+            peers = min(peers, len(targets))
+        raise_fd_limit(peers + 64)
+        self.scenario = scenario
+        self.rate = rate
+        self.duration = duration
+        self.timeout = timeout
+        self.timers = TimerWheel(tick=0.005)
+        self.selector = selectors.DefaultSelector()
+        self.ready = deque()
+        self.latencies = {}
+        self.errors = {}
+        self.sent = 0
+        self.completed = 0
+        self.peers = []
+        script = globals()[f"{scenario}_script"]
+        for i in range(peers):
+            target = targets[i % len(targets)]
+            if scenario == 'busy' and i < len(targets):
+                # One peer per daemon holds the chat that makes it busy
+                peer = Peer(f"holder{i}", target, chat_script(f"holder{i}", messages))
+            else:
+                peer = Peer(f"load{i}", target, script(f"load{i}", messages))
+            self.peers.append(peer)
+            self.selector.register(peer.sock, selectors.EVENT_READ, peer)
+
+    def advance(self, peer: Peer, response: dict = None):
+        """Step the peer's script with the parsed response and queue its next datagram."""
+        try:
+            step = peer.script.send(response) if peer.label else next(peer.script)
+        except StopIteration:
+            peer.label = None
+            return
+        peer.label, peer.data, peer.expected = step
+        self.ready.append(peer)
+
+    def transmit(self, peer: Peer, now: float):
+        try:
+            peer.sock.sendto(peer.data, peer.target)
+        except OSError:
+            self.error('send_failed')
+            self.ready.append(peer)
+            return
+        self.sent += 1
+        if peer.expected is None:
+            self.advance(peer)
+        else:
+            peer.sent_at = now
+            peer.timer = self.timers.schedule(self.timeout, self.expire, peer)
+
+    def expire(self, peer: Peer):
+        """No matching response in time: count it and retry the same step."""
+        peer.timer = None
+        self.error(f"{peer.label}_timeout")
+        self.ready.append(peer)
+
+    def error(self, kind: str):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def receive(self, peer: Peer, now: float):
+        while True:
+            try:
+                data, _ = peer.sock.recvfrom(4096)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                self.error('icmp_unreachable')
+                return
+            try:
+                msg = parse_simp_message(data)
+            except ValueError:
+                self.error('malformed')
+                continue
+            op = msg['operation']
+            if msg['type'] == MessageType.CONTROL.value and op == PING:
+                try:
+                    peer.sock.sendto(control(PING | ACK, peer.name, msg['seq']), peer.target)
+                except OSError:
+                    self.error('send_failed')
+                continue
+            if peer.timer is None or op not in peer.expected:
+                continue  # e.g. the FIN that follows a busy ERR, or a late duplicate
+            self.timers.cancel(peer.timer)
+            peer.timer = None
+            self.completed += 1
+            self.latencies.setdefault(peer.label, []).append(now - peer.sent_at)
+            self.advance(peer, msg)
+
+    def run(self) -> dict:
+        for peer in self.peers:
+            self.advance(peer)
+        interval = 1.0 / self.rate if self.rate else 0.0
+        started = time.monotonic()
+        next_send = started
+        end = started + self.duration
+        while True:
+            now = time.monotonic()
+            if now >= end:
+                break
+            # Pace sends to the target rate, catching up in bursts if behind
+            while self.ready and next_send <= now:
+                self.transmit(self.ready.popleft(), now)
+                next_send += interval
+            if not self.ready:
+                next_send = max(next_send, now)
+            wait = max(0.0, min(next_send - now, self.timers.tick)) if self.ready else self.timers.tick
+            for key, _ in self.selector.select(wait):
+                self.receive(key.data, time.monotonic())
+            self.timers.advance()
+        elapsed = time.monotonic() - started
+        return self.report(elapsed)
+
+    def report(self, elapsed: float) -> dict:
+        latency = {}
+        for label, values in self.latencies.items():
+            values.sort()
+            latency[label] = {
+                'count': len(values),
+                'p50_ms': values[len(values) // 2] * 1000,
+                'p90_ms': values[int(len(values) * 0.9)] * 1000,
+                'p99_ms': values[int(len(values) * 0.99)] * 1000,
+                'max_ms': values[-1] * 1000,
+            }
+        return {
+            'scenario': self.scenario,
+            'peers': len(self.peers),
+            'elapsed_s': elapsed,
+            'sent': self.sent,
+            'completed': self.completed,
+            'target_rate': self.rate,
+            'achieved_rate': self.completed / elapsed if elapsed else 0.0,
+            'errors': dict(self.errors),
+            'latency': latency,
+        }
+
+    def close(self):
+        self.selector.close()
+        for peer in self.peers:
+            peer.sock.close()
+
+
+def raise_fd_limit(needed: int):
+    """Make sure one socket per emulated peer fits under RLIMIT_NOFILE."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        target = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+
+
+def parse_target(value: str) -> tuple:
+    host, _, port = value.rpartition(':')
+    return (host or '127.0.0.1', int(port or DAEMON_PORT))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SIMP load generator")
+    parser.add_argument('--target', type=parse_target, action='append',
+                        help=f"daemon host:port, may be repeated (default 127.0.0.1:{DAEMON_PORT})")
+    parser.add_argument('--scenario', choices=SCENARIOS, default='syn_storm')
+    parser.add_argument('--peers', type=int, default=100, help="emulated peers (chat: one per target)")
+    parser.add_argument('--rate', type=float, default=1000, help="datagrams per second, 0 = unlimited")
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--timeout', type=float, default=TIMEOUT)
+    parser.add_argument('--messages', type=int, default=5, help="chat messages per session in churn")
+    args = parser.parse_args()
+
+    generator = LoadGenerator(args.target or [('127.0.0.1', DAEMON_PORT)], args.scenario, args.peers,
+                              args.rate, args.duration, args.timeout, args.messages)
+    try:
+        report = generator.run()
+    finally:
+        generator.close()
+    print(f"scenario={report['scenario']} peers={report['peers']} elapsed={report['elapsed_s']:.1f}s")
+    print(f"  sent {report['sent']}, completed {report['completed']}, "
+          f"rate {report['achieved_rate']:.0f}/s (target {report['target_rate']:.0f}/s)")
+    for label, stats in report['latency'].items():
+        print(f"  {label:5} n={stats['count']:<7} p50={stats['p50_ms']:.2f}ms p90={stats['p90_ms']:.2f}ms "
+              f"p99={stats['p99_ms']:.2f}ms max={stats['max_ms']:.2f}ms")
+    for kind, count in sorted(report['errors'].items()):
+        print(f"  error {kind}: {count}")
+
+
+if __name__ == "__main__":
+    main()
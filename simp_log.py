@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+import json
+import queue
+import random
+import sys
+import threading
+import time
+
+LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+
+
+def fmt_addr(addr) -> str:
+    """'ip:port' for log fields."""
+    return f"{addr[0]}:{addr[1]}" if addr else None
+
+
+class EventLog:
+    """Structured event log, one JSON object per line, written off the hot path.
+
+    log() only checks the level, samples and puts the event on a bounded
+    queue; a background thread serializes and writes it. When the queue
+    is full the event is dropped and counted instead of blocking the
+    caller. Sampling applies to debug and info events only, warnings
+    and errors are always kept.
+
+        log = EventLog(sys.stderr, level='debug', sample=0.1)
+        log.start()
+        log.info('retransmit', session=3, peer='10.0.0.2:7777', seq=1, attempt=2)
+    """
+
+    def __init__(self, stream=None, level: str = 'info', sample: float = 1.0, queue_size: int = 4096,
+                 clock=time.time, seed=None):
+        self.stream = stream or sys.stderr
+        self.level = LEVELS[level]
+        self.sample = sample
+        self.clock = clock
+        self.rng = random.Random(seed)
+        self._queue = queue.Queue(queue_size)
+        self._thread = None
+        self.written = 0
+        self.dropped = 0
+        self.sampled_out = 0
+
+    def enabled(self, level: str) -> bool:
+        """Cheap check before building expensive fields."""
+        return LEVELS[level] >= self.level
+
+    def log(self, level: str, event: str, **fields) -> bool:
+        """Queue one event, False if it was filtered, sampled out or dropped."""
+        severity = LEVELS[level]
+        if severity < self.level:
+            return False
+        if severity < LEVELS['warning'] and self.sample < 1.0 and self.rng.random() >= self.sample:
+            self.sampled_out += 1
+            return False
+        try:
+            self._queue.put_nowait((self.clock(), level, event, fields))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def debug(self, event: str, **fields) -> bool:
+        return self.log('debug', event, **fields)
+
+    def info(self, event: str, **fields) -> bool:
+        return self.log('info', event, **fields)
+
+    def warning(self, event: str, **fields) -> bool:
+        return self.log('warning', event, **fields)
+
+    def error(self, event: str, **fields) -> bool:
+        return self.log('error', event, **fields)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            self._write(item)
+            # Flush once per batch, not once per event
+            if self._queue.empty():
+                self.stream.flush()
+
+    def _write(self, item: tuple):
+        ts, level, event, fields = item
+        record = {'ts': round(ts, 6), 'level': level, 'event': event}
+        record.update(fields)
+        try:
+            self.stream.write(json.dumps(record, default=str) + "\n")
+            self.written += 1
+        except (OSError, ValueError):
+            self.dropped += 1
+
+    def stop(self):
+        """Write what is still queued, then stop the writer."""
+        if not self._thread:
+            return
+        try:
+            self._queue.put(None, timeout=1)
+        except queue.Full:
+            pass
+        self._thread.join(timeout=1)
+        self._thread = None
+        try:
+            self.stream.flush()
+        except (OSError, ValueError):
+            pass
+
+    def stats(self) -> dict:
+        return {
+            'log_written': self.written,
+            'log_dropped': self.dropped,
+            'log_sampled_out': self.sampled_out,
+            'log_queued': self._queue.qsize(),
+        }
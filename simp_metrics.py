@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+
+import threading
+from collections import deque
+
+
+class LatencyStats:
+    """Running count/mean/max of a latency plus percentiles over the last `window` samples."""
+
+    def __init__(self, window: int = 1024):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float):
+        with self._lock:
+            self.samples.append(seconds)
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, p: float) -> float:
+        with self._lock:
+            ordered = sorted(self.samples)
+        if not ordered:
+            return 0.0
+        return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+    def stats(self, prefix: str) -> dict:
+        """Counters in milliseconds, keys prefixed for the 'stats' reply."""
+        mean = self.total / self.count if self.count else 0.0
+        return {
+            f"{prefix}_count": self.count,
+            f"{prefix}_mean_ms": round(mean * 1000, 3),
+            f"{prefix}_p50_ms": round(self.percentile(50) * 1000, 3),
+            f"{prefix}_p99_ms": round(self.percentile(99) * 1000, 3),
+            f"{prefix}_max_ms": round(self.max * 1000, 3),
+        }
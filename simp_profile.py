@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+"""Profiling hooks for a running daemon.
+
+The daemon answers three client-daemon commands:
+
+    profile|action=start|mode=cprofile      (or mode=sample|interval=0.005)
+    profile|action=stop                     -> profile|status=stopped|path=...
+    timing|action=on                        (or off)
+
+Only the client registered with 'connect' may send them. Results go to
+the daemon's --profile-dir as simp-<pid>-<time>.prof or .folded; the
+reply names the file. cProfile results are in pstats format (python -m
+pstats FILE), sampling results collapsed stacks ("frame;frame;frame
+count"), which flamegraph tools read directly. This module is also a
+small command line tool to send those commands; it registers as the
+daemon's client first, so run it while no chat client is attached:
+
+    python simp_profile.py start --mode sample
+    python simp_profile.py stop
+    python simp_profile.py timing on
+"""
+
+import argparse
+import cProfile
+import os
+import pstats
+import socket
+import sys
+import threading
+import time
+from collections import Counter
+from simp_common import *
+
+PROFILE_MODES = ('cprofile', 'sample')
+
+
+class SamplingProfiler:
+    """Samples the stacks of all other threads every interval seconds."""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.counts = Counter()
+        self.samples = 0
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        me = threading.get_ident()
+        while self._running:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                self.counts[";".join(reversed(stack))] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def stop(self):
+        self._running = False
+        if self._thread:
+            self._thread.join(timeout=1)
+
+    def dump(self, path: str):
+        """Write collapsed stacks, most frequent first."""
+        with open(path, 'w') as f:
+            for stack, count in self.counts.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+# Before 3.12 cProfile hooks only the thread that enables it, since then
+# it is process-wide (sys.monitoring) and only one may be active.
+PER_THREAD_PROFILES = sys.version_info < (3, 12)
+
+
+class _Snapshot:
+    """pstats input taken from a profile without disabling it from a foreign thread."""
+
+    def __init__(self, profile: cProfile.Profile):
+        profile.snapshot_stats()
+        self.stats = profile.stats
+
+    def create_stats(self):
+        pass
+
+
+class Profiler:
+    """Start/stop cProfile or sampling inside a running process.
+
+    Where cProfile only sees the thread that enabled it, the daemon's
+    handler entry points call sync() whenever `pending` is set: each
+    thread then switches its own profile on or off the next time it
+    handles something. While nothing is pending the cost is a single
+    attribute check.
+    """
+
+    def __init__(self, directory: str = '.'):
+        self.directory = directory
+        self.mode = None
+        self.pending = False
+        self._generation = 0
+        self._profiles = []
+        self._live = set()
+        self._local = threading.local()
+        self._sampler = None
+        self._lock = threading.Lock()
+
+    @property
+    def active(self) -> bool:
+        return self.mode is not None
+
+    def start(self, mode: str = 'cprofile', interval: float = 0.005):
+        with self._lock:
+            if self.mode:
+                raise RuntimeError(f"{self.mode} profiling already running")
+            if mode not in PROFILE_MODES:
+                raise ValueError(f"Unknown profiling mode {mode}")
+            self.mode = mode
+            self._profiles = []
+            if mode == 'sample':
+                self._sampler = SamplingProfiler(interval)
+                self._sampler.start()
+            elif not PER_THREAD_PROFILES:
+                profile = cProfile.Profile()
+                profile.enable()
+                self._profiles.append(profile)
+            else:
+                self._generation += 1
+                self.pending = True
+        self.sync()
+
+    def sync(self):
+        """Bring the calling thread's cProfile in line with the session state."""
+        if not PER_THREAD_PROFILES:
+            return
+        ident = threading.get_ident()
+        profile = getattr(self._local, 'profile', None)
+        with self._lock:
+            if self.mode == 'cprofile' and getattr(self._local, 'generation', 0) != self._generation:
+                if profile:
+                    profile.disable()
+                profile = self._local.profile = cProfile.Profile()
+                self._local.generation = self._generation
+                self._profiles.append(profile)
+                self._live.add(ident)
+                profile.enable()
+            elif self.mode != 'cprofile' and profile:
+                profile.disable()
+                self._local.profile = None
+                self._live.discard(ident)
+            self.pending = self.mode == 'cprofile' or bool(self._live)
+
+    def stop(self) -> dict:
+        """End the session and write its results to a new file in our directory, returns a summary."""
+        with self._lock:
+            mode = self.mode
+            if not mode:
+                raise RuntimeError("No profiling session running")
+            self.mode = None
+            profiles, self._profiles = self._profiles, []
+            sampler, self._sampler = self._sampler, None
+        name = f"simp-{os.getpid()}-{time.time_ns()}.{'prof' if mode == 'cprofile' else 'folded'}"
+        path = os.path.abspath(os.path.join(self.directory, name))
+        if mode == 'sample':
+            sampler.stop()
+            sampler.dump(path)
+            return {'mode': mode, 'path': path, 'samples': sampler.samples}
+        if PER_THREAD_PROFILES:
+            # Other threads switch their profiles off on their next sync()
+            self.sync()
+        else:
+            profiles[0].disable()
+        stats = None
+        for profile in profiles:
+            if stats is None:
+                stats = pstats.Stats(_Snapshot(profile))
+            else:
+                stats.add(_Snapshot(profile))
+        if stats is None:
+            raise RuntimeError("No thread was profiled")
+        stats.dump_stats(path)
+        return {'mode': mode, 'path': path, 'threads': len(profiles)}
+
+
+class HandlerTimers:
+    """Call counts and durations for selected methods of one object.
+
+    enable() shadows each method with a timing wrapper in the instance
+    __dict__ and disable() removes the wrappers again, so while timing is
+    off calls go straight to the class methods at no extra cost.
+    """
+
+    def __init__(self, obj, names: tuple, clock=time.perf_counter):
+        self.obj = obj
+        self.names = names
+        self.clock = clock
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.calls = dict.fromkeys(names, 0)
+        self.total = dict.fromkeys(names, 0.0)
+        self.max = dict.fromkeys(names, 0.0)
+
+    def _wrap(self, name: str, method):
+        clock = self.clock
+
+        def timed(*args, **kwargs):
+            started = clock()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed = clock() - started
+                with self._lock:
+                    self.calls[name] += 1
+                    self.total[name] += elapsed
+                    if elapsed > self.max[name]:
+                        self.max[name] = elapsed
+        return timed
+
+    def enable(self):
+        if self.enabled:
+            return
+        for name in self.names:
+            method = getattr(type(self.obj), name).__get__(self.obj)
+            setattr(self.obj, name, self._wrap(name, method))
+        self.enabled = True
+
+    def disable(self):
+        for name in self.names:
+            self.obj.__dict__.pop(name, None)
+        self.enabled = False
+
+    def stats(self) -> dict:
+        stats = {}
+        with self._lock:
+            for name in self.names:
+                calls = self.calls[name]
+                if not calls:
+                    continue
+                stats[f"time_{name}_calls"] = calls
+                stats[f"time_{name}_mean_us"] = round(self.total[name] / calls * 1e6, 1)
+                stats[f"time_{name}_max_us"] = round(self.max[name] * 1e6, 1)
+        return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Control profiling of a running SIMP daemon")
+    parser.add_argument('action', choices=('start', 'stop', 'timing', 'stats'))
+    parser.add_argument('state', nargs='?', choices=('on', 'off'), help="for timing")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, help=f"client port of the daemon (default {CLIENT_DAEMON_PORT})")
+    parser.add_argument('--mode', choices=PROFILE_MODES, default='cprofile')
+    parser.add_argument('--interval', type=float, default=0.005, help="sampling interval in seconds")
+    parser.add_argument('--username', default='profiler', help="name to register with the daemon")
+    args = parser.parse_args()
+
+    if args.action == 'start':
+        cmd, kwargs = 'profile', {'action': 'start', 'mode': args.mode, 'interval': args.interval}
+    elif args.action == 'stop':
+        cmd, kwargs = 'profile', {'action': 'stop'}
+    elif args.action == 'timing':
+        cmd, kwargs = 'timing', {'action': args.state or 'on'}
+    else:
+        cmd, kwargs = 'stats', {}
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(TIMEOUT)
+    port = env_setting('CLIENT_PORT', args.port, CLIENT_DAEMON_PORT)
+    try:
+        if cmd != 'stats':
+            sock.sendto(build_client_daemon_message('connect', username=args.username).encode('ascii'), (args.host, port))
+            sock.recvfrom(65535)
+        sock.sendto(build_client_daemon_message(cmd, **kwargs).encode('ascii'), (args.host, port))
+        data, _ = sock.recvfrom(65535)
+    except socket.timeout:
+        sys.exit("No answer from the daemon")
+    reply = parse_client_daemon_message(data.decode('ascii'))
+    for key, value in reply.items():
+        print(f"{key:28} {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+import argparse
+import random
+import selectors
+import socket
+import sys
+import threading
+import time
+from simp_common import *
+from simp_timer import TimerWheel
+
+
+class ImpairmentProxy:
+    """UDP proxy between two SIMP daemons that impairs the traffic.
+
+    Side A talks to listen_addr, the proxy forwards to target_addr (side B)
+    from its own socket and relays B's answers back to the last A address.
+    Every datagram may be dropped, delayed (delay +/- jitter), duplicated
+    or held back for reordering. All decisions come from one seeded RNG and
+    are taken on a single thread, so a run is reproducible for the same
+    order of incoming datagrams.
+    """
+
+    def __init__(self, listen_addr: tuple, target_addr: tuple, loss=0.0, delay=0.0, jitter=0.0,
+                 duplicate=0.0, reorder=0.0, reorder_delay=None, seed=None, log=None):
+        self.target_addr = target_addr
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.duplicate = duplicate
+        self.reorder = reorder
+        # A reordered datagram is held back long enough to let the next one pass
+        self.reorder_delay = reorder_delay if reorder_delay is not None else max(2 * delay, 0.01)
+        self.rng = random.Random(seed)
+        self.log = log
+        self.front = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.front.bind(listen_addr)
+        self.front.setblocking(False)
+        self.back = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.back.bind(('', 0))
+        self.back.setblocking(False)
+        self.listen_addr = self.front.getsockname()
+        self.front_peer = None
+        self.timers = TimerWheel(tick=0.001)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.front, selectors.EVENT_READ, 'a->b')
+        self.selector.register(self.back, selectors.EVENT_READ, 'b->a')
+        self.running = True
+        self.thread = None
+        self.started = time.monotonic()
+        self.stats = {'forwarded': 0, 'dropped': 0, 'duplicated': 0, 'reordered': 0}
+
+    def start(self):
+        """Run the proxy on a background thread."""
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """Relay datagrams until stop() is called."""
+        while self.running:
+            for key, _ in self.selector.select(self.timers.tick):
+                self.drain(key.fileobj, key.data)
+            self.timers.advance()
+
+    def drain(self, sock: socket.socket, direction: str):
+        while True:
+            try:
+                data, addr = sock.recvfrom(65535)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                # ICMP port unreachable from a daemon that is not up yet
+                continue
+            if direction == 'a->b':
+                self.front_peer = addr
+                self.impair(data, direction, self.back, self.target_addr)
+            elif self.front_peer:
+                self.impair(data, direction, self.front, self.front_peer)
+
+    def impair(self, data: bytes, direction: str, sock: socket.socket, dest: tuple):
+        """Decide the fate of one datagram and schedule its delivery."""
+        if self.rng.random() < self.loss:
+            self.stats['dropped'] += 1
+            self.record(direction, 'drop', data)
+            return
+        copies = 1
+        if self.rng.random() < self.duplicate:
+            copies = 2
+            self.stats['duplicated'] += 1
+        for _ in range(copies):
+            delay = self.delay + self.rng.uniform(-self.jitter, self.jitter) if self.jitter else self.delay
+            action = 'pass'
+            if self.rng.random() < self.reorder:
+                delay += self.reorder_delay
+                action = 'reorder'
+                self.stats['reordered'] += 1
+            delay = max(0.0, delay)
+            self.record(direction, f"{action} delay={delay * 1000:.1f}ms" + (" dup" if copies > 1 else ""), data)
+            if delay:
+                self.timers.schedule(delay, self.forward, sock, data, dest)
+            else:
+                self.forward(sock, data, dest)
+
+    def forward(self, sock: socket.socket, data: bytes, dest: tuple):
+        try:
+            sock.sendto(data, dest)
+            self.stats['forwarded'] += 1
+        except OSError:
+            pass
+
+    def record(self, direction: str, action: str, data: bytes):
+        """Write one line per decision to the log, if any."""
+        if not self.log:
+            return
+        header = f"type={data[0]} op={data[1]} seq={data[2]}" if len(data) >= HEADER_SIZE else "short"
+        self.log.write(f"{time.monotonic() - self.started:.6f} {direction} {action} len={len(data)} {header}\n")
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join(timeout=1)
+        self.selector.close()
+        self.front.close()
+        self.back.close()
+
+
+def parse_addr(value: str) -> tuple:
+    host, _, port = value.rpartition(':')
+    return (host or '127.0.0.1', int(port))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="UDP impairment proxy for SIMP daemons")
+    parser.add_argument('--listen', type=parse_addr, required=True, help="host:port side A sends to")
+    parser.add_argument('--target', type=parse_addr, required=True, help="host:port of side B's daemon")
+    parser.add_argument('--loss', type=float, default=0.0, help="drop probability")
+    parser.add_argument('--delay', type=float, default=0.0, help="one-way delay in seconds")
+    parser.add_argument('--jitter', type=float, default=0.0, help="+/- jitter in seconds")
+    parser.add_argument('--duplicate', type=float, default=0.0, help="duplication probability")
+    parser.add_argument('--reorder', type=float, default=0.0, help="reordering probability")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--log', default=None, help="file for the decision log ('-' for stdout)")
+    args = parser.parse_args()
+
+    log = None
+    if args.log == '-':
+        log = sys.stdout
+    elif args.log:
+        log = open(args.log, 'w')
+    proxy = ImpairmentProxy(args.listen, args.target, args.loss, args.delay, args.jitter,
+                            args.duplicate, args.reorder, seed=args.seed, log=log)
+    print(f"Impairment proxy {proxy.listen_addr} -> {args.target}")
+    try:
+        proxy.run()
+    except KeyboardInterrupt:
+        print(f"\n{proxy.stats}")
+        proxy.stop()
+
+
+if __name__ == "__main__":
+    main()
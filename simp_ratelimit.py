@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, at most `burst` saved up."""
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def refill(self, now: float):
+        if now > self.stamp:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+
+    def take(self, now: float, cost: float = 1.0) -> bool:
+        """Spend cost tokens if there are enough of them."""
+        self.refill(now)
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+
+class RateLimiter:
+    """Per-source and global token buckets in front of the daemon socket.
+
+    Source buckets live in an LRU table bounded by max_sources, so a flood
+    of spoofed addresses costs a bounded amount of memory: the least
+    recently seen source is evicted (it simply starts with a full bucket
+    if it comes back). A datagram is checked against its source bucket
+    first, so one noisy source cannot drain the global bucket for
+    everyone else.
+    """
+
+    def __init__(self, source_rate: float, global_rate: float, max_sources: int = 4096,
+                 source_burst: float = None, global_burst: float = None, clock=time.monotonic):
+        self.source_rate = source_rate
+        self.source_burst = source_burst or 2 * source_rate
+        self.max_sources = max_sources
+        self.clock = clock
+        self.global_bucket = TokenBucket(global_rate, global_burst or 2 * global_rate, clock())
+        self.sources = OrderedDict()
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.limited_source = 0
+        self.limited_global = 0
+        self.evicted = 0
+
+    def allow(self, addr) -> bool:
+        """Account one datagram from addr, False if it should be dropped."""
+        now = self.clock()
+        with self._lock:
+            bucket = self.sources.get(addr)
+            if bucket is None:
+                if len(self.sources) >= self.max_sources:
+                    self.sources.popitem(last=False)
+                    self.evicted += 1
+                bucket = self.sources[addr] = TokenBucket(self.source_rate, self.source_burst, now)
+            else:
+                self.sources.move_to_end(addr)
+            if not bucket.take(now):
+                self.limited_source += 1
+                return False
+            if not self.global_bucket.take(now):
+                self.limited_global += 1
+                return False
+            self.allowed += 1
+            return True
+
+    def under_load(self) -> bool:
+        """True once more than half of the global burst has been used up."""
+        with self._lock:
+            self.global_bucket.refill(self.clock())
+            return self.global_bucket.tokens < self.global_bucket.burst / 2
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'rl_allowed': self.allowed,
+                'rl_limited_source': self.limited_source,
+                'rl_limited_global': self.limited_global,
+                'rl_sources': len(self.sources),
+                'rl_evicted': self.evicted,
+            }
+
+
+class SynCookies:
+    """Stateless address validation for SYNs while the daemon is under load.
+
+    A cookie is an HMAC of the source address, the username and the
+    current epoch, so checking one needs no stored state. Cookies from
+    the previous epoch are still accepted to cover a round trip across
+    an epoch boundary.
+    """
+
+    def __init__(self, lifetime: float = 10.0, secret: bytes = None, clock=time.time):
+        self.lifetime = lifetime
+        self.secret = secret or os.urandom(16)
+        self.clock = clock
+
+    def _cookie(self, addr: tuple, username: str, epoch: int) -> str:
+        data = f"{addr[0]}:{addr[1]}:{username}:{epoch}".encode()
+        return hmac.new(self.secret, data, hashlib.sha256).hexdigest()[:16]
+
+    def make(self, addr: tuple, username: str) -> str:
+        return self._cookie(addr, username, int(self.clock() // self.lifetime))
+
+    def check(self, cookie: str, addr: tuple, username: str) -> bool:
+        epoch = int(self.clock() // self.lifetime)
+        return any(hmac.compare_digest(cookie, self._cookie(addr, username, e)) for e in (epoch, epoch - 1))
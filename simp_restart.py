@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""Hot restart: hand a running daemon's sockets and sessions over to a new process.
+
+The running daemon listens on a Unix socket (--handover-socket PATH).
+A new daemon started with --take-over PATH connects to it, and
+
+1. the old daemon stops reading its UDP sockets, lets its worker handle
+   everything already received and checkpoints its sessions to
+   PATH.snapshot;
+2. it passes both bound UDP sockets over the Unix socket (SCM_RIGHTS)
+   together with the snapshot path;
+3. the new daemon adopts the sockets, restores the snapshot, starts and
+   replies 'ok', upon which the old one stops. Without the 'ok' the old
+   daemon carries on serving.
+
+Datagrams that arrive in between wait in the kernel socket buffers, so
+peers see a short delay at most. File transfers are not carried over:
+they fail with reason 'restart' and resume when the file is offered again.
+"""
+
+import base64
+import json
+import os
+import socket
+import threading
+
+SNAPSHOT_VERSION = 1
+HANDOVER_TIMEOUT = 5  # seconds the old daemon waits for the successor's 'ok'
+
+
+def write_snapshot(path: str, state: dict):
+    """Write a checkpoint atomically, as compact JSON."""
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(dict(state, version=SNAPSHOT_VERSION), f, separators=(',', ':'))
+    os.replace(tmp, path)
+
+
+def read_snapshot(path: str) -> dict:
+    with open(path) as f:
+        state = json.load(f)
+    if state.get('version') != SNAPSHOT_VERSION:
+        raise ValueError(f"Unsupported snapshot version {state.get('version')}")
+    return state
+
+
+def encode_bytes(data: bytes) -> str:
+    return base64.b64encode(data).decode('ascii')
+
+
+def decode_bytes(text: str) -> bytes:
+    return base64.b64decode(text)
+
+
+def send_handover(conn: socket.socket, socks: tuple, snapshot_path: str):
+    """Pass the sockets and the snapshot path to the successor on conn."""
+    message = json.dumps({'snapshot': snapshot_path}).encode('ascii')
+    socket.send_fds(conn, [message], [sock.fileno() for sock in socks])
+
+
+def receive_handover(path: str, timeout: float = HANDOVER_TIMEOUT) -> tuple:
+    """Connect to the daemon listening at path and take its sockets and snapshot.
+
+    Returns (conn, sockets, state); reply 'ok' on conn once running.
+    Raises OSError or ValueError if the handover did not happen.
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.settimeout(timeout)
+        conn.connect(path)
+        message, fds, _, _ = socket.recv_fds(conn, 4096, 2)
+        if len(fds) != 2:
+            raise ValueError(f"Expected 2 sockets, got {len(fds)}")
+        socks = tuple(socket.socket(fileno=fd) for fd in fds)
+        state = read_snapshot(json.loads(message)['snapshot'])
+    except Exception:
+        conn.close()
+        raise
+    return conn, socks, state
+
+
+class HandoverServer:
+    """Waits on a Unix socket for a successor and calls hand_over(conn) when one connects."""
+
+    def __init__(self, path: str, hand_over):
+        self.path = path
+        self.snapshot_path = f"{path}.snapshot"
+        self.hand_over = hand_over
+        self.sock = None
+        self._inode = None
+
+    def start(self):
+        if os.path.exists(self.path):
+            # Left over by a crashed daemon, or ours now that we are the successor
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen(1)
+        self._inode = os.stat(self.path).st_ino
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return  # closed by stop()
+            with conn:
+                conn.settimeout(HANDOVER_TIMEOUT)
+                if self.hand_over(conn):
+                    return
+
+    def stop(self):
+        if not self.sock:
+            return
+        try:
+            # Wakes up the accept() in _run
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        self.sock = None
+        try:
+            # The successor may already have bound its own socket at path
+            if os.stat(self.path).st_ino == self._inode:
+                os.unlink(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+import struct
+import tempfile
+import threading
+from collections import deque
+
+POLICIES = ('reject', 'drop_oldest', 'spill')
+SPILL_LENGTH = struct.Struct('>I')
+
+
+class MemoryBudget:
+    """Byte budget shared by the buffers of a daemon, or of all daemons in a process."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self.refused = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, size: int) -> bool:
+        """Take size bytes from the budget, False if they are not available."""
+        with self._lock:
+            if self.used + size > self.limit:
+                self.refused += 1
+                return False
+            self.used += size
+            if self.used > self.peak:
+                self.peak = self.used
+            return True
+
+    def release(self, size: int):
+        with self._lock:
+            self.used -= size
+
+    def stats(self) -> dict:
+        return {'memory_budget': self.limit, 'memory_used': self.used, 'memory_peak': self.peak,
+                'memory_refused': self.refused}
+
+
+class RingBuffer:
+    """FIFO of byte records in one buffer allocated up front.
+
+    Records are copied into a bytearray of capacity bytes, a record that
+    does not fit before the end of the buffer starts over at offset 0.
+    The buffer is reserved from budget when created, so the memory a
+    session holds for retained messages is fixed no matter how slow or
+    dead its peer is. When a record does not fit, or max_items are
+    stored, the policy decides:
+
+    - 'reject': append() returns False, the caller pushes back;
+    - 'drop_oldest': the oldest records are dropped, each passed to on_drop;
+    - 'spill': the record goes to an unlinked temporary file, and so do
+      the following ones until the file is read empty, keeping FIFO order.
+    """
+
+    def __init__(self, capacity: int, max_items: int = None, policy: str = 'reject',
+                 budget: MemoryBudget = None, on_drop=None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown overflow policy {policy!r}, expected one of {', '.join(POLICIES)}")
+        if budget and not budget.reserve(capacity):
+            raise MemoryError(f"Memory budget exhausted, cannot allocate {capacity} bytes")
+        self.capacity = capacity
+        self.max_items = max_items or capacity
+        self.policy = policy
+        self.budget = budget
+        self.on_drop = on_drop
+        self._buf = bytearray(capacity)
+        self._view = memoryview(self._buf)
+        self._index = deque()  # (offset, length) of the stored records, oldest first
+        self._tail = 0
+        self._wrapped = False
+        self.used = 0
+        self._spill = None
+        self._spill_read = 0
+        self._spill_write = 0
+        self.spilled = 0  # records currently on disk
+        self.counters = {'appended': 0, 'dropped': 0, 'rejected': 0, 'spilled': 0}
+
+    def __len__(self) -> int:
+        return len(self._index) + self.spilled
+
+    def _place(self, size: int):
+        """Offset where a record of size bytes fits, or None."""
+        if not self._index:
+            self._tail, self._wrapped = 0, False
+            return 0 if size <= self.capacity else None
+        head = self._index[0][0]
+        if self._wrapped:
+            return self._tail if self._tail + size <= head else None
+        if self._tail + size <= self.capacity:
+            return self._tail
+        if size <= head:
+            self._wrapped = True
+            return 0
+        return None
+
+    def _store(self, data: bytes) -> bool:
+        if len(self._index) >= self.max_items:
+            return False
+        offset = self._place(len(data))
+        if offset is None:
+            return False
+        self._view[offset:offset + len(data)] = data
+        self._index.append((offset, len(data)))
+        self._tail = offset + len(data)
+        self.used += len(data)
+        return True
+
+    def append(self, data: bytes) -> bool:
+        """Store a record, False if the policy rejected it."""
+        if len(data) > self.capacity and self.policy != 'spill':
+            self.counters['rejected'] += 1
+            return False
+        if self.spilled or not self._store(data):
+            if self.policy == 'reject':
+                self.counters['rejected'] += 1
+                return False
+            if self.policy == 'spill':
+                self._spill_append(data)
+                self.counters['appended'] += 1
+                return True
+            while not self._store(data):
+                dropped = self._pop_stored()
+                self.counters['dropped'] += 1
+                if self.on_drop:
+                    self.on_drop(dropped)
+        self.counters['appended'] += 1
+        return True
+
+    def _pop_stored(self) -> bytes:
+        offset, size = self._index.popleft()
+        data = bytes(self._view[offset:offset + size])
+        self.used -= size
+        if self._index and self._index[0][0] < offset:
+            # The oldest record is now the one that wrapped to the start
+            self._wrapped = False
+        return data
+
+    def popleft(self) -> bytes:
+        """Remove and return the oldest record. Raises IndexError if empty."""
+        if self._index:
+            return self._pop_stored()
+        if self.spilled:
+            return self._spill_pop()
+        raise IndexError("pop from an empty RingBuffer")
+
+    def _spill_append(self, data: bytes):
+        if self._spill is None:
+            self._spill = tempfile.TemporaryFile()
+        self._spill.seek(self._spill_write)
+        self._spill.write(SPILL_LENGTH.pack(len(data)) + data)
+        self._spill_write = self._spill.tell()
+        self.spilled += 1
+        self.counters['spilled'] += 1
+
+    def _spill_pop(self) -> bytes:
+        self._spill.seek(self._spill_read)
+        size, = SPILL_LENGTH.unpack(self._spill.read(SPILL_LENGTH.size))
+        data = self._spill.read(size)
+        self._spill_read = self._spill.tell()
+        self.spilled -= 1
+        if not self.spilled:
+            # Read empty: reuse the file from the start
+            self._spill.truncate(0)
+            self._spill_read = self._spill_write = 0
+        return data
+
+    def items(self) -> list:
+        """All records, oldest first, without removing them."""
+        records = [bytes(self._view[offset:offset + size]) for offset, size in self._index]
+        if self.spilled:
+            self._spill.seek(self._spill_read)
+            for _ in range(self.spilled):
+                size, = SPILL_LENGTH.unpack(self._spill.read(SPILL_LENGTH.size))
+                records.append(self._spill.read(size))
+        return records
+
+    def clear(self):
+        self._index.clear()
+        self._tail, self._wrapped, self.used = 0, False, 0
+        if self._spill:
+            self._spill.truncate(0)
+        self._spill_read = self._spill_write = self.spilled = 0
+
+    def close(self):
+        """Clear and give the buffer back to the budget."""
+        self.clear()
+        if self._spill:
+            self._spill.close()
+            self._spill = None
+        if self.budget and self._buf is not None:
+            self.budget.release(self.capacity)
+        self._view.release()
+        self._buf = None
+
+    def stats(self, prefix: str) -> dict:
+        stats = {f"{prefix}_capacity": self.capacity, f"{prefix}_bytes": self.used,
+                 f"{prefix}_items": len(self), f"{prefix}_spilled_items": self.spilled}
+        stats.update({f"{prefix}_{key}": value for key, value in self.counters.items()})
+        return stats
@@ -0,0 +1,495 @@
+#!/usr/bin/env python3
+"""Discrete-event simulation of SIMP daemons on modelled links.
+
+Real SimpDaemon objects run on a virtual clock: their timers and the
+datagrams between them are events in one queue, handled in time order
+without any waiting, so an hour of traffic takes seconds. Links between
+hosts have a propagation delay with optional jitter, random loss and a
+bottleneck bandwidth with a bounded queue; datagrams between a daemon
+and its client on the same host arrive at once.
+
+A run sets up three hosts: alice invites bob, then sends --rate messages
+per second for --duration virtual seconds through stop-and-wait, while
+carol's invitations to bob are turned down as busy. At the end alice
+quits and bob sees the FIN. Each run reports throughput, latency
+percentiles, retransmissions and the handshake, busy and FIN times.
+
+Every option takes a comma-separated list; the runner sweeps all
+combinations:
+
+    python simp_sim.py --loss 0,0.02,0.1 --timeout 0.2,0.5,2 --duration 3600
+"""
+
+import argparse
+import heapq
+import itertools
+import json
+import random
+import time
+from simp_common import *
+from simp_daemon import SimpDaemon
+from simp_metrics import LatencyStats
+
+IP_UDP_OVERHEAD = 28  # bytes a datagram takes on the link beyond its payload
+# Simulation parameters; every other key of a configuration is a SimpDaemon setting
+DEFAULTS = {
+    'delay': 0.02,  # one-way propagation delay in seconds
+    'jitter': 0.0,  # extra delay, uniform in [0, jitter)
+    'loss': 0.0,  # probability that a datagram is lost
+    'bandwidth': 1e6,  # bits per second, 0 for unlimited
+    'queue': 64 << 10,  # bytes waiting for the link before datagrams are dropped, 0 for unlimited
+    'rate': 10.0,  # messages per second offered by alice's client
+    'duration': 60.0,  # virtual seconds of offered traffic
+    'size': 100,  # characters per message
+    'busy_probes': 5,  # invitations from carol during the chat
+    'seed': 1,
+}
+DAEMON_SETTINGS = ('timeout', 'handshake_timeout', 'keepalive_interval', 'keepalive_probes', 'send_queue_size',
+                   'session_buffer', 'buffer_policy', 'extensions')
+
+
+class Simulator:
+    """Event queue on a virtual clock. Events at the same time run in the order they were scheduled."""
+
+    def __init__(self):
+        self.now = 0.0
+        self._events = []
+        self._seq = itertools.count()
+        self.events_run = 0
+        self.stopped = False
+
+    def clock(self) -> float:
+        return self.now
+
+    def schedule(self, delay: float, fn, *args) -> list:
+        """Run fn(*args) delay virtual seconds from now. Returns the event, for cancel()."""
+        event = [self.now + max(0.0, delay), next(self._seq), fn, args]
+        heapq.heappush(self._events, event)
+        return event
+
+    def cancel(self, event: list):
+        if event is not None:
+            event[2] = None
+
+    def stop(self):
+        self.stopped = True
+
+    def run(self, until: float = float('inf')) -> float:
+        """Run events until none are left, stop() or the clock would pass until. Returns the time."""
+        self.stopped = False
+        while self._events and not self.stopped:
+            event = heapq.heappop(self._events)
+            when, _, fn, args = event
+            if fn is None:
+                continue
+            if when > until:
+                heapq.heappush(self._events, event)
+                self.now = until
+                break
+            self.now = when
+            fn(*args)
+            self.events_run += 1
+        return self.now
+
+
+class SimTimers:
+    """The timer interface of TimerWheel on a Simulator, firing at the exact deadlines.
+
+    on_fire runs after every callback; for a daemon it is the
+    dispatcher's run_tasks(), which plays the worker thread.
+    """
+
+    def __init__(self, sim: Simulator):
+        self.sim = sim
+        self.on_fire = None
+        self.fired = 0
+        self.active = 0
+
+    def schedule(self, delay: float, callback, *args) -> list:
+        self.active += 1
+        return self.sim.schedule(delay, self._fire, callback, args)
+
+    def _fire(self, callback, args: tuple):
+        self.active -= 1
+        self.fired += 1
+        callback(*args)
+        if self.on_fire:
+            self.on_fire()
+
+    def cancel(self, event: list):
+        if event is not None and event[2] is not None:
+            self.active -= 1
+        self.sim.cancel(event)
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def stats(self) -> dict:
+        return {'timers_active': self.active, 'timers_fired': self.fired, 'timer_lag_mean_ms': 0.0,
+                'timer_lag_max_ms': 0.0}
+
+
+class Link:
+    """One direction between two hosts: a FIFO queue in front of a bottleneck, then delay and loss."""
+
+    def __init__(self, sim: Simulator, rng: random.Random, delay: float = 0.02, jitter: float = 0.0,
+                 loss: float = 0.0, bandwidth: float = 0, queue: int = 0):
+        self.sim = sim
+        self.rng = rng
+        self.delay = delay
+        self.jitter = jitter
+        self.loss = loss
+        self.bandwidth = bandwidth
+        self.queue = queue
+        self.free_at = 0.0  # when the bottleneck has sent everything queued so far
+        self.counters = {'sent': 0, 'lost': 0, 'overflowed': 0, 'bytes': 0}
+
+    def transmit(self, size: int):
+        """Virtual time at which a datagram of size bytes arrives, None if it is dropped."""
+        now = self.sim.now
+        start = max(now, self.free_at)
+        if self.bandwidth:
+            if self.queue and (start - now) * self.bandwidth / 8 > self.queue:
+                self.counters['overflowed'] += 1
+                return None
+            self.free_at = start + (size + IP_UDP_OVERHEAD) * 8 / self.bandwidth
+        self.counters['sent'] += 1
+        self.counters['bytes'] += size
+        if self.loss and self.rng.random() < self.loss:
+            self.counters['lost'] += 1
+            return None
+        departed = self.free_at if self.bandwidth else now
+        return departed + self.delay + self.jitter * self.rng.random()
+
+
+class SimEndpoint:
+    """A transport bound on a SimNetwork. Datagrams are pushed to handler(data, addr) when they arrive."""
+
+    batched = False
+
+    def __init__(self, network, addr: tuple):
+        self.network = network
+        self.addr = addr
+        self.handler = None
+        self.closed = False
+
+    def local_address(self) -> tuple:
+        return self.addr
+
+    def send(self, data: bytes, addr: tuple):
+        self.network.send(bytes(data), self.addr, addr)
+
+    def send_parts(self, parts: list, addr: tuple):
+        self.send(b''.join(parts), addr)
+
+    def send_many(self, datagrams: list, addr: tuple):
+        for parts in datagrams:
+            self.send(b''.join(parts), addr)
+
+    def interrupt(self):
+        pass
+
+    def close(self, shutdown: bool = True):
+        self.closed = True
+        self.network.endpoints.pop(self.addr, None)
+
+
+class SimNetwork:
+    """Transport factory for simulated daemons, with a Link per ordered pair of hosts.
+
+    Links are created with the default parameters on first use;
+    set_link() gives a pair of hosts its own.
+    """
+
+    def __init__(self, sim: Simulator, seed: int = 1, **link_defaults):
+        self.sim = sim
+        self.rng = random.Random(seed)
+        self.link_defaults = link_defaults
+        self.links = {}
+        self.endpoints = {}
+        self._next_port = 40000
+
+    def bind(self, host: str, port: int = 0, rcvbuf: int = None) -> SimEndpoint:
+        if not port:
+            port = self._next_port
+            self._next_port += 1
+        endpoint = SimEndpoint(self, (host, port))
+        self.endpoints[(host, port)] = endpoint
+        return endpoint
+
+    def link(self, src_host: str, dest_host: str) -> Link:
+        link = self.links.get((src_host, dest_host))
+        if link is None:
+            link = self.links[(src_host, dest_host)] = Link(self.sim, self.rng, **self.link_defaults)
+        return link
+
+    def set_link(self, src_host: str, dest_host: str, both: bool = True, **params):
+        self.links[(src_host, dest_host)] = Link(self.sim, self.rng, **dict(self.link_defaults, **params))
+        if both:
+            self.set_link(dest_host, src_host, False, **params)
+
+    def send(self, data: bytes, src: tuple, dest: tuple):
+        if src[0] == dest[0]:
+            self.sim.schedule(0, self.deliver, data, src, dest)
+            return
+        arrival = self.link(src[0], dest[0]).transmit(len(data))
+        if arrival is not None:
+            self.sim.schedule(arrival - self.sim.now, self.deliver, data, src, dest)
+
+    def deliver(self, data: bytes, src: tuple, dest: tuple):
+        endpoint = self.endpoints.get(dest)
+        if endpoint and endpoint.handler:
+            endpoint.handler(data, src)
+
+    def stats(self) -> dict:
+        totals = dict.fromkeys(('sent', 'lost', 'overflowed', 'bytes'), 0)
+        for link in self.links.values():
+            for key, value in link.counters.items():
+                totals[key] += value
+        return totals
+
+
+class SimNode:
+    """A SimpDaemon on a simulated host, with a scripted client next to it.
+
+    The simulator calls the daemon's handlers where its listener
+    threads would, and runs the tasks its timers submit right after
+    them, as the dispatcher worker would.
+    """
+
+    def __init__(self, sim: Simulator, network: SimNetwork, host: str, username: str, **settings):
+        self.sim = sim
+        self.timers = SimTimers(sim)
+        settings.setdefault('log_level', 'warning')
+        # Session IDs and transfer IDs, drawn from the network's seed so a run can be repeated
+        settings.setdefault('rng', random.Random(network.rng.getrandbits(32)))
+        self.daemon = SimpDaemon(host=host, daemon_port=DAEMON_PORT, client_host=host, client_port=CLIENT_DAEMON_PORT,
+                                 transport=network, clock=sim.clock, timers=self.timers, **settings)
+        self.timers.on_fire = self.daemon.dispatcher.run_tasks
+        self.daemon.daemon_transport.handler = self.datagram
+        self.daemon.client_transport.handler = self.client_command
+        self.client = network.bind(host)
+        self.client.handler = self.notification
+        self.handlers = {}
+        self.command('connect', username=username)
+
+    def datagram(self, data: bytes, addr: tuple):
+        self.daemon.handle_daemon_message(data, addr)
+        self.daemon.dispatcher.run_tasks()
+
+    def client_command(self, data: bytes, addr: tuple):
+        self.daemon.handle_client_message(data.decode('ascii'), addr)
+        self.daemon.dispatcher.run_tasks()
+
+    def command(self, cmd: str, **kwargs):
+        """Send a command from the client to the daemon."""
+        msg = build_client_daemon_message(cmd, **kwargs)
+        self.client.send(msg.encode('ascii'), self.daemon.client_transport.local_address())
+
+    def on(self, command: str, handler):
+        self.handlers[command] = handler
+
+    def notification(self, data: bytes, addr: tuple):
+        msg = parse_client_daemon_message(data.decode('ascii'))
+        handler = self.handlers.get(msg['command'])
+        if handler:
+            handler(msg)
+
+
+def simulate(config: dict) -> dict:
+    """Run one configuration (DEFAULTS updated with config) and return its results."""
+    config = dict(DEFAULTS, **config)
+    settings = {key: config[key] for key in DAEMON_SETTINGS if key in config}
+    sim = Simulator()
+    network = SimNetwork(sim, config['seed'], delay=config['delay'], jitter=config['jitter'], loss=config['loss'],
+                         bandwidth=config['bandwidth'], queue=config['queue'])
+    alice = SimNode(sim, network, '10.0.0.1', 'alice', **settings)
+    bob = SimNode(sim, network, '10.0.0.2', 'bob', **settings)
+    carol = SimNode(sim, network, '10.0.0.3', 'carol', **settings)
+    bob_addr = ('10.0.0.2', DAEMON_PORT)
+    messages = int(config['rate'] * config['duration'])
+    sent_at = {}
+    latency = LatencyStats(window=None)
+    busy = LatencyStats(window=None)
+    result = {'connected': False, 'connect_ms': None, 'offered': messages, 'delivered': 0, 'send_rejected': 0,
+              'send_failed': 0, 'session_lost': False, 'fin_ms': None}
+    timing = {'probe': None, 'quit': None, 'first_sent': None, 'last_delivered': None}
+
+    def send(i: int):
+        if not alice.daemon.in_chat:
+            return
+        if i == 0:
+            timing['first_sent'] = sim.now
+        sent_at[i] = sim.now
+        alice.command('send', text=f"{i}:".ljust(config['size'], 'x'), id=str(i))
+        if i + 1 < messages:
+            sim.schedule(1 / config['rate'], send, i + 1)
+        else:
+            sim.schedule(0, check_done)
+
+    def check_done():
+        # Quit once every message is delivered, turned away or given up
+        settled = result['delivered'] + result['send_rejected'] + result['send_failed']
+        if settled >= len(sent_at) == messages and timing['quit'] is None:
+            timing['quit'] = sim.now
+            alice.command('quit')
+
+    def connected(msg: dict):
+        result['connected'] = True
+        result['connect_ms'] = sim.now * 1000
+        if messages:
+            send(0)
+        else:
+            check_done()
+        probes = config['busy_probes']
+        for k in range(probes):
+            sim.schedule((k + 0.5) * config['duration'] / probes, probe)
+
+    def probe():
+        timing['probe'] = sim.now
+        carol.command('invite', ip=bob_addr[0], port=bob_addr[1])
+
+    def refused(msg: dict):
+        if timing['probe'] is not None:
+            busy.add(sim.now - timing['probe'])
+            timing['probe'] = None
+
+    def rejected(msg: dict):
+        result['send_rejected'] += 1
+        check_done()
+
+    def delivered(msg: dict):
+        i = int(msg['text'].split(':', 1)[0])
+        latency.add(sim.now - sent_at[i])
+        result['delivered'] += 1
+        timing['last_delivered'] = sim.now
+        check_done()
+
+    def alice_disconnected(msg: dict):
+        if timing['quit'] is None:
+            # Before we quit: the handshake failed, or the session timed out and
+            # took the messages not yet delivered with it
+            result['session_lost'] = result['connected']
+            if result['connected']:
+                result['send_failed'] = len(sent_at) - result['delivered'] - result['send_rejected']
+            sim.stop()
+
+    def bob_disconnected(msg: dict):
+        if timing['quit'] is not None:
+            result['fin_ms'] = (sim.now - timing['quit']) * 1000
+        else:
+            result['session_lost'] = True
+        sim.stop()
+
+    alice.on('connected', connected)
+    alice.on('busy', rejected)
+    alice.on('disconnected', alice_disconnected)
+    alice.on('error', lambda msg: alice_disconnected(msg) if not result['connected'] else None)
+    bob.on('invitation', lambda msg: bob.command('accept', ip=msg['ip'], port=msg['port'])
+           if msg['username'] == 'alice' else None)
+    bob.on('message', delivered)
+    bob.on('disconnected', bob_disconnected)
+    carol.on('error', refused)
+    carol.on('disconnected', refused)
+    alice.command('invite', ip=bob_addr[0], port=bob_addr[1])
+
+    started = time.perf_counter()
+    # Leave room for the last retransmissions and the FIN after the offered traffic
+    limit = config['duration'] * 2 + alice.daemon.handshake_timeout + alice.daemon.timeout * MAX_RETRIES * 4
+    try:
+        sim.run(until=limit)
+    finally:
+        for node in (alice, bob, carol):
+            node.daemon.stop()
+    wall = time.perf_counter() - started
+
+    stats = alice.daemon.stats()
+    span = (timing['last_delivered'] or 0) - (timing['first_sent'] or 0)
+    link = network.stats()
+    result.update({
+        'throughput_msg_s': result['delivered'] / span if span > 0 else 0.0,
+        'goodput_kbit_s': result['delivered'] * config['size'] * 8 / span / 1000 if span > 0 else 0.0,
+        'lat_mean_ms': latency.total / latency.count * 1000 if latency.count else 0.0,
+        'lat_p50_ms': latency.percentile(50) * 1000,
+        'lat_p90_ms': latency.percentile(90) * 1000,
+        'lat_p99_ms': latency.percentile(99) * 1000,
+        'lat_max_ms': latency.max * 1000,
+        'retransmits': stats['retransmits'],
+        'retransmit_ratio': stats['retransmits'] / max(1, result['delivered']),
+        'syn_retransmits': stats['syn_retransmits'] + carol.daemon.counters['syn_retransmits'],
+        'syn_ack_retransmits': bob.daemon.counters['syn_ack_retransmits'],
+        'busy_rejections': busy.count,
+        'busy_p50_ms': busy.percentile(50) * 1000,
+        'datagrams': link['sent'],
+        'lost': link['lost'] + link['overflowed'],
+        'sim_s': sim.now,
+        'wall_s': wall,
+        'events': sim.events_run,
+    })
+    return {'config': config, 'result': result}
+
+
+def sweep(grid: dict):
+    """Yield simulate() of every combination of the values in grid, e.g. {'loss': [0, 0.1], 'timeout': [0.5, 2]}."""
+    keys = list(grid)
+    for values in itertools.product(*(grid[key] for key in keys)):
+        yield simulate(dict(zip(keys, values)))
+
+
+def values(cast):
+    """argparse type for a comma-separated list."""
+    return lambda text: [cast(value) for value in text.split(',')]
+
+
+# Result, heading and decimals of the columns printed per configuration
+COLUMNS = (('delivered', 'deliv', 0), ('send_rejected', 'busy', 0), ('send_failed', 'failed', 0),
+           ('throughput_msg_s', 'msg/s', 2), ('lat_p50_ms', 'p50_ms', 1), ('lat_p90_ms', 'p90_ms', 1),
+           ('lat_p99_ms', 'p99_ms', 1), ('retransmits', 'retx', 0), ('retransmit_ratio', 'retx/msg', 3),
+           ('connect_ms', 'conn_ms', 1), ('busy_p50_ms', 'refuse_ms', 1), ('fin_ms', 'fin_ms', 1),
+           ('wall_s', 'wall_s', 2))
+
+
+def fmt_cell(value, decimals: int) -> str:
+    if value is None:
+        return f"{'-':>9}"
+    return f"{value:>9.{decimals}f}" if decimals else f"{round(value):>9}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--delay', type=values(float), help=f"one-way delay in seconds (default {DEFAULTS['delay']})")
+    parser.add_argument('--jitter', type=values(float), help="extra random delay in seconds (default 0)")
+    parser.add_argument('--loss', type=values(float), help="datagram loss probability (default 0)")
+    parser.add_argument('--bandwidth', type=values(float), help="bits per second, 0 unlimited (default 1e6)")
+    parser.add_argument('--queue', type=values(int), help=f"link queue in bytes (default {DEFAULTS['queue']})")
+    parser.add_argument('--rate', type=values(float), help=f"messages per second (default {DEFAULTS['rate']})")
+    parser.add_argument('--duration', type=values(float), help=f"virtual seconds (default {DEFAULTS['duration']})")
+    parser.add_argument('--size', type=values(int), help=f"characters per message (default {DEFAULTS['size']})")
+    parser.add_argument('--busy-probes', type=values(int), help="invitations turned down as busy (default 5)")
+    parser.add_argument('--seed', type=values(int), help="random seed (default 1)")
+    parser.add_argument('--timeout', type=values(float), help=f"retransmission timeout (default {TIMEOUT})")
+    parser.add_argument('--handshake-timeout', type=values(float), help=f"connect deadline (default {HANDSHAKE_TIMEOUT})")
+    parser.add_argument('--send-queue-size', type=values(int), help=f"queued messages (default {SEND_QUEUE_SIZE})")
+    parser.add_argument('--keepalive-interval', type=values(float), help=f"0 disables (default {KEEPALIVE_INTERVAL})")
+    parser.add_argument('--json', metavar='PATH', help="also write every configuration and result as JSON lines")
+    args = parser.parse_args()
+
+    grid = {key: value for key, value in vars(args).items() if key != 'json' and value is not None}
+    swept = [key for key, value in grid.items() if len(value) > 1]
+    print("".join(f"{key:>12} " for key in swept) + " ".join(f"{heading:>9}" for _, heading, _ in COLUMNS))
+    runs = []
+    for run in sweep(grid):
+        runs.append(run)
+        print("".join(f"{run['config'][key]:>12} " for key in swept)
+              + " ".join(fmt_cell(run['result'][name], decimals) for name, _, decimals in COLUMNS), flush=True)
+    if args.json:
+        with open(args.json, 'w') as f:
+            for run in runs:
+                f.write(json.dumps(run) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Each level of the wheel has 2**WHEEL_BITS slots
+WHEEL_BITS = 6
+WHEEL_SIZE = 1 << WHEEL_BITS
+WHEEL_MASK = WHEEL_SIZE - 1
+
+
+class Timer:
+    """A single scheduled callback. Returned by TimerWheel.schedule()."""
+    __slots__ = ('deadline', 'expires', 'callback', 'args', 'cancelled', 'slot')
+
+    def __init__(self, deadline: float, expires: int, callback, args: tuple):
+        self.deadline = deadline
+        self.expires = expires
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.slot = None
+
+    def cancel(self):
+        """Mark the timer as cancelled. Prefer TimerWheel.cancel() which also frees the slot."""
+        self.cancelled = True
+
+
+class TimerWheel:
+    """Hierarchical timer wheel.
+
+    Timers are hashed into WHEEL_SIZE slots per level, level n covering
+    WHEEL_SIZE**(n+1) ticks. Scheduling and cancelling are O(1); timers on
+    the upper levels are cascaded down as the wheel turns. The wheel is
+    driven either by its own thread (start()) or by calling advance() from
+    an event loop. A callback that raises is reported to
+    on_error(exception, callback), if given, and logged otherwise.
+    """
+
+    def __init__(self, tick: float = 0.01, levels: int = 4, clock=time.monotonic, on_error=None):
+        self.tick = tick
+        self.on_error = on_error
+        self.levels = levels
+        self.clock = clock
+        self._wheels = [[set() for _ in range(WHEEL_SIZE)] for _ in range(levels)]
+        self._origin = clock()
+        self._current = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._running = False
+        self.active = 0
+        # Lag instrumentation (seconds between deadline and actual firing)
+        self.fired = 0
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+
+    def _tick_of(self, when: float) -> int:
+        return int((when - self._origin) / self.tick + 0.999999)
+
+    def _insert(self, timer: Timer):
+        delta = timer.expires - self._current
+        for level in range(self.levels):
+            if delta < 1 << (WHEEL_BITS * (level + 1)):
+                break
+        else:
+            # Beyond the top level: park it as far out as possible, it will
+            # be re-hashed with its real expiry when that slot cascades
+            level = self.levels - 1
+            delta = (1 << (WHEEL_BITS * self.levels)) - 1
+        expires = self._current + delta
+        slot = self._wheels[level][(expires >> (WHEEL_BITS * level)) & WHEEL_MASK]
+        slot.add(timer)
+        timer.slot = slot
+
+    def schedule(self, delay: float, callback, *args) -> Timer:
+        """Call callback(*args) after delay seconds. Returns the Timer handle."""
+        deadline = self.clock() + delay
+        with self._lock:
+            expires = max(self._tick_of(deadline), self._current + 1)
+            timer = Timer(deadline, expires, callback, args)
+            self._insert(timer)
+            self.active += 1
+        return timer
+
+    def cancel(self, timer: Timer):
+        """Cancel a pending timer. Safe to call on fired or cancelled timers."""
+        if timer is None:
+            return
+        with self._lock:
+            timer.cancelled = True
+            if timer.slot is not None:
+                timer.slot.discard(timer)
+                timer.slot = None
+                self.active -= 1
+
+    def _cascade(self, level: int):
+        slot = self._wheels[level][(self._current >> (WHEEL_BITS * level)) & WHEEL_MASK]
+        timers = list(slot)
+        slot.clear()
+        for timer in timers:
+            self._insert(timer)
+
+    def advance(self, now: float = None) -> int:
+        """Fire every timer that is due at `now`. Returns the number fired."""
+        now = self.clock() if now is None else now
+        target = int((now - self._origin) / self.tick)
+        due = []
+        with self._lock:
+            while self._current < target:
+                self._current += 1
+                # Cascade upper levels whenever the level below wraps around
+                for level in range(1, self.levels):
+                    if self._current & ((1 << (WHEEL_BITS * level)) - 1):
+                        break
+                    self._cascade(level)
+                slot = self._wheels[0][self._current & WHEEL_MASK]
+                if slot:
+                    due.extend(slot)
+                    slot.clear()
+            for timer in due:
+                timer.slot = None
+            self.active -= len(due)
+
+        fired = 0
+        for timer in due:
+            if timer.cancelled:
+                continue
+            lag = max(0.0, now - timer.deadline)
+            self.fired += 1
+            self.lag_total += lag
+            if lag > self.lag_max:
+                self.lag_max = lag
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                if self.on_error:
+                    self.on_error(e, timer.callback)
+                else:
+                    logger.exception("Error in timer callback %r", timer.callback)
+            fired += 1
+        return fired
+
+    def next_expiry(self) -> float:
+        """Return the deadline of the earliest pending timer, or None."""
+        with self._lock:
+            best = None
+            for level in range(self.levels):
+                shift = WHEEL_BITS * level
+                start = (self._current >> shift) & WHEEL_MASK
+                # The current slot is scanned last: on upper levels it holds
+                # timers a full turn ahead
+                for i in range(1, WHEEL_SIZE + 1):
+                    slot = self._wheels[level][(start + i) & WHEEL_MASK]
+                    if slot:
+                        earliest = min(t.deadline for t in slot)
+                        if best is None or earliest < best:
+                            best = earliest
+                        break
+            return best
+
+    def start(self):
+        """Drive the wheel from a background thread."""
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while self._running:
+            time.sleep(self.tick)
+            self.advance()
+
+    def stop(self):
+        """Stop the background thread, pending timers are dropped."""
+        self._running = False
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join(timeout=1)
+
+    def stats(self) -> dict:
+        """Return counters for the timer subsystem."""
+        mean = self.lag_total / self.fired if self.fired else 0.0
+        return {
+            'timers_active': self.active,
+            'timers_fired': self.fired,
+            'timer_lag_mean_ms': round(mean * 1000, 3),
+            'timer_lag_max_ms': round(self.lag_max * 1000, 3),
+        }
@@ -0,0 +1,442 @@
+#!/usr/bin/env python3
+"""Chunked file transfer between two daemons in a chat session.
+
+Used when both daemons negotiated the 'files' extension. All datagrams
+have type FILE and a binary payload:
+
+    SYN   offer   \\x01id=..;name=..;size=..;sha256=..\\x01
+    ACK   resume  \\x01id=..;offset=..\\x01   bytes the receiver has, in order
+    CHAT  chunk   transfer id (4) | offset (8) | CRC-32 (4) | data
+    FIN   abort   \\x01id=..;reason=..\\x01
+
+Aborts are FINs: ERR has the value of CHAT and would be taken for a chunk.
+
+The sender hashes the file on a helper thread, so a large file does not
+hold up the daemon, then maps it into memory and keeps up to `window` chunks
+in flight (go-back-N): the receiver only accepts the chunk at its
+current offset, appends it to a partial file and ACKs the new offset.
+A timeout, or three duplicate ACKs, rewinds the sender to the last
+ACKed offset. The partial file is named after the file's SHA-256, so
+offering the same file again after a broken transfer resumes where it
+stopped. When the last chunk is written the receiver checks the
+SHA-256 of the whole file before moving it into place.
+"""
+
+import hashlib
+import mmap
+import os
+import random
+import re
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from urllib.parse import quote, unquote
+from simp_common import *
+
+CHUNK_HEADER = struct.Struct('!IQI')
+assert CHUNK_HEADER.size == FILE_CHUNK_HEADER_SIZE
+HASH_BLOCK = 1 << 20
+DUP_ACKS = 3  # duplicate ACKs that trigger a retransmission before the timeout
+COMPLETED_KEPT = 64  # finished incoming transfers remembered to re-ACK late duplicates
+SHA256_HEX = re.compile(r'[0-9a-f]{64}')
+
+
+def mb_per_s(size: int, seconds: float) -> float:
+    return round(size / 1e6 / seconds, 3) if seconds > 0 else 0.0
+
+
+def file_sha256(fd: int) -> str:
+    """SHA-256 of what fd reads from its current offset, closing fd."""
+    digest = hashlib.sha256()
+    with open(fd, 'rb') as f:
+        while block := f.read(HASH_BLOCK):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class OutgoingFile:
+    """Sender side of one transfer, reading the file through mmap."""
+
+    def __init__(self, transfer_id: int, path: str):
+        self.id = transfer_id
+        self.path = path
+        self.name = os.path.basename(path)
+        self.file = open(path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        # mmap cannot map empty files
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+        self.view = memoryview(self.mm) if self.mm else memoryview(b'')
+        self.sha256 = None  # set by the hashing helper, see TransferEngine.offer()
+        self.acked = None  # None until the receiver answers the offer
+        self.next_offset = 0
+        self.resumed_from = 0
+        self.dup_acks = 0
+        self.attempts = 0
+        self.timer = None
+        self.armed = 0  # counts _arm() calls, to recognise the expiry of a replaced timer
+        self.started = None
+
+    def close(self):
+        self.view.release()
+        if self.mm:
+            self.mm.close()
+        self.file.close()
+
+
+class IncomingFile:
+    """Receiver side of one transfer, appending to a partial file on disk."""
+
+    def __init__(self, transfer_id: int, directory: str, name: str, size: int, sha256: str):
+        self.id = transfer_id
+        self.directory = directory
+        self.name = name
+        self.size = size
+        self.sha256 = sha256
+        self.part_path = os.path.join(directory, f".{name}.{sha256[:16]}.part")
+        self.file = open(self.part_path, 'ab')
+        self.hash = hashlib.sha256()
+        self.written = self.file.tell()
+        if self.written > size:
+            self.file.truncate(0)
+            self.written = 0
+        # Resume: hash what an earlier attempt already wrote
+        with open(self.part_path, 'rb') as part:
+            while block := part.read(HASH_BLOCK):
+                self.hash.update(block)
+        self.resumed_from = self.written
+        self.started = None
+
+    def write(self, data) -> bool:
+        """Append the chunk at the current offset, True when the file is complete."""
+        self.file.write(data)
+        self.hash.update(data)
+        self.written += len(data)
+        return self.written >= self.size
+
+    def finish(self) -> str:
+        """Verify the checksum and move the file into place, returns its path."""
+        self.file.close()
+        if self.hash.hexdigest() != self.sha256:
+            os.remove(self.part_path)
+            raise ValueError("checksum mismatch")
+        base, ext = os.path.splitext(self.name)
+        path = os.path.join(self.directory, self.name)
+        n = 0
+        while os.path.exists(path):
+            n += 1
+            path = os.path.join(self.directory, f"{base}.{n}{ext}")
+        os.replace(self.part_path, path)
+        return path
+
+    def close(self):
+        """Stop receiving, the partial file stays for a later resume."""
+        self.file.close()
+
+
+class TransferEngine:
+    """File transfers with the current chat partner, in both directions.
+
+    send(parts, addr) transmits one datagram given as a list of buffers
+    (the daemon uses sendmsg, so chunks go out straight from the mmap),
+    send_many(datagrams, addr), if given, transmits a window of chunks at
+    once, post(fn, *args), if given, runs fn on the thread that owns the
+    session (the offer is hashed on a helper thread and handed back
+    through it), notify(cmd, **kwargs) reports to the local client:
+
+        file_offered|id=..|name=..|size=..
+        file_sent|id=..|name=..|bytes=..|seconds=..|mb_s=..|resumed_from=..
+        file_received|id=..|name=..|path=..|bytes=..|seconds=..|mb_s=..|resumed_from=..
+        file_failed|id=..|name=..|reason=..
+        file_refused|id=..|name=..|size=..
+
+    Timer callbacks from timers.schedule(delay, fn, *args) should run on
+    the session's thread as well; the lock only matters when the engine is
+    driven without one, as a bare TimerWheel does.
+
+    Offers from the partner are accepted without asking the user only
+    if `accept` is set; otherwise they are refused with FIN reason=refused.
+    """
+
+    def __init__(self, send, notify, timers, directory: str = '.', chunk_size: int = FILE_CHUNK_SIZE,
+                 window: int = FILE_WINDOW, timeout: float = TIMEOUT, max_retries: int = MAX_RETRIES,
+                 clock=time.monotonic, send_many=None, post=None, accept: bool = True, rng=random):
+        self.send = send
+        self.send_many = send_many
+        self.post = post or (lambda fn, *args: fn(*args))
+        self.accept = accept
+        self.notify = notify
+        self.timers = timers
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.window = window
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.clock = clock
+        self.peer = None
+        self.username = "daemon"
+        self.session_id = None
+        self.outgoing = {}
+        self.incoming = {}
+        self.completed = OrderedDict()
+        self._next_id = rng.getrandbits(32)
+        self._lock = threading.RLock()
+        self.counters = {'files_sent': 0, 'files_received': 0, 'files_failed': 0, 'file_bytes_sent': 0,
+                         'file_bytes_received': 0, 'file_retransmits': 0, 'file_chunks_rejected': 0}
+
+    def open(self, peer: tuple, username: str, session_id: int = None):
+        """Start a session with peer, with compact headers if session_id is given."""
+        with self._lock:
+            self.close()
+            self.peer = peer
+            self.username = username or "daemon"
+            self.session_id = session_id
+
+    def close(self, reason: str = 'disconnected'):
+        """End the session, failing every transfer still running."""
+        with self._lock:
+            for transfer in list(self.outgoing.values()):
+                self._fail_outgoing(transfer, reason, tell_peer=False)
+            for transfer in list(self.incoming.values()):
+                self._fail_incoming(transfer, reason, tell_peer=False)
+            self.peer = None
+
+    def _header(self, op: int, payload_len: int) -> bytes:
+        if self.session_id is not None:
+            return build_compact_header(MessageType.FILE, op, 0, self.session_id, payload_len)
+        return build_simp_header(MessageType.FILE, op, 0, self.username, payload_len)
+
+    def _message(self, op: int, payload: bytes) -> bytes:
+        return self._header(op, len(payload)) + payload
+
+    def _control(self, op: int, **options):
+        self.send([self._message(op, add_syn_options(options).encode('ascii'))], self.peer)
+
+    # Sender
+
+    def offer(self, path: str) -> int:
+        """Offer a file to the partner, returns the transfer id. Raises OSError."""
+        with self._lock:
+            if self.peer is None:
+                raise RuntimeError("Not in a chat")
+            transfer_id = self._next_id
+            self._next_id = (transfer_id + 1) & 0xFFFFFFFF
+            transfer = OutgoingFile(transfer_id, path)
+            # The helper reads a duplicate descriptor, ours may be closed if the transfer fails meanwhile
+            fd = os.dup(transfer.file.fileno())
+            self.outgoing[transfer_id] = transfer
+            self.notify('file_offered', id=f"{transfer_id:08x}", name=transfer.name, size=transfer.size)
+            threading.Thread(target=self._hash, args=(transfer, fd), daemon=True).start()
+            return transfer_id
+
+    def _hash(self, transfer: OutgoingFile, fd: int):
+        """Helper thread: hash the file, then send the offer from the session's thread."""
+        try:
+            digest = file_sha256(fd)
+        except OSError as e:
+            self.post(self._hashed, transfer, None, e.strerror)
+        else:
+            self.post(self._hashed, transfer, digest, None)
+
+    def _hashed(self, transfer: OutgoingFile, digest: str, error: str):
+        with self._lock:
+            if self.outgoing.get(transfer.id) is not transfer:
+                return  # failed or the session ended while hashing
+            if digest is None:
+                self._fail_outgoing(transfer, error, tell_peer=False)
+                return
+            transfer.sha256 = digest
+            self._send_offer(transfer)
+
+    def _send_offer(self, transfer: OutgoingFile):
+        self._control(OperationType.SYN.value, id=f"{transfer.id:08x}", name=quote(transfer.name),
+                      size=transfer.size, sha256=transfer.sha256)
+        self._arm(transfer)
+
+    def _arm(self, transfer: OutgoingFile):
+        self.timers.cancel(transfer.timer)
+        transfer.armed += 1
+        transfer.timer = self.timers.schedule(self.timeout, self._expire, transfer, transfer.armed)
+
+    def _pump(self, transfer: OutgoingFile):
+        """Send chunks until the window is full."""
+        limit = min(transfer.size, transfer.acked + self.window * self.chunk_size)
+        header_len = CHUNK_HEADER.size
+        datagrams = []
+        while transfer.next_offset < limit:
+            offset = transfer.next_offset
+            chunk = transfer.view[offset:offset + self.chunk_size]
+            header = self._header(OperationType.CHAT_MSG.value, header_len + len(chunk))
+            datagrams.append([header, CHUNK_HEADER.pack(transfer.id, offset, zlib.crc32(chunk)), chunk])
+            transfer.next_offset = offset + len(chunk)
+        if self.send_many:
+            self.send_many(datagrams, self.peer)
+        else:
+            for parts in datagrams:
+                self.send(parts, self.peer)
+        if transfer.timer is None:
+            self._arm(transfer)
+
+    def _expire(self, transfer: OutgoingFile, armed: int):
+        """Retransmission timer: repeat the offer, or go back to the last ACKed offset."""
+        with self._lock:
+            # A timer cancelled after it fired may still have its task queued
+            if self.outgoing.get(transfer.id) is not transfer or transfer.timer is None or armed != transfer.armed:
+                return
+            transfer.timer = None
+            transfer.attempts += 1
+            if transfer.attempts >= self.max_retries:
+                self._fail_outgoing(transfer, 'timeout')
+            elif transfer.acked is None:
+                self._send_offer(transfer)
+            else:
+                self._rewind(transfer)
+
+    def _rewind(self, transfer: OutgoingFile):
+        chunks = -(-(transfer.next_offset - transfer.acked) // self.chunk_size)
+        self.counters['file_retransmits'] += chunks
+        transfer.next_offset = transfer.acked
+        self._pump(transfer)
+
+    def _handle_ack(self, transfer: OutgoingFile, offset: int):
+        if transfer.acked is None:
+            # Answer to the offer: start at the receiver's resume offset
+            transfer.acked = transfer.next_offset = transfer.resumed_from = min(offset, transfer.size)
+            transfer.started = self.clock()
+        elif offset <= transfer.acked:
+            transfer.dup_acks += 1
+            if transfer.dup_acks == DUP_ACKS and transfer.next_offset > transfer.acked:
+                self._rewind(transfer)
+            return
+        else:
+            transfer.acked = min(offset, transfer.size)
+            transfer.dup_acks = 0
+        transfer.attempts = 0
+        self.timers.cancel(transfer.timer)
+        transfer.timer = None
+        if transfer.acked >= transfer.size:
+            self._finish_outgoing(transfer)
+        else:
+            self._pump(transfer)
+
+    def _finish_outgoing(self, transfer: OutgoingFile):
+        del self.outgoing[transfer.id]
+        transfer.close()
+        sent = transfer.size - transfer.resumed_from
+        seconds = self.clock() - transfer.started
+        self.counters['files_sent'] += 1
+        self.counters['file_bytes_sent'] += sent
+        self.notify('file_sent', id=f"{transfer.id:08x}", name=transfer.name, bytes=sent,
+                    seconds=round(seconds, 3), mb_s=mb_per_s(sent, seconds), resumed_from=transfer.resumed_from)
+
+    def _fail_outgoing(self, transfer: OutgoingFile, reason: str, tell_peer: bool = True):
+        del self.outgoing[transfer.id]
+        self.timers.cancel(transfer.timer)
+        transfer.close()
+        self.counters['files_failed'] += 1
+        if tell_peer:
+            self._control(OperationType.FIN.value, id=f"{transfer.id:08x}", reason=reason)
+        self.notify('file_failed', id=f"{transfer.id:08x}", name=transfer.name, reason=reason)
+
+    # Receiver
+
+    def _handle_offer(self, options: dict):
+        transfer_id = int(options['id'], 16)
+        if transfer_id in self.completed:
+            self._control(OperationType.ACK.value, id=options['id'], offset=self.completed[transfer_id])
+            return
+        transfer = self.incoming.get(transfer_id)
+        if transfer is None:
+            # The checksum names the partial file, so it must be nothing but hex digits
+            if not SHA256_HEX.fullmatch(options.get('sha256', '')) or not options.get('size', '').isdigit():
+                self.counters['files_failed'] += 1
+                self._control(OperationType.FIN.value, id=options['id'], reason='bad_offer')
+                return
+            name = os.path.basename(unquote(options['name'])) or 'file'
+            if not self.accept:
+                self._control(OperationType.FIN.value, id=options['id'], reason='refused')
+                self.notify('file_refused', id=options['id'], name=name, size=options['size'])
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            transfer = IncomingFile(transfer_id, self.directory, name, int(options['size']), options['sha256'])
+            transfer.started = self.clock()
+            self.incoming[transfer_id] = transfer
+            if transfer.written >= transfer.size:
+                self._finish_incoming(transfer)
+                return
+        self._control(OperationType.ACK.value, id=options['id'], offset=transfer.written)
+
+    def _handle_chunk(self, payload: bytes):
+        transfer_id, offset, crc = CHUNK_HEADER.unpack_from(payload)
+        transfer = self.incoming.get(transfer_id)
+        if transfer is None:
+            if transfer_id in self.completed:
+                self._control(OperationType.ACK.value, id=f"{transfer_id:08x}", offset=self.completed[transfer_id])
+            return
+        data = memoryview(payload)[CHUNK_HEADER.size:]
+        if offset == transfer.written and zlib.crc32(data) == crc:
+            if transfer.write(data):
+                self._finish_incoming(transfer)
+                return
+        elif offset == transfer.written:
+            self.counters['file_chunks_rejected'] += 1
+        # Also re-ACK chunks out of order, the sender counts duplicate ACKs
+        self._control(OperationType.ACK.value, id=f"{transfer_id:08x}", offset=transfer.written)
+
+    def _finish_incoming(self, transfer: IncomingFile):
+        del self.incoming[transfer.id]
+        try:
+            path = transfer.finish()
+        except ValueError as e:
+            self.counters['files_failed'] += 1
+            self._control(OperationType.FIN.value, id=f"{transfer.id:08x}", reason='checksum')
+            self.notify('file_failed', id=f"{transfer.id:08x}", name=transfer.name, reason=str(e))
+            return
+        self.completed[transfer.id] = transfer.size
+        if len(self.completed) > COMPLETED_KEPT:
+            self.completed.popitem(last=False)
+        received = transfer.size - transfer.resumed_from
+        seconds = self.clock() - transfer.started
+        self.counters['files_received'] += 1
+        self.counters['file_bytes_received'] += received
+        self._control(OperationType.ACK.value, id=f"{transfer.id:08x}", offset=transfer.size)
+        self.notify('file_received', id=f"{transfer.id:08x}", name=transfer.name, path=path, bytes=received,
+                    seconds=round(seconds, 3), mb_s=mb_per_s(received, seconds), resumed_from=transfer.resumed_from)
+
+    def _fail_incoming(self, transfer: IncomingFile, reason: str, tell_peer: bool = True):
+        del self.incoming[transfer.id]
+        transfer.close()
+        self.counters['files_failed'] += 1
+        if tell_peer:
+            self._control(OperationType.FIN.value, id=f"{transfer.id:08x}", reason=reason)
+        self.notify('file_failed', id=f"{transfer.id:08x}", name=transfer.name, reason=reason)
+
+    def handle(self, msg: dict):
+        """Handle a FILE datagram from the chat partner."""
+        with self._lock:
+            if self.peer is None:
+                return
+            if msg['operation'] == OperationType.CHAT_MSG.value:
+                self._handle_chunk(msg['payload'])
+                return
+            options, _ = split_syn_options(msg['payload'].decode('ascii'))
+            transfer_id = int(options.get('id', '0'), 16)
+            if msg['operation'] == OperationType.SYN.value:
+                self._handle_offer(options)
+            elif msg['operation'] == OperationType.ACK.value:
+                transfer = self.outgoing.get(transfer_id)
+                if transfer:
+                    self._handle_ack(transfer, int(options['offset']))
+            elif msg['operation'] == OperationType.FIN.value:
+                reason = f"peer: {options.get('reason', 'error')}"
+                if transfer_id in self.outgoing:
+                    self._fail_outgoing(self.outgoing[transfer_id], reason, tell_peer=False)
+                elif transfer_id in self.incoming:
+                    self._fail_incoming(self.incoming[transfer_id], reason, tell_peer=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.counters)
+            stats['files_active'] = len(self.outgoing) + len(self.incoming)
+            return stats
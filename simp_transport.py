@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+"""Datagram transports a SimpDaemon sends and receives through.
+
+A transport is one bound endpoint:
+
+    send(data, addr)          one datagram
+    send_parts(parts, addr)   one datagram gathered from several buffers
+    send_many(datagrams, addr)  several datagrams, each a list of buffers
+    receive()                 (data, addr), blocking; None once interrupt() was called
+    interrupt()               make receive() return None after what arrived before
+    local_address()           (host, port) actually bound
+    close(shutdown=True)      release it; shutdown=False leaves the socket
+                              usable by a process it was handed over to
+
+Transports are made by a factory with bind(host, port, rcvbuf=None):
+
+- UdpTransport: a kernel UDP socket, one system call per datagram;
+- BatchedUdpTransport: the same socket, but received in bursts with
+  recvmmsg() and send_many() in one sendmmsg() (Linux, through ctypes;
+  elsewhere it falls back to one call per datagram);
+- MemoryNetwork: endpoints exchanging datagrams through in-process
+  queues, so many daemons can talk in one process without the kernel.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import socket
+import struct
+import threading
+from collections import deque
+
+RECEIVE_SIZE = 4096  # bytes read per datagram, as the daemon listeners always did
+BATCH_SIZE = 64  # datagrams per recvmmsg()/sendmmsg() call
+MSG_WAITFORONE = 0x10000
+
+
+class UdpTransport:
+    """A bound UDP socket."""
+
+    batched = False
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        # Sources of the datagrams sent by interrupt()
+        self._wake_addrs = set()
+
+    @classmethod
+    def bind(cls, host: str, port: int, rcvbuf: int = None):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        sock.bind((host, port))
+        return cls(sock)
+
+    def local_address(self) -> tuple:
+        return self.sock.getsockname()
+
+    def send(self, data: bytes, addr: tuple):
+        self.sock.sendto(data, addr)
+
+    def send_parts(self, parts: list, addr: tuple):
+        """Send one datagram gathered from several buffers, without joining them first."""
+        self.sock.sendmsg(parts, [], 0, addr)
+
+    def send_many(self, datagrams: list, addr: tuple):
+        for parts in datagrams:
+            self.sock.sendmsg(parts, [], 0, addr)
+
+    def receive(self):
+        data, addr = self.sock.recvfrom(RECEIVE_SIZE)
+        if addr in self._wake_addrs:
+            self._wake_addrs.discard(addr)
+            return None
+        return data, addr
+
+    def interrupt(self):
+        """Queue an empty datagram from a throwaway socket whose address receive() recognizes.
+
+        Everything queued ahead of it is still received, nothing after it.
+        """
+        host, port = self.local_address()
+        wake = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        wake.connect(('127.0.0.1' if host == '0.0.0.0' else host, port))
+        self._wake_addrs.add(wake.getsockname())
+        wake.send(b'')
+        wake.close()
+
+    def close(self, shutdown: bool = True):
+        if shutdown:
+            try:
+                # Wakes up a receive() blocked in the kernel
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.sock.close()
+
+
+class _SockaddrIn(ctypes.Structure):
+    _fields_ = [('family', ctypes.c_ushort), ('port', ctypes.c_ubyte * 2), ('addr', ctypes.c_ubyte * 4),
+                ('zero', ctypes.c_ubyte * 8)]
+
+
+class _Iovec(ctypes.Structure):
+    _fields_ = [('base', ctypes.c_void_p), ('len', ctypes.c_size_t)]
+
+
+class _Msghdr(ctypes.Structure):
+    _fields_ = [('name', ctypes.c_void_p), ('namelen', ctypes.c_uint32), ('iov', ctypes.POINTER(_Iovec)),
+                ('iovlen', ctypes.c_size_t), ('control', ctypes.c_void_p), ('controllen', ctypes.c_size_t),
+                ('flags', ctypes.c_int)]
+
+
+class _Mmsghdr(ctypes.Structure):
+    _fields_ = [('hdr', _Msghdr), ('len', ctypes.c_uint)]
+
+
+def _load_mmsg():
+    """libc's recvmmsg and sendmmsg, or None where there are none."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        recvmmsg, sendmmsg = libc.recvmmsg, libc.sendmmsg
+    except (OSError, AttributeError):
+        return None
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_Mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_Mmsghdr), ctypes.c_uint, ctypes.c_int]
+    return recvmmsg, sendmmsg
+
+
+_MMSG = _load_mmsg()
+
+
+def _sockaddr(addr: tuple) -> _SockaddrIn:
+    sa = _SockaddrIn()
+    sa.family = socket.AF_INET
+    sa.port[:] = struct.pack('>H', addr[1])
+    sa.addr[:] = socket.inet_aton(addr[0])
+    return sa
+
+
+class BatchedUdpTransport(UdpTransport):
+    """A UDP socket read with recvmmsg() and written in bursts with sendmmsg().
+
+    One recvmmsg() returns every datagram already queued, up to batch,
+    and receive() hands them out one by one; during a burst that is one
+    system call for the batch instead of one per datagram. send_many()
+    passes a whole window of file chunks to the kernel at once. Buffers
+    that ctypes cannot point into (read-only memoryviews, e.g. of an
+    mmapped file) are copied first.
+
+    Datagrams read in the same batch as the one from interrupt() are
+    still returned before None.
+    """
+
+    def __init__(self, sock: socket.socket, batch: int = BATCH_SIZE):
+        super().__init__(sock)
+        self.batched = _MMSG is not None
+        self.batch = batch
+        self._received = deque()
+        self._woken = False
+        self._used = batch  # entries the last recvmmsg() filled in, to be reset before the next
+        self.calls = 0  # recvmmsg() and sendmmsg() calls, for comparing with the datagram counts
+        if self.batched:
+            self._buffers = ctypes.create_string_buffer(RECEIVE_SIZE * batch)
+            self._addrs = (_SockaddrIn * batch)()
+            self._iovs = (_Iovec * batch)()
+            self._msgs = (_Mmsghdr * batch)()
+            self._base = ctypes.addressof(self._buffers)
+            for i in range(batch):
+                self._iovs[i].base = self._base + i * RECEIVE_SIZE
+                self._iovs[i].len = RECEIVE_SIZE
+                hdr = self._msgs[i].hdr
+                hdr.name = ctypes.addressof(self._addrs[i])
+                hdr.iov = ctypes.pointer(self._iovs[i])
+                hdr.iovlen = 1
+
+    def receive(self):
+        if not self.batched:
+            return super().receive()
+        while not self._received:
+            if self._woken:
+                self._woken = False
+                return None
+            self._fill()
+        return self._received.popleft()
+
+    def _fill(self):
+        """Read what is queued into _received: blocks for the first datagram only."""
+        for i in range(self._used):
+            self._msgs[i].hdr.namelen = ctypes.sizeof(_SockaddrIn)
+            self._addrs[i].family = 0
+        recvmmsg, _ = _MMSG
+        while True:
+            count = recvmmsg(self.sock.fileno(), self._msgs, self.batch, MSG_WAITFORONE, None)
+            if count >= 0:
+                break
+            err = ctypes.get_errno()
+            if err != errno.EINTR:
+                raise OSError(err, os.strerror(err))
+        self.calls += 1
+        self._used = max(count, 1)
+        if count == 0 or self._addrs[0].family != socket.AF_INET:
+            # Nothing from anyone: the socket was shut down
+            raise OSError(errno.EBADF, "Transport closed")
+        for i in range(count):
+            sa = self._addrs[i]
+            addr = (socket.inet_ntoa(bytes(sa.addr)), struct.unpack('>H', bytes(sa.port))[0])
+            if addr in self._wake_addrs:
+                self._wake_addrs.discard(addr)
+                self._woken = True
+                continue
+            data = ctypes.string_at(self._base + i * RECEIVE_SIZE, self._msgs[i].len)
+            self._received.append((data, addr))
+
+    def send_many(self, datagrams: list, addr: tuple):
+        if not self.batched:
+            return super().send_many(datagrams, addr)
+        _, sendmmsg = _MMSG
+        sa = _sockaddr(addr)
+        for first in range(0, len(datagrams), self.batch):
+            chunk = datagrams[first:first + self.batch]
+            msgs = (_Mmsghdr * len(chunk))()
+            keep = []  # the buffers and iovec arrays must outlive the call
+            for msg, parts in zip(msgs, chunk):
+                iovs = (_Iovec * len(parts))()
+                for iov, part in zip(iovs, parts):
+                    if not isinstance(part, bytes):
+                        part = bytes(part)
+                    keep.append(part)
+                    iov.base = ctypes.cast(ctypes.c_char_p(part), ctypes.c_void_p)
+                    iov.len = len(part)
+                keep.append(iovs)
+                msg.hdr.name = ctypes.addressof(sa)
+                msg.hdr.namelen = ctypes.sizeof(sa)
+                msg.hdr.iov = iovs
+                msg.hdr.iovlen = len(parts)
+            sent = 0
+            while sent < len(chunk):
+                first_msg = ctypes.cast(ctypes.addressof(msgs) + sent * ctypes.sizeof(_Mmsghdr),
+                                        ctypes.POINTER(_Mmsghdr))
+                count = sendmmsg(self.sock.fileno(), first_msg, len(chunk) - sent, 0)
+                if count < 0:
+                    err = ctypes.get_errno()
+                    if err == errno.EINTR:
+                        continue
+                    raise OSError(err, os.strerror(err))
+                self.calls += 1
+                sent += count
+
+    def close(self, shutdown: bool = True):
+        super().close(shutdown)
+        self._received.clear()
+
+
+class MemoryTransport:
+    """One endpoint of a MemoryNetwork. Datagrams are copied into the receiver's queue."""
+
+    batched = False
+
+    def __init__(self, network, addr: tuple):
+        self.network = network
+        self.addr = addr
+        self.queue = deque()
+        self._cond = threading.Condition()
+        self.closed = False
+
+    def local_address(self) -> tuple:
+        return self.addr
+
+    def send(self, data: bytes, addr: tuple):
+        if self.closed:
+            raise OSError(errno.EBADF, "Transport closed")
+        self.network.deliver(bytes(data), self.addr, addr)
+
+    def send_parts(self, parts: list, addr: tuple):
+        self.send(b''.join(parts), addr)
+
+    def send_many(self, datagrams: list, addr: tuple):
+        for parts in datagrams:
+            self.send(b''.join(parts), addr)
+
+    def put(self, item):
+        with self._cond:
+            self.queue.append(item)
+            self._cond.notify()
+
+    def receive(self, timeout: float = None):
+        """Next (data, addr); None after interrupt() or when timeout passes."""
+        with self._cond:
+            while not self.queue:
+                if self.closed:
+                    raise OSError(errno.EBADF, "Transport closed")
+                if not self._cond.wait(timeout) and timeout is not None:
+                    return None
+            return self.queue.popleft()
+
+    def interrupt(self):
+        self.put(None)
+
+    def close(self, shutdown: bool = True):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+        self.network.unbind(self)
+
+
+class MemoryNetwork:
+    """Delivers datagrams between MemoryTransports in one process.
+
+    Ports are allocated like ephemeral UDP ports when bound to 0, an
+    endpoint bound to 0.0.0.0 receives for any host, and a datagram to
+    an address nobody bound is dropped, as UDP would.
+    """
+
+    def __init__(self, first_port: int = 40000):
+        self.endpoints = {}
+        self._next_port = first_port
+        self._lock = threading.Lock()
+        self.delivered = 0
+        self.dropped = 0
+
+    def bind(self, host: str = '127.0.0.1', port: int = 0, rcvbuf: int = None) -> MemoryTransport:
+        with self._lock:
+            if not port:
+                while (host, self._next_port) in self.endpoints or ('0.0.0.0', self._next_port) in self.endpoints:
+                    self._next_port += 1
+                port = self._next_port
+                self._next_port += 1
+            if (host, port) in self.endpoints:
+                raise OSError(errno.EADDRINUSE, f"Address {host}:{port} already in use")
+            transport = MemoryTransport(self, (host, port))
+            self.endpoints[(host, port)] = transport
+            return transport
+
+    def unbind(self, transport: MemoryTransport):
+        with self._lock:
+            if self.endpoints.get(transport.addr) is transport:
+                del self.endpoints[transport.addr]
+
+    def deliver(self, data: bytes, src: tuple, dest: tuple):
+        if src[0] == '0.0.0.0':
+            src = ('127.0.0.1', src[1])
+        endpoint = self.endpoints.get(dest) or self.endpoints.get(('0.0.0.0', dest[1]))
+        if endpoint is None or endpoint.closed:
+            self.dropped += 1
+            return
+        self.delivered += 1
+        endpoint.put((data, src))
+
+
+TRANSPORTS = {'udp': UdpTransport, 'batched': BatchedUdpTransport}
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""Memory of a daemon under sustained traffic to a peer that keeps stalling.
+
+Two in-process SimpDaemons chat through an ImpairmentProxy: A -> proxy
+-> B. A scripted client feeds A's send queue at a fixed rate. Every
+--stall seconds the proxy drops everything for --stall seconds, so A's
+session buffer fills up and the overflow policy has to act. A stall
+must end before A runs out of retransmissions, which would end the
+session; the run fails if the session is gone at any sample. The
+process RSS is sampled every --interval seconds; with bounded buffers
+it stays flat once warmed up, however long the soak runs.
+
+    python soak_memory.py --duration 3600 --rate 200 --policy drop_oldest
+"""
+
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+from simp_common import *
+from simp_daemon import SimpDaemon
+from simp_proxy import ImpairmentProxy
+from bench_impairment import attach_client
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def rss_mb() -> float:
+    """Resident set size of this process right now."""
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * PAGE_SIZE / (1 << 20)
+
+
+def drain(sock: socket.socket) -> int:
+    """Read and discard the notifications waiting on a client socket."""
+    count = 0
+    try:
+        while True:
+            sock.recv(4096)
+            count += 1
+    except BlockingIOError:
+        return count
+
+
+def run(duration: float, rate: float, size: int, policy: str, stall: float, interval: float, warmup: float):
+    sender = SimpDaemon(host='127.0.0.1', daemon_port=0, client_port=0, buffer_policy=policy,
+                        keepalive_interval=0, log_level='warning')
+    receiver = SimpDaemon(host='127.0.0.1', daemon_port=0, client_port=0, keepalive_interval=0,
+                          log_level='warning')
+    receiver.auto_accept = True
+    for daemon in (sender, receiver):
+        daemon.start()
+    proxy = ImpairmentProxy(('127.0.0.1', 0), ('127.0.0.1', receiver.daemon_port))
+    proxy.start()
+    sender_client = attach_client(sender, 'alice')
+    receiver_client = attach_client(receiver, 'bob')
+    sender_addr = ('127.0.0.1', sender.client_port)
+    sender_client.sendto(build_client_daemon_message('invite', ip='127.0.0.1', port=proxy.listen_addr[1])
+                         .encode('ascii'), sender_addr)
+    while not sender.in_chat:
+        time.sleep(0.01)
+    for sock in (sender_client, receiver_client):
+        sock.setblocking(False)
+
+    running = True
+
+    def feed():
+        i = 0
+        next_at = time.monotonic()
+        while running:
+            msg = build_client_daemon_message('send', text=f"{i}:".ljust(size, 'x'), id=i)
+            sender_client.sendto(msg.encode('ascii'), sender_addr)
+            i += 1
+            next_at += 1 / rate
+            time.sleep(max(0.0, next_at - time.monotonic()))
+
+    threading.Thread(target=feed, daemon=True).start()
+    started = time.monotonic()
+    samples = []
+    lost = False
+    print(f"{'t_s':>7} {'rss_mb':>8} {'queued':>7} {'dropped':>8} {'rejected':>8} {'mem_used_kb':>11} {'delivered':>9}")
+    while time.monotonic() - started < duration:
+        next_sample = time.monotonic() + interval
+        while time.monotonic() < next_sample:
+            # Stall the link every other stall period
+            elapsed = time.monotonic() - started
+            proxy.loss = 1.0 if stall and int(elapsed / stall) % 2 else 0.0
+            time.sleep(0.05)
+        elapsed = time.monotonic() - started
+        if not sender.in_chat:
+            # Samples of a dead session with an empty buffer prove nothing
+            print(f"{elapsed:7.0f} session ended, the stall outlasted the retransmissions")
+            lost = True
+            break
+        drain(sender_client)
+        drain(receiver_client)
+        stats = sender.stats()
+        rss = rss_mb()
+        if elapsed >= warmup:
+            samples.append(rss)
+        print(f"{elapsed:7.0f} {rss:8.1f} {stats['send_buffer_items']:7} {stats['send_buffer_dropped']:8} "
+              f"{stats['send_buffer_rejected']:8} {stats['memory_used'] // 1024:11} {stats['delivered']:9}")
+    running = False
+    for daemon in (sender, receiver):
+        daemon.stop()
+    proxy.stop()
+    if lost:
+        sys.exit(1)
+    if samples:
+        print(f"RSS after warm-up: first {samples[0]:.1f} MB, max {max(samples):.1f} MB, "
+              f"last {samples[-1]:.1f} MB, growth {samples[-1] - samples[0]:+.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--duration', type=float, default=60, help="seconds to run, e.g. 3600 for a one-hour soak")
+    parser.add_argument('--rate', type=float, default=200, help="messages per second fed to the sender")
+    parser.add_argument('--size', type=int, default=200, help="payload bytes per message")
+    parser.add_argument('--policy', choices=('reject', 'drop_oldest', 'spill'), default='drop_oldest')
+    parser.add_argument('--stall', type=float, default=5,
+                        help=f"seconds the link works and stalls in turn, 0 never, below {TIMEOUT * MAX_RETRIES} s")
+    parser.add_argument('--interval', type=float, default=5, help="seconds between samples")
+    parser.add_argument('--warmup', type=float, default=10, help="seconds before samples count for the growth")
+    args = parser.parse_args()
+    if args.stall >= TIMEOUT * MAX_RETRIES:
+        parser.error(f"--stall must be shorter than the {TIMEOUT * MAX_RETRIES} s the sender retransmits for")
+    run(args.duration, args.rate, args.size, args.policy, args.stall, args.interval, args.warmup)
+
+
+if __name__ == "__main__":
+    main()
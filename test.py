@@ -1,67 +1,84 @@
+import hashlib
+import io
+import json
+import os
+import pstats
+import select
 import subprocess
 import time
 import socket
 import sys
 import pytest
 from simp_common import (MessageType, build_simp_message, parse_simp_message, 
-                         DAEMON_PORT, CLIENT_DAEMON_PORT, TIMEOUT, 
-                         build_client_daemon_message, parse_client_daemon_message)
+                         TIMEOUT, SUPPORTED_EXTENSIONS, add_syn_cookie, split_syn_cookie,
+                         add_syn_options, split_syn_options, build_compact_message,
+                         build_client_daemon_message, parse_client_daemon_message, SESSION_BUFFER,
+                         FILE_CHUNK_SIZE, DAEMON_PORT)
+from simp_timer import TimerWheel
+from simp_daemon import SimpDaemon
+from simp_ratelimit import RateLimiter, SynCookies
+from simp_dispatch import PriorityDispatcher
+from simp_log import EventLog
+from simp_client import ClientCore, Renderer
+from simp_proxy import ImpairmentProxy
+from simp_loadgen import LoadGenerator
+from simp_transfer import TransferEngine
+from simp_restart import receive_handover
+from simp_ring import RingBuffer, MemoryBudget
+from simp_transport import MemoryNetwork
+from simp_sim import Simulator, SimNetwork, SimNode, simulate, sweep
+import threading
 
-DAEMON_ADDR = ("127.0.0.1", DAEMON_PORT)
+# Daemons, fake clients and peers come from the fixtures in conftest.py
 
-def start_client(username="testuser"):
-    """Starts the simp_client process."""
+EXT = ",".join(sorted(SUPPORTED_EXTENSIONS))  # extensions a default daemon offers
+
+def start_client(username="testuser", port=None):
+    """Starts the simp_client process against the client port of a (fake) daemon."""
     print(f"\n[INFO] Starting simp_client.py for user {username}...")
     # Use Popen to control stdin/stdout for interaction
-    proc = subprocess.Popen([sys.executable, "simp_client.py"], 
+    proc = subprocess.Popen([sys.executable, "simp_client.py", "--port", str(port)], 
                             stdin=subprocess.PIPE, 
                             stdout=subprocess.PIPE, 
                             stderr=subprocess.PIPE, 
                             text=True)
-    time.sleep(1)
-    # The client immediately prompts for a username
+    # The client immediately prompts for a username; the pipe buffers it until then
     proc.stdin.write(f"{username}\n")
     proc.stdin.flush()
     return proc
 
-# --- DAEMON FIXTURE (scope="function" to avoid port conflict) ---
-@pytest.fixture(scope="function") 
-def daemon():
-    """Start daemon before tests, stop after each test completes, ensuring ports are freed."""
-    print("\n[INFO] Starting simp_daemon.py ...")
-    proc = subprocess.Popen([sys.executable, "simp_daemon.py"], 
-                           stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    time.sleep(1.5)  # Give daemon time to start and bind ports
-    
-    # Check if the daemon failed to start
-    if proc.poll() is not None:
-         stdout, stderr = proc.communicate(timeout=0.1)
-         pytest.fail(f"Daemon failed to start. STDOUT: {stdout.strip()}. STDERR: {stderr.strip()}")
-        
-    yield proc
-    print("\n[INFO] Stopping daemon...")
-    proc.terminate()
-    try:
-        proc.wait(timeout=1) 
-    except subprocess.TimeoutExpired:
-        proc.kill()
+def wait_until(predicate, timeout=TIMEOUT):
+    """Poll predicate() until it holds, instead of sleeping a fixed time."""
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            pytest.fail("Condition not reached in time")
+        time.sleep(0.005)
+
+def wait_for_output(proc, text, timeout=TIMEOUT):
+    """Read the client's stdout until text shows up, instead of sleeping."""
+    output = b''
+    deadline = time.monotonic() + timeout
+    while text.encode() not in output:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not select.select([proc.stdout], [], [], remaining)[0]:
+            pytest.fail(f"Client did not print {text!r} (got {output.decode(errors='replace')!r})")
+        chunk = os.read(proc.stdout.fileno(), 4096)
+        if not chunk:
+            pytest.fail(f"Client exited before printing {text!r}")
+        output += chunk
+    return output.decode(errors='replace')
 
 # --- CLIENT TESTING FIXTURE ---
 @pytest.fixture
 def client_conn_setup():
     """
     Set up a temporary UDP socket that acts as the DAEMON's client-daemon listener.
-    It binds to CLIENT_DAEMON_PORT (7779) to intercept messages from the client process.
+    It binds an ephemeral port; clients are pointed at it with --port.
     """
-    print(f"\n[INFO] Setting up temporary socket on port {CLIENT_DAEMON_PORT} to intercept client messages...")
     temp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    
-    try:
-        # Bind to CLIENT_DAEMON_PORT to intercept client messages
-        temp_sock.bind(("127.0.0.1", CLIENT_DAEMON_PORT))
-    except OSError as e:
-        pytest.fail(f"Failed: Could not bind to port {CLIENT_DAEMON_PORT}. Ensure no other daemon/test is running.")
-        
+    temp_sock.bind(("127.0.0.1", 0))
+    print(f"\n[INFO] Intercepting client messages on port {temp_sock.getsockname()[1]}...")
     temp_sock.settimeout(TIMEOUT)
     yield temp_sock
     temp_sock.close()
@@ -74,10 +91,8 @@ def run_client_action_test(client_proc, expected_command, input_sequence, temp_s
     for input_line in input_sequence:
         client_proc.stdin.write(f"{input_line}\n")
     client_proc.stdin.flush()
-    # Wait for the client to process input and send the message
-    time.sleep(1) 
 
-    # 2. Check for the expected message on the temporary daemon socket
+    # 2. Wait for the expected message on the temporary daemon socket
     try:
         data, addr = temp_sock.recvfrom(4096)
         msg = parse_client_daemon_message(data.decode('ascii'))
@@ -118,7 +133,7 @@ def test_message_build_parse_no_daemon():
 # ----------------------------------------------------------
 # 2. Three-way handshake
 # ----------------------------------------------------------
-def test_three_way_handshake_with_daemon(daemon):
+def test_three_way_handshake_with_daemon(daemon, daemon_addr):
     """Test three-way handshake: SYN -> SYN+ACK -> ACK. (Requires daemon)"""
     print("\n[TEST] Three-way handshake: SYN -> SYN+ACK -> ACK")
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -127,7 +142,7 @@ def test_three_way_handshake_with_daemon(daemon):
     try:
         # 1. send SYN
         syn_msg = build_simp_message(MessageType.CONTROL, 0x02, 0, "alice")
-        sock.sendto(syn_msg, DAEMON_ADDR)
+        sock.sendto(syn_msg, daemon_addr)
 
         # 2. Receive SYN+ACK
         data, _ = sock.recvfrom(4096)
@@ -138,8 +153,8 @@ def test_three_way_handshake_with_daemon(daemon):
         
         # 3. Send final ACK
         ack_msg = build_simp_message(MessageType.CONTROL, 0x04, 0, "alice")
-        sock.sendto(ack_msg, DAEMON_ADDR)
-        time.sleep(0.5)
+        sock.sendto(ack_msg, daemon_addr)
+        wait_until(lambda: daemon.in_chat)
         
     except socket.timeout:
         pytest.fail("No SYN+ACK received from daemon (timeout)")
@@ -147,7 +162,7 @@ def test_three_way_handshake_with_daemon(daemon):
         # Send FIN to cleanup
         try:
             fin_msg = build_simp_message(MessageType.CONTROL, 0x08, 0, "alice")
-            sock.sendto(fin_msg, DAEMON_ADDR)
+            sock.sendto(fin_msg, daemon_addr)
             sock.recvfrom(4096)
         except:
             pass
@@ -156,7 +171,7 @@ def test_three_way_handshake_with_daemon(daemon):
 # ----------------------------------------------------------
 # 3. Stop-and-wait
 # ----------------------------------------------------------
-def test_stop_and_wait_with_daemon(daemon):
+def test_stop_and_wait_with_daemon(daemon, daemon_addr):
     """Test stop-and-wait ARQ with chat messages. (Requires daemon)"""
     print("\n[TEST] Stop-and-wait message")
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -167,11 +182,11 @@ def test_stop_and_wait_with_daemon(daemon):
     # Establish connection
     try:
         syn_msg = build_simp_message(MessageType.CONTROL, 0x02, 0, "bob")
-        sock.sendto(syn_msg, DAEMON_ADDR)
+        sock.sendto(syn_msg, daemon_addr)
         data, _ = sock.recvfrom(4096)
         ack_msg = build_simp_message(MessageType.CONTROL, 0x04, 0, "bob")
-        sock.sendto(ack_msg, DAEMON_ADDR)
-        time.sleep(0.5)
+        sock.sendto(ack_msg, daemon_addr)
+        wait_until(lambda: daemon.in_chat)
     except:
         pytest.fail("Could not establish connection for stop-and-wait test.")
     
@@ -179,7 +194,7 @@ def test_stop_and_wait_with_daemon(daemon):
     try:
         for i in range(2):
             msg = build_simp_message(MessageType.CHAT, 0x01, seq, "bob", f"msg{i}")
-            sock.sendto(msg, DAEMON_ADDR)
+            sock.sendto(msg, daemon_addr)
             
             # Receive ACK
             data, _ = sock.recvfrom(4096)
@@ -197,7 +212,7 @@ def test_stop_and_wait_with_daemon(daemon):
         # Send FIN to cleanup
         try:
             fin_msg = build_simp_message(MessageType.CONTROL, 0x08, 0, "bob")
-            sock.sendto(fin_msg, DAEMON_ADDR)
+            sock.sendto(fin_msg, daemon_addr)
             sock.recvfrom(4096)
         except:
             pass
@@ -217,7 +232,7 @@ def test_daemon_client_communication_with_daemon(daemon):
     try:
         # Send connect message to daemon
         connect_msg = build_client_daemon_message('connect', username='tester')
-        test_sock.sendto(connect_msg.encode('ascii'), ("127.0.0.1", CLIENT_DAEMON_PORT))
+        test_sock.sendto(connect_msg.encode('ascii'), ("127.0.0.1", daemon.client_port))
         
         # Wait for OK response from the actual daemon
         data, _ = test_sock.recvfrom(4096)
@@ -231,10 +246,1435 @@ def test_daemon_client_communication_with_daemon(daemon):
     finally:
         test_sock.close()
 
+def test_client_port_on_loopback_by_default(make_daemon):
+    """The client port stays on loopback when SIMP listens on every interface, unless asked otherwise."""
+    simp_daemon = make_daemon(host='0.0.0.0')
+    assert simp_daemon.daemon_transport.local_address()[0] == '0.0.0.0'
+    assert simp_daemon.client_transport.local_address()[0] == '127.0.0.1'
+    exposed = make_daemon(host='0.0.0.0', client_host='0.0.0.0')
+    assert exposed.client_transport.local_address()[0] == '0.0.0.0'
+    print("PASS: Client port on loopback")
+
+# ----------------------------------------------------------
+# 5. Zero-RTT first message on SYN
+# ----------------------------------------------------------
+def test_zero_rtt_first_message_with_daemon(daemon, daemon_addr, make_client, make_peer):
+    """First chat payload rides on the SYN and is delivered once, after the handshake."""
+    print("\n[TEST] Zero-RTT first message")
+    client = make_client(daemon, 'carol')
+    peer = make_peer()
+    
+    # SYN carrying the first message, then a retransmission of it
+    syn_msg = build_simp_message(MessageType.CONTROL, 0x02, 0, "dave", "hello early")
+    peer.sendto(syn_msg, daemon_addr)
+    assert client.recv()['command'] == 'invitation'
+    peer.sendto(syn_msg, daemon_addr)
+    
+    # Accept, complete the handshake
+    client.command('accept')
+    assert parse_simp_message(peer.recvfrom(4096)[0])["operation"] == (0x02 | 0x04)
+    peer.sendto(build_simp_message(MessageType.CONTROL, 0x04, 0, "dave"), daemon_addr)
+    
+    assert client.recv()['command'] == 'connected'
+    msg = client.recv()
+    assert msg['command'] == 'message' and msg['text'] == "hello early"
+    
+    # The retransmitted SYN must not produce a second delivery
+    client.sock.settimeout(0.5)
+    with pytest.raises(socket.timeout):
+        client.recv()
+    print("PASS: Early data delivered exactly once")
+
+# ----------------------------------------------------------
+# 6. Keepalive and dead-peer detection
+# ----------------------------------------------------------
+def test_keepalive_dead_peer_detection(make_daemon, make_client, make_peer):
+    """A silent partner is probed, then the session is reclaimed and the client told."""
+    print("\n[TEST] Keepalive / dead-peer detection")
+    simp_daemon = make_daemon(keepalive_interval=0.2, keepalive_probes=2)
+    simp_daemon.auto_accept = True
+    client = make_client(simp_daemon, 'erin')
+    peer = make_peer()
+    daemon_addr = ("127.0.0.1", simp_daemon.daemon_port)
+    
+    peer.sendto(build_simp_message(MessageType.CONTROL, 0x02, 0, "frank"), daemon_addr)
+    assert client.recv()['command'] == 'invitation'
+    peer.recvfrom(4096)  # SYN+ACK
+    peer.sendto(build_simp_message(MessageType.CONTROL, 0x04, 0, "frank"), daemon_addr)
+    assert client.recv()['command'] == 'connected'
+    
+    # The peer now goes silent: it gets probed, then the session is dropped
+    assert parse_simp_message(peer.recvfrom(4096)[0])["operation"] == 0x10, "Expected a PING probe"
+    msg = client.recv()
+    assert msg['command'] == 'disconnected' and msg['reason'] == 'timeout'
+    assert not simp_daemon.in_chat and simp_daemon.chat_partner is None
+    print("PASS: Dead peer detected and session reclaimed")
+
+
+# ----------------------------------------------------------
+# 7. Send queue backpressure
+# ----------------------------------------------------------
+def test_send_queue_backpressure(make_daemon, make_client, make_peer):
+    """A full send queue answers 'busy', frees up with 'credit', and 'quit' bypasses it."""
+    print("\n[TEST] Send queue backpressure")
+    simp_daemon = make_daemon(send_queue_size=4)
+    simp_daemon.auto_accept = True
+    client = make_client(simp_daemon, 'gina')
+    peer = make_peer()
+    daemon_addr = ("127.0.0.1", simp_daemon.daemon_port)
+    
+    peer.sendto(build_simp_message(MessageType.CONTROL, 0x02, 0, "hank"), daemon_addr)
+    assert client.recv()['command'] == 'invitation'
+    peer.recvfrom(4096)  # SYN+ACK
+    peer.sendto(build_simp_message(MessageType.CONTROL, 0x04, 0, "hank"), daemon_addr)
+    assert client.recv()['command'] == 'connected'
+    
+    # One message in flight plus four queued, the sixth is refused
+    for i in range(6):
+        client.command('send', text=f"m{i}")
+    assert client.recv()['command'] == 'busy'
+    
+    # ACK the messages one by one; delivery order is preserved
+    seq = 0
+    for i in range(3):
+        parsed = parse_simp_message(peer.recvfrom(4096)[0])
+        assert parsed["payload"] == f"m{i}" and parsed["seq"] == seq
+        peer.sendto(build_simp_message(MessageType.CONTROL, 0x04, seq, "hank"), daemon_addr)
+        seq = 1 - seq
+    msg = client.recv()
+    assert msg['command'] == 'credit' and int(msg['available']) >= 2
+    
+    # quit is handled at once even though messages are still queued
+    client.command('quit')
+    assert client.recv()['command'] == 'ok'
+    while parse_simp_message(peer.recvfrom(4096)[0])["operation"] != 0x08:
+        pass
+    assert not simp_daemon.send_queue
+    print("PASS: busy / credit / quit bypass")
+
+
+# ----------------------------------------------------------
+# 8. Load generator against a live daemon
+# ----------------------------------------------------------
+def test_load_generator_syn_storm(daemon_addr):
+    """Every SYN of a small storm is answered and timed."""
+    generator = LoadGenerator([daemon_addr], 'syn_storm', peers=50, rate=500, duration=0.5)
+    try:
+        report = generator.run()
+    finally:
+        generator.close()
+    assert report['completed'] > 100
+    assert not report['errors'], report['errors']
+    assert report['latency']['syn']['count'] == report['completed']
+    print(f"PASS: {report['completed']} SYNs answered, p99 {report['latency']['syn']['p99_ms']:.2f} ms")
+
+
+# ----------------------------------------------------------
+# 9. Delivery receipts
+# ----------------------------------------------------------
+def test_delivery_receipts_between_daemons(make_daemon, make_client):
+    """Two daemons negotiate receipts; the sender learns the RTT, the receiver the one-way latency."""
+    print("\n[TEST] Delivery receipts")
+    alice_daemon, bob_daemon = make_daemon(), make_daemon()
+    bob_daemon.auto_accept = True
+    alice, bob = make_client(alice_daemon, 'alice'), make_client(bob_daemon, 'bob')
+    alice.command('invite', ip='127.0.0.1', port=bob_daemon.daemon_port)
+    alice.expect('connected')
+    bob.expect('connected')
+    assert alice_daemon.session_extensions == bob_daemon.session_extensions == set(SUPPORTED_EXTENSIONS)
+    
+    alice.command('send', text='hello', id='m-1')
+    alice.command('send', text='no receipt wanted')
+    assert bob.expect('message')['text'] == 'hello'
+    assert bob.expect('message')['text'] == 'no receipt wanted'
+    receipt = alice.expect('delivered')
+    assert receipt['id'] == 'm-1' and receipt['attempts'] == '1' and float(receipt['rtt_ms']) >= 0
+    
+    wait_until(lambda: alice_daemon.stats()['delivered'] == 2)
+    assert alice_daemon.stats()['ack_rtt_count'] == 2
+    assert bob_daemon.stats()['one_way_count'] == 2
+    print(f"PASS: Receipt with rtt {receipt['rtt_ms']} ms")
+
+
+def test_receipts_not_used_with_legacy_peer(make_daemon, make_client, make_peer):
+    """A peer that offers no extensions gets plain chat payloads and plain ACKs."""
+    simp_daemon = make_daemon()
+    client = make_client(simp_daemon)
+    peer = make_peer()
+    client.command('invite', ip='127.0.0.1', port=peer.getsockname()[1])
+    syn, daemon_addr = peer.recvfrom(4096)
+    options, early_data = split_syn_options(parse_simp_message(syn)["payload"])
+    assert options['ext'] == EXT and early_data == ""
+    peer.sendto(build_simp_message(MessageType.CONTROL, 0x06, 0, "old"), daemon_addr)
+    assert parse_simp_message(peer.recvfrom(4096)[0])["operation"] == 0x04
+    client.expect('connected')
+    
+    client.command('send', text='plain', id='x')
+    chat = parse_simp_message(peer.recvfrom(4096)[0])
+    assert chat["payload"] == "plain"
+    peer.sendto(build_simp_message(MessageType.CONTROL, 0x04, chat["seq"], "old"), daemon_addr)
+    assert client.expect('delivered')['id'] == 'x'
+    
+    # Skewed clocks are counted, not recorded as latency
+    simp_daemon.record_one_way_latency(int((time.time() + 5) * 1e6))
+    assert simp_daemon.stats()['one_way_skewed'] == 1
+    print("PASS: No extension with a legacy peer")
+
+
+# ----------------------------------------------------------
+# 10. Compact headers
+# ----------------------------------------------------------
+def test_compact_header_session(make_daemon, make_client, make_peer):
+    """After the handshake binds session IDs, datagrams carry a 7-byte header instead of the username."""
+    print("\n[TEST] Compact headers")
+    compact = build_compact_message(MessageType.CONTROL, 0x04, 1, 0x42, "id")
+    assert len(compact) == 7 + 2
+    assert parse_simp_message(compact, {0x42: "ivan"})["username"] == "ivan"
+    with pytest.raises(ValueError):
+        parse_simp_message(compact, {0x43: "ivan"})
+    assert PriorityDispatcher.classify(compact) == PriorityDispatcher.classify(build_simp_message(
+        MessageType.CONTROL, 0x04, 1, "ivan"))
+    
+    simp_daemon = make_daemon(extensions='compact')
+    simp_daemon.auto_accept = True
+    client = make_client(simp_daemon, 'heidi')
+    peer = make_peer()
+    daemon_addr = ('127.0.0.1', simp_daemon.daemon_port)
+    peer.sendto(build_simp_message(MessageType.CONTROL, 0x02, 0, "ivan", add_syn_options(
+        {'ext': 'compact', 'sid': '0042'})), daemon_addr)
+    options, _ = split_syn_options(parse_simp_message(peer.recvfrom(4096)[0])["payload"])
+    assert options['ext'] == 'compact'
+    daemon_sid = int(options['sid'], 16)
+    peer.sendto(build_simp_message(MessageType.CONTROL, 0x04, 0, "ivan"), daemon_addr)
+    client.expect('connected')
+    
+    client.command('send', text='hi')
+    data = peer.recvfrom(4096)[0]
+    assert len(data) == 7 + 2
+    chat = parse_simp_message(data, {daemon_sid: "heidi"})
+    assert (chat["type"], chat["seq"], chat["payload"]) == (MessageType.CHAT.value, 0, "hi")
+    peer.sendto(build_compact_message(MessageType.CONTROL, 0x04, 0, 0x42), daemon_addr)
+    peer.sendto(build_compact_message(MessageType.CHAT, 0x01, 0, 0x42, "hello"), daemon_addr)
+    assert client.expect('message') == {'command': 'message', 'username': 'ivan', 'text': 'hello'}
+    wait_until(lambda: simp_daemon.stats()['delivered'] == 1)
+    print("PASS: Compact session")
+
+
+# ----------------------------------------------------------
+# 11. Invitation queue
+# ----------------------------------------------------------
+def test_invitation_queue(make_daemon, make_client, make_peer):
+    """Invitations queue up per peer; accept and decline pick one; extra and stray datagrams change nothing."""
+    print("\n[TEST] Invitation queue")
+    simp_daemon = make_daemon(invitation_queue_size=2)
+    client = make_client(simp_daemon, 'olga')
+    daemon_addr = ("127.0.0.1", simp_daemon.daemon_port)
+    alice, bob, carol = make_peer(), make_peer(), make_peer()
+    syn = lambda name: build_simp_message(MessageType.CONTROL, 0x02, 0, name)
+    
+    alice.sendto(syn("alice"), daemon_addr)
+    bob.sendto(syn("bob"), daemon_addr)
+    assert client.expect('invitation')['username'] == 'alice'
+    assert client.expect('invitation') == {'command': 'invitation', 'username': 'bob', 'ip': '127.0.0.1',
+                                           'port': str(bob.getsockname()[1])}
+    alice.sendto(syn("alice"), daemon_addr)  # retransmission, no new invitation
+    
+    # The queue is full: carol is turned away at once instead of waiting for a timeout
+    carol.sendto(syn("carol"), daemon_addr)
+    assert parse_simp_message(carol.recvfrom(4096)[0])["operation"] == 0x01
+    assert parse_simp_message(carol.recvfrom(4096)[0])["operation"] == 0x08
+    # Neither her ACK nor her FIN touch anyone else's state
+    carol.sendto(build_simp_message(MessageType.CONTROL, 0x04, 0, "carol"), daemon_addr)
+    carol.sendto(build_simp_message(MessageType.CONTROL, 0x08, 0, "carol"), daemon_addr)
+    
+    client.command('accept', ip='127.0.0.1', port=bob.getsockname()[1])
+    assert parse_simp_message(bob.recvfrom(4096)[0])["operation"] == 0x06
+    assert not simp_daemon.in_chat and len(simp_daemon.invitations) == 2
+    bob.sendto(build_simp_message(MessageType.CONTROL, 0x04, 0, "bob"), daemon_addr)
+    assert client.expect('connected')['username'] == 'bob'
+    
+    # Alice is told right away, her invitation is gone
+    assert parse_simp_message(alice.recvfrom(4096)[0])["operation"] == 0x01
+    assert parse_simp_message(alice.recvfrom(4096)[0])["operation"] == 0x08
+    assert not simp_daemon.invitations
+    print("PASS: Invitation queue")
+
+
+def test_reinvite_replaces_invitation(make_daemon, make_client, make_peer):
+    """A new handshake from a peer with a pending invitation replaces it, a retransmission does not."""
+    print("\n[TEST] Re-invitation")
+    simp_daemon = make_daemon()
+    client = make_client(simp_daemon, 'olga')
+    daemon_addr = ("127.0.0.1", simp_daemon.daemon_port)
+    peer = make_peer()
+    syn = lambda text: build_simp_message(MessageType.CONTROL, 0x02, 0, "lena", text)
+    
+    peer.sendto(syn("first try"), daemon_addr)
+    client.expect('invitation')
+    peer.sendto(syn("first try"), daemon_addr)  # retransmission
+    # The peer's connect deadline ran out and it invites again, with another first message
+    peer.sendto(syn("second try"), daemon_addr)
+    client.expect('invitation')
+    client.command('accept')
+    assert parse_simp_message(peer.recvfrom(4096)[0])["operation"] == 0x06
+    peer.sendto(build_simp_message(MessageType.CONTROL, 0x04, 0, "lena"), daemon_addr)
+    client.expect('connected')
+    assert client.expect('message')['text'] == "second try"
+    print("PASS: Re-invitation replaces the old one")
+
+
+def test_invitation_expiry_sends_fin(make_daemon, make_client, make_peer):
+    """An unanswered invitation expires with a FIN to the inviter; decline targets one invitation."""
+    simp_daemon = make_daemon(invitation_ttl=0.3)
+    client = make_client(simp_daemon, 'olga')
+    daemon_addr = ("127.0.0.1", simp_daemon.daemon_port)
+    dave, erin = make_peer(), make_peer()
+    dave.sendto(build_simp_message(MessageType.CONTROL, 0x02, 0, "dave"), daemon_addr)
+    erin.sendto(build_simp_message(MessageType.CONTROL, 0x02, 0, "erin"), daemon_addr)
+    client.expect('invitation')
+    client.expect('invitation')
+    
+    client.command('decline', ip='127.0.0.1', port=erin.getsockname()[1])
+    assert parse_simp_message(erin.recvfrom(4096)[0])["operation"] == 0x08
+    assert parse_simp_message(dave.recvfrom(4096)[0])["operation"] == 0x08
+    assert client.expect('invitation_expired')['username'] == 'dave'
+    assert not simp_daemon.invitations
+
+
+# ----------------------------------------------------------
+# 12. Handshake retransmission
+# ----------------------------------------------------------
+def test_syn_retransmitted_until_answered(make_daemon, make_client, make_peer):
+    """A lost SYN is resent with backoff; a duplicate SYN+ACK gets the final ACK again."""
+    print("\n[TEST] SYN retransmission")
+    simp_daemon = make_daemon(timeout=0.1, handshake_timeout=5)
+    client = make_client(simp_daemon, 'lena')
+    peer, stranger = make_peer(), make_peer()
+    client.command('invite', ip='127.0.0.1', port=peer.getsockname()[1])
+    # Drop the first SYN, answer the retransmission
+    first, daemon_addr = peer.recvfrom(4096)
+    assert parse_simp_message(peer.recvfrom(4096)[0]) == parse_simp_message(first)
+    
+    # A SYN+ACK from anyone else does not complete the handshake
+    stranger.sendto(build_simp_message(MessageType.CONTROL, 0x06, 0, "mallory"), daemon_addr)
+    syn_ack = build_simp_message(MessageType.CONTROL, 0x06, 0, "mike")
+    peer.sendto(syn_ack, daemon_addr)
+    assert client.expect('connected')['username'] == 'mike'
+    
+    # Our final ACK "was lost": the repeated SYN+ACK is answered again
+    peer.sendto(syn_ack, daemon_addr)
+    acks = 0
+    while acks < 2:
+        msg = parse_simp_message(peer.recvfrom(4096)[0])
+        if msg["operation"] == 0x04:
+            acks += 1
+        else:
+            assert msg["operation"] == 0x02  # retransmissions sent before the SYN+ACK arrived
+    
+    stats = simp_daemon.stats()
+    assert simp_daemon.chat_partner == peer.getsockname()
+    assert stats['syn_retransmits'] >= 1 and stats['final_acks_resent'] == 1
+    assert stats['connect_count'] == 1 and stats['connect_p50_ms'] >= 100
+    print(f"PASS: Connected after {stats['syn_retransmits']} retransmission(s) in {stats['connect_p50_ms']} ms")
+
+
+def test_connect_deadline(make_daemon, make_client, make_peer):
+    """An unanswered handshake gives up at the deadline, tells the client and withdraws with a FIN."""
+    simp_daemon = make_daemon(timeout=0.05, handshake_timeout=0.5)
+    client = make_client(simp_daemon, 'lena')
+    peer = make_peer()
+    client.command('invite', ip='127.0.0.1', port=peer.getsockname()[1])
+    assert client.expect('error')['message'] == "Connection timed out"
+    
+    ops = []
+    while not ops or ops[-1] != 0x08:
+        ops.append(parse_simp_message(peer.recvfrom(4096)[0])["operation"])
+    assert set(ops[:-1]) == {0x02} and len(ops) - 1 == 1 + simp_daemon.counters['syn_retransmits']
+    assert simp_daemon.connecting is None and simp_daemon.counters['connect_timeouts'] == 1
+
+
+def test_syn_ack_retransmitted(make_daemon, make_peer):
+    """The responder resends its SYN+ACK until the final ACK arrives."""
+    simp_daemon = make_daemon(timeout=0.1)
+    daemon_addr = ("127.0.0.1", simp_daemon.daemon_port)
+    peer = make_peer()
+    peer.sendto(build_simp_message(MessageType.CONTROL, 0x02, 0, "nina"), daemon_addr)
+    assert parse_simp_message(peer.recvfrom(4096)[0])["operation"] == 0x06
+    assert parse_simp_message(peer.recvfrom(4096)[0])["operation"] == 0x06
+    peer.sendto(build_simp_message(MessageType.CONTROL, 0x04, 0, "nina"), daemon_addr)
+    
+    wait_until(lambda: simp_daemon.in_chat)
+    assert simp_daemon.counters['syn_ack_retransmits'] >= 1
+    # No more SYN+ACKs once the session is open
+    retransmits = simp_daemon.counters['syn_ack_retransmits']
+    time.sleep(0.5)
+    assert simp_daemon.counters['syn_ack_retransmits'] == retransmits
+
+
+# ----------------------------------------------------------
+# 13. SYN cookies under load
+# ----------------------------------------------------------
+def test_syn_cookies_under_load(make_daemon, make_peer):
+    """Once the global budget is half spent, new SYNs must echo a cookie first."""
+    print("\n[TEST] SYN cookies under load")
+    simp_daemon = make_daemon(global_rate=10)
+    daemon_addr = ("127.0.0.1", simp_daemon.daemon_port)
+    
+    # 15 SYNs from distinct sources use up more than half of the burst of 20
+    flood = [make_peer() for _ in range(15)]
+    for i, sock in enumerate(flood):
+        sock.sendto(build_simp_message(MessageType.CONTROL, 0x02, 0, f"flood{i}"), daemon_addr)
+    for sock in flood:
+        sock.recvfrom(4096)
+    
+    peer = make_peer()
+    peer.sendto(build_simp_message(MessageType.CONTROL, 0x02, 0, "ivan", "hi"), daemon_addr)
+    retry = parse_simp_message(peer.recvfrom(4096)[0])
+    assert retry["operation"] == 0x03, f"Expected RETRY, got {retry['operation']}"
+    
+    # A wrong cookie gets another RETRY, the right one an invitation
+    peer.sendto(build_simp_message(MessageType.CONTROL, 0x02, 0, "ivan", add_syn_cookie("0" * 16, "hi")), daemon_addr)
+    assert parse_simp_message(peer.recvfrom(4096)[0])["operation"] == 0x03
+    peer.sendto(build_simp_message(MessageType.CONTROL, 0x02, 0, "ivan", add_syn_cookie(retry["payload"], "hi")), daemon_addr)
+    assert parse_simp_message(peer.recvfrom(4096)[0])["operation"] == (0x02 | 0x04)
+    assert simp_daemon.invitations[peer.getsockname()]['username'] == "ivan"
+    
+    stats = simp_daemon.stats()
+    assert stats['syn_cookies_sent'] >= 2 and stats['syn_cookies_valid'] == 1 and stats['syn_cookies_invalid'] == 1
+    print("PASS: Cookie required under load, invitation created after echo")
+
+
+def test_initiator_answers_retry(daemon, make_client, make_peer):
+    """A daemon whose SYN gets a RETRY repeats it once with the cookie and its first message."""
+    print("\n[TEST] Initiator answers RETRY")
+    client = make_client(daemon, 'judy')
+    peer = make_peer()
+    client.command('invite', ip='127.0.0.1', port=peer.getsockname()[1], text='early')
+    _, daemon_addr = peer.recvfrom(4096)
+    
+    peer.sendto(build_simp_message(MessageType.CONTROL, 0x03, 0, "kate", "c00kie"), daemon_addr)
+    syn = parse_simp_message(peer.recvfrom(4096)[0])
+    assert syn["operation"] == 0x02
+    cookie, payload = split_syn_cookie(syn["payload"])
+    options, early_data = split_syn_options(payload)
+    assert cookie == "c00kie" and options['ext'] == EXT and early_data == "early"
+    
+    # Only one retry per connection attempt
+    peer.sendto(build_simp_message(MessageType.CONTROL, 0x03, 0, "kate", "again"), daemon_addr)
+    peer.settimeout(0.3)
+    with pytest.raises(socket.timeout):
+        peer.recvfrom(4096)
+    print("PASS: SYN repeated with cookie")
+
+
+def test_per_source_rate_limit(make_daemon, make_peer):
+    """A single noisy source is cut off at its own budget and does not starve others."""
+    print("\n[TEST] Per-source rate limit")
+    simp_daemon = make_daemon(source_rate=5)
+    daemon_addr = ("127.0.0.1", simp_daemon.daemon_port)
+    noisy = make_peer()
+    for _ in range(40):
+        noisy.sendto(build_simp_message(MessageType.CONTROL, 0x02, 0, "noisy"), daemon_addr)
+    
+    quiet = make_peer()
+    quiet.sendto(build_simp_message(MessageType.CONTROL, 0x02, 1, "quiet"), daemon_addr)
+    assert parse_simp_message(quiet.recvfrom(4096)[0])["operation"] == (0x02 | 0x04)
+    
+    stats = simp_daemon.stats()
+    assert stats['rl_limited_source'] >= 25, stats
+    assert stats['rl_limited_global'] == 0 and stats['rl_sources'] == 2
+    print(f"PASS: {stats['rl_limited_source']} datagrams from the noisy source dropped")
+
+
+# ----------------------------------------------------------
+# 14. Concurrent sessions
+# ----------------------------------------------------------
+def test_concurrent_sessions_stress(make_daemon, make_client):
+    """Busy sessions in both directions with retransmissions: every message delivered once, in order."""
+    print("\n[TEST] Concurrent sessions stress")
+    count, pairs = 100, 3
+    clients = []
+    for i in range(pairs):
+        # A short timeout makes spurious retransmissions and late ACKs likely under load
+        left, right = (make_daemon(timeout=0.2, send_queue_size=count, keepalive_interval=0.25) for _ in range(2))
+        right.auto_accept = True
+        a, b = make_client(left, f'left{i}'), make_client(right, f'right{i}')
+        a.command('invite', ip='127.0.0.1', port=right.daemon_port)
+        a.expect('connected')
+        b.expect('connected')
+        clients += [(a, left, f'right{i}'), (b, right, f'left{i}')]
+    
+    received = {id(client): [] for client, _, _ in clients}
+    delivered = {id(client): set() for client, _, _ in clients}
+    
+    def collect(client):
+        while len(received[id(client)]) < count or len(delivered[id(client)]) < count:
+            msg = client.recv()
+            if msg['command'] == 'message':
+                received[id(client)].append(msg['text'])
+            elif msg['command'] == 'delivered':
+                delivered[id(client)].add(msg['id'])
+    
+    def hammer(client, name):
+        for k in range(count):
+            client.command('send', text=f"{name}-{k}", id=str(k))
+            if k % 10 == 0:
+                client.command('stats')  # client commands interleave with the session's handlers
+    
+    # Switch threads as often as possible to provoke interleaving
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-5)
+    threads = [threading.Thread(target=collect, args=(client,)) for client, _, _ in clients]
+    threads += [threading.Thread(target=hammer, args=(client, daemon.username))
+                for client, daemon, _ in clients]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            thread.join(timeout=60)
+    finally:
+        sys.setswitchinterval(switch_interval)
+    
+    for client, daemon, partner in clients:
+        assert received[id(client)] == [f"{partner}-{k}" for k in range(count)]
+        assert delivered[id(client)] == {str(k) for k in range(count)}
+        assert daemon.in_chat and daemon.stats()['dispatch_task_errors'] == 0
+    retransmits = sum(daemon.counters['retransmits'] for _, daemon, _ in clients)
+    print(f"PASS: {2 * pairs} senders, {2 * pairs * count} messages, {retransmits} retransmissions, no duplicates")
+
+
+# ----------------------------------------------------------
+# 15. Session buffer overflow
+# ----------------------------------------------------------
+def test_session_buffer_drop_oldest(make_daemon, make_client, make_peer):
+    """With a silent peer the drop_oldest buffer stays at its size and reports what it dropped."""
+    print("\n[TEST] Session buffer drop_oldest")
+    simp_daemon = make_daemon(send_queue_size=4, buffer_policy='drop_oldest', timeout=5, extensions='')
+    simp_daemon.auto_accept = True
+    client = make_client(simp_daemon, 'sven')
+    daemon_addr = ("127.0.0.1", simp_daemon.daemon_port)
+    peer = make_peer()
+    peer.sendto(build_simp_message(MessageType.CONTROL, 0x02, 0, "tess"), daemon_addr)
+    peer.recvfrom(4096)
+    peer.sendto(build_simp_message(MessageType.CONTROL, 0x04, 0, "tess"), daemon_addr)
+    client.expect('connected')
+    
+    # m0 goes out and waits for its ACK, m1..m9 compete for 4 slots
+    for i in range(10):
+        client.command('send', text=f"message {i}", id=f"m{i}")
+    assert [client.expect('dropped')['id'] for _ in range(5)] == ['m1', 'm2', 'm3', 'm4', 'm5']
+    wait_until(lambda: simp_daemon.send_queue.counters['appended'] == 10)
+    stats = simp_daemon.stats()
+    assert stats['send_buffer_items'] == 4 and stats['send_buffer_dropped'] == 5
+    assert stats['memory_used'] >= stats['send_buffer_capacity'] == SESSION_BUFFER
+    
+    def next_chat():
+        while (msg := parse_simp_message(peer.recvfrom(4096)[0]))["type"] != MessageType.CHAT.value:
+            pass
+        return msg["payload"]
+    
+    assert next_chat() == "message 0"
+    peer.sendto(build_simp_message(MessageType.CONTROL, 0x04, 0, "tess"), daemon_addr)
+    assert next_chat() == "message 6"
+    print("PASS: Oldest queued messages dropped, buffer bounded")
+
+
+# =======================================================================
+# === TIMER WHEEL TESTS ===
+# =======================================================================
+
+class FakeClock:
+    """Manually advanced clock for deterministic timer tests."""
+    def __init__(self):
+        self.now = 0.0
+    
+    def __call__(self):
+        return self.now
+
+
+def test_timer_wheel_fires_in_order():
+    """Timers on every level of the wheel fire once, in deadline order, never early."""
+    clock = FakeClock()
+    wheel = TimerWheel(tick=0.01, clock=clock)
+    fired = []
+    delays = [0.005, 0.3, 0.64, 0.65, 5.0, 41.0, 300.0]
+    for delay in delays:
+        wheel.schedule(delay, lambda d=delay: fired.append((d, clock.now)))
+    
+    assert abs(wheel.next_expiry() - 0.005) < 1e-9
+    while clock.now < 400:
+        clock.now += 0.05
+        wheel.advance()
+    
+    assert [d for d, _ in fired] == delays
+    assert all(at >= d for d, at in fired), "Timer fired before its deadline"
+    assert wheel.stats()['timers_active'] == 0
+    print("PASS: Timer wheel ordering")
+
+
+def test_timer_wheel_cancel():
+    """Cancelled timers never fire and free their slot."""
+    clock = FakeClock()
+    wheel = TimerWheel(tick=0.01, clock=clock)
+    fired = []
+    timers = [wheel.schedule(1.0 + i * 0.01, fired.append, i) for i in range(1000)]
+    for timer in timers[::2]:
+        wheel.cancel(timer)
+    assert wheel.stats()['timers_active'] == 500
+    
+    clock.now = 20.0
+    wheel.advance()
+    assert fired == list(range(1, 1000, 2))
+    assert wheel.next_expiry() is None
+    print("PASS: Timer wheel cancel")
+
+
+def test_timer_wheel_reports_errors(caplog):
+    """A callback that raises goes to on_error, or the log without one, and the timers after it still fire."""
+    clock = FakeClock()
+    errors, fired = [], []
+    wheel = TimerWheel(tick=0.01, clock=clock, on_error=lambda e, fn: errors.append((type(e), fn)))
+    fail = lambda: 1 / 0
+    wheel.schedule(0.1, fail)
+    wheel.schedule(0.2, fired.append, "after")
+    clock.now = 1.0
+    assert wheel.advance() == 2
+    assert errors == [(ZeroDivisionError, fail)] and fired == ["after"]
+    
+    wheel = TimerWheel(tick=0.01, clock=clock)
+    wheel.schedule(0.1, fail)
+    clock.now = 2.0
+    assert wheel.advance() == 1
+    assert [record.exc_info[0] for record in caplog.records] == [ZeroDivisionError]
+    print("PASS: Timer wheel errors reported")
+
+
+# =======================================================================
+# === RATE LIMITER TESTS ===
+# =======================================================================
+
+def test_rate_limiter_buckets_and_lru():
+    """Buckets refill at their rate, and the source table stays bounded."""
+    clock = FakeClock()
+    limiter = RateLimiter(source_rate=1, global_rate=100, max_sources=3, clock=clock)
+    assert [limiter.allow('a') for _ in range(3)] == [True, True, False]
+    clock.now += 1.0
+    assert limiter.allow('a') and not limiter.allow('a')
+    
+    # 'a' is the most recently used, 'b' gets evicted by 'd'
+    for addr in ('b', 'c', 'a', 'd'):
+        limiter.allow(addr)
+    assert list(limiter.sources) == ['c', 'a', 'd']
+    assert limiter.stats()['rl_evicted'] == 1
+    assert not limiter.under_load()
+    
+    busy = RateLimiter(source_rate=1000, global_rate=10, clock=clock)
+    for _ in range(11):
+        busy.allow('x')
+    assert busy.under_load()
+    print("PASS: Token buckets and LRU table")
+
+
+def test_syn_cookies_expire():
+    """A cookie is bound to address and username and valid for one to two lifetimes."""
+    clock = FakeClock()
+    cookies = SynCookies(lifetime=10, clock=clock)
+    cookie = cookies.make(('10.0.0.1', 7777), 'alice')
+    assert cookies.check(cookie, ('10.0.0.1', 7777), 'alice')
+    assert not cookies.check(cookie, ('10.0.0.2', 7777), 'alice')
+    assert not cookies.check(cookie, ('10.0.0.1', 7777), 'mallory')
+    clock.now = 15
+    assert cookies.check(cookie, ('10.0.0.1', 7777), 'alice')
+    clock.now = 25
+    assert not cookies.check(cookie, ('10.0.0.1', 7777), 'alice')
+    print("PASS: SYN cookie validation")
+
+
+# =======================================================================
+# === PRIORITY DISPATCH TESTS ===
+# =======================================================================
+
+def test_dispatcher_serves_control_first():
+    """Control datagrams overtake queued chat, but chat still gets every control_burst-th turn."""
+    dispatcher = PriorityDispatcher(handler=None, queue_size=8, control_burst=3)
+    chat = [build_simp_message(MessageType.CHAT, 0x01, 0, "c", str(i)) for i in range(10)]
+    control = [build_simp_message(MessageType.CONTROL, 0x04, 0, "a", str(i)) for i in range(7)]
+    for data in chat[:2] + control:
+        dispatcher.put(data, ('127.0.0.1', 1))
+    for data in chat[2:]:
+        dispatcher.put(data, ('127.0.0.1', 1))
+    
+    order = []
+    while True:
+        item = dispatcher.get(timeout=0)
+        if not item:
+            break
+        msg = parse_simp_message(item[0])
+        order.append(('ack' if msg['type'] == MessageType.CONTROL.value else 'chat') + msg['payload'])
+    assert order == ['ack0', 'ack1', 'ack2', 'chat0', 'ack3', 'ack4', 'ack5', 'chat1', 'ack6',
+                     'chat2', 'chat3', 'chat4', 'chat5', 'chat6', 'chat7']
+    stats = dispatcher.stats()
+    assert stats['dispatch_chat_dropped'] == 2 and stats['dispatch_control_dropped'] == 0
+    print("PASS: Control first, chat not starved, queues bounded")
+
+
+def test_dispatcher_runs_tasks_first():
+    """Submitted tasks run on the worker, in order and ahead of queued datagrams."""
+    order, errors = [], []
+    dispatcher = PriorityDispatcher(handler=lambda data, addr: order.append(parse_simp_message(data)['payload']),
+                                    on_error=lambda e, fn: errors.append(type(e)))
+    dispatcher.put(build_simp_message(MessageType.CHAT, 0x01, 0, "c", "chat"), ('127.0.0.1', 1))
+    dispatcher.submit(lambda: order.append(threading.current_thread()))
+    dispatcher.submit(order.append, "task")
+    dispatcher.submit(lambda: 1 / 0)
+    dispatcher.start()
+    wait_until(lambda: len(order) == 3)
+    dispatcher.stop()
+    assert order[0] is dispatcher._thread and order[1:] == ["task", "chat"]
+    assert dispatcher.stats()['dispatch_tasks_run'] == 3 and dispatcher.stats()['dispatch_task_errors'] == 1
+    assert errors == [ZeroDivisionError]
+
+
+# =======================================================================
+# === RING BUFFER TESTS ===
+# =======================================================================
+
+def test_ring_buffer_policies():
+    """Records wrap around the preallocated buffer; full buffers reject, drop the oldest or spill."""
+    budget = MemoryBudget(100)
+    ring = RingBuffer(32, policy='reject', budget=budget)
+    assert budget.used == 32
+    for i in range(3):
+        assert ring.append(bytes([i]) * 10)
+    assert not ring.append(b"x" * 10) and ring.stats('r')['r_rejected'] == 1
+    assert ring.popleft() == bytes([0]) * 10 and ring.popleft() == bytes([1]) * 10
+    # Wraps to the start of the buffer
+    assert ring.append(b"a" * 12) and ring.append(b"b" * 8)
+    assert ring.items() == [bytes([2]) * 10, b"a" * 12, b"b" * 8] and ring.used == 30
+    assert not ring.append(b"c" * 4)
+    with pytest.raises(MemoryError):
+        RingBuffer(80, budget=budget)
+    ring.close()
+    assert budget.used == 0
+    
+    dropped = []
+    ring = RingBuffer(32, max_items=3, policy='drop_oldest', on_drop=dropped.append)
+    for i in range(6):
+        assert ring.append(str(i).encode() * 8)
+    assert dropped == [b"0" * 8, b"1" * 8, b"2" * 8] and len(ring) == 3
+    assert ring.append(b"z" * 30) and len(dropped) == 6 and ring.items() == [b"z" * 30]
+    
+    ring = RingBuffer(16, policy='spill')
+    records = [str(i).encode() * 6 for i in range(6)]
+    for record in records[:4]:
+        assert ring.append(record)
+    assert ring.stats('r')['r_spilled'] == 2 and ring.items() == records[:4]
+    assert ring.popleft() == records[0]
+    ring.append(records[4])  # the ring has room again, but the spilled records are older
+    ring.append(records[5])
+    assert [ring.popleft() for _ in range(5)] == records[1:] and len(ring) == 0
+    ring.close()
+
+
+# =======================================================================
+# === EVENT LOG TESTS ===
+# =======================================================================
+
+def test_event_log_levels_sampling_and_drops():
+    """Events below the level are filtered, info is sampled, a full queue drops instead of blocking."""
+    stream = io.StringIO()
+    log = EventLog(stream, level='info', sample=0.5, queue_size=100, seed=1)
+    assert not log.debug('noise')
+    kept = sum(log.info('tick', seq=i) for i in range(100))
+    assert 30 < kept < 70 and log.sampled_out == 100 - kept
+    
+    # The writer is not running yet: the queue fills up and further events are dropped
+    errors = sum(log.error('boom', n=i) for i in range(100))
+    assert errors == 100 - kept and log.dropped == kept
+    
+    log.start()
+    log.stop()
+    records = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert len(records) == 100 and records[-1]['event'] == 'boom' and records[-1]['level'] == 'error'
+    assert log.stats()['log_written'] == 100
+    print("PASS: Event log levels, sampling and drops")
+
+
+def test_daemon_event_log(make_daemon, make_peer, tmp_path):
+    """The daemon writes session and per-datagram events as JSON lines."""
+    log_file = tmp_path / "events.jsonl"
+    simp_daemon = make_daemon(log_level='debug', log_file=str(log_file))
+    daemon_addr = ("127.0.0.1", simp_daemon.daemon_port)
+    peer = make_peer()
+    peer.sendto(build_simp_message(MessageType.CONTROL, 0x02, 0, "lena"), daemon_addr)
+    peer.recvfrom(4096)
+    peer.sendto(build_simp_message(MessageType.CONTROL, 0x04, 0, "lena"), daemon_addr)
+    wait_until(lambda: simp_daemon.in_chat)
+    simp_daemon.dispatcher.submit(lambda: 1 / 0)
+    wait_until(lambda: simp_daemon.dispatcher.task_errors == 1)
+    simp_daemon.stop()
+    assert simp_daemon.log_stream.closed
+    
+    events = [json.loads(line) for line in log_file.read_text().splitlines()]
+    assert [e['error'] for e in events if e['event'] == 'callback_error'] == ["division by zero"]
+    peer_addr = "127.0.0.1:%d" % peer.getsockname()[1]
+    assert {'event': 'recv', 'peer': peer_addr, 'op': 0x02}.items() <= events[0].items()
+    opened = [e for e in events if e['event'] == 'session_open']
+    assert opened and opened[0]['session'] == 1 and opened[0]['peer'] == peer_addr
+    print("PASS: Daemon event log")
+
+
+# =======================================================================
+# === PROFILING TESTS ===
+# =======================================================================
+
+def chat_with_peer(simp_daemon, peer, messages=3):
+    """Open a chat from peer to an auto-accepting daemon and send it some messages."""
+    daemon_addr = ("127.0.0.1", simp_daemon.daemon_port)
+    simp_daemon.auto_accept = True
+    peer.sendto(build_simp_message(MessageType.CONTROL, 0x02, 0, "mona"), daemon_addr)
+    peer.recvfrom(4096)
+    peer.sendto(build_simp_message(MessageType.CONTROL, 0x04, 0, "mona"), daemon_addr)
+    wait_until(lambda: simp_daemon.in_chat)
+    for i in range(messages):
+        peer.sendto(build_simp_message(MessageType.CHAT, 0x01, i % 2, "mona", f"m{i}"), daemon_addr)
+        assert parse_simp_message(peer.recvfrom(4096)[0])["operation"] == 0x04
+
+
+def test_handler_timing_toggle(make_daemon, make_client, make_peer):
+    """Handler timing is switched on and off at runtime and leaves no wrapper behind."""
+    simp_daemon = make_daemon()
+    client = make_client(simp_daemon)
+    client.command('timing', action='on')
+    assert client.recv()['command'] == 'ok'
+    chat_with_peer(simp_daemon, make_peer())
+    # The last handler call is counted just after its ACK went out
+    wait_until(lambda: simp_daemon.handler_timers.calls['handle_daemon_message'] >= 5)
+    
+    client.command('timing', action='off')
+    client.expect('ok')
+    assert 'handle_daemon_message' not in vars(simp_daemon)
+    assert simp_daemon.dispatcher.handler.__func__ is SimpDaemon.handle_daemon_message
+    client.command('stats')
+    stats = client.expect('stats')
+    assert int(stats['time_handle_daemon_message_calls']) >= 5
+    assert int(stats['time_handle_chat_message_calls']) == 3
+    print("PASS: Handler timing toggled at runtime")
+
+
+@pytest.mark.parametrize("mode", ["cprofile", "sample"])
+def test_profile_running_daemon(make_daemon, make_client, make_peer, tmp_path, mode):
+    """A profiling session is started and stopped over the client port and dumped to a file."""
+    simp_daemon = make_daemon(profile_dir=str(tmp_path))
+    client = make_client(simp_daemon)
+    client.command('profile', action='start', mode=mode, interval=0.001)
+    assert client.recv()['status'] == 'started'
+    chat_with_peer(simp_daemon, make_peer(), messages=20)
+    # The daemon picks the file name, a path from the client is ignored
+    client.command('profile', action='stop', path=str(tmp_path / "elsewhere"))
+    reply = client.expect('profile')
+    path = tmp_path / os.path.basename(reply['path'])
+    assert reply['status'] == 'stopped' and reply['path'] == str(path) and path.exists()
+    assert os.listdir(tmp_path) == [path.name]
+    
+    if mode == 'cprofile':
+        functions = {func for _, _, func in pstats.Stats(str(path)).stats}
+        assert 'handle_chat_message' in functions
+    else:
+        stacks = path.read_text().splitlines()
+        assert stacks and all(line.rsplit(' ', 1)[1].isdigit() for line in stacks)
+    assert not simp_daemon.profiler.active
+    print(f"PASS: {mode} profile written")
+
+
+def test_profiling_only_from_registered_client(make_daemon, make_client, tmp_path):
+    """Profiling and timing commands from any other local socket are refused."""
+    simp_daemon = make_daemon(profile_dir=str(tmp_path))
+    make_client(simp_daemon)
+    stranger = make_client(simp_daemon, username=None)
+    stranger.command('profile', action='start')
+    assert stranger.recv()['command'] == 'error'
+    stranger.command('timing', action='on')
+    assert stranger.recv()['command'] == 'error'
+    assert not simp_daemon.profiler.active and not simp_daemon.handler_timers.enabled
+    stranger.command('stats')
+    assert stranger.recv()['command'] == 'stats'
+    print("PASS: Profiling refused from an unregistered socket")
+
+
+# =======================================================================
+# === FILE TRANSFER TESTS ===
+# =======================================================================
+
+def test_file_transfer_between_daemons(make_daemon, make_client, tmp_path):
+    """A file crosses in MTU-sized chunks, and a partial file from an earlier attempt is resumed."""
+    print("\n[TEST] File transfer")
+    data = os.urandom(300_000)
+    source = tmp_path / "notes.log"
+    source.write_bytes(data)
+    downloads = tmp_path / "in"
+    
+    alice_daemon, bob_daemon = make_daemon(), make_daemon(download_dir=str(downloads))
+    bob_daemon.auto_accept = True
+    alice, bob = make_client(alice_daemon, 'alice'), make_client(bob_daemon, 'bob')
+    alice.command('invite', ip='127.0.0.1', port=bob_daemon.daemon_port)
+    alice.expect('connected')
+    bob.expect('connected')
+    # Only alice's registered client may send her files
+    stranger = make_client(alice_daemon, username=None)
+    stranger.command('sendfile', path=str(source))
+    assert stranger.recv()['command'] == 'error'
+    # Bob's daemon refuses files until accepting them is switched on
+    alice.command('sendfile', path=str(source))
+    assert alice.expect('file_failed')['reason'] == 'peer: refused'
+    assert bob.expect('file_refused')['size'] == str(len(data))
+    assert not downloads.exists()
+    bob_daemon.transfers.accept = True
+    
+    alice.command('sendfile', path=str(source))
+    assert alice.expect('file_offered')['size'] == str(len(data))
+    sent = alice.expect('file_sent')
+    received = bob.expect('file_received')
+    assert received['path'] == str(downloads / "notes.log")
+    assert (downloads / "notes.log").read_bytes() == data
+    assert sent['bytes'] == received['bytes'] == str(len(data)) and float(sent['mb_s']) > 0
+    
+    # The same file again, with the first 100000 bytes already on disk
+    sha = hashlib.sha256(data).hexdigest()
+    (downloads / f".notes.log.{sha[:16]}.part").write_bytes(data[:100_000])
+    alice.command('sendfile', path=str(source))
+    sent = alice.expect('file_sent')
+    received = bob.expect('file_received')
+    assert sent['resumed_from'] == received['resumed_from'] == '100000'
+    assert received['bytes'] == str(len(data) - 100_000)
+    assert (downloads / "notes.1.log").read_bytes() == data
+    assert bob_daemon.stats()['files_received'] == 2
+    print(f"PASS: File transfer at {sent['mb_s']} MB/s")
+
+
+def test_transfer_engine_recovers_from_loss(tmp_path):
+    """Lost and corrupted chunks are sent again until the checksum matches."""
+    clock = FakeClock()
+    wheel = TimerWheel(tick=0.01, clock=clock)
+    wire = []
+    notes = {'a': [], 'b': []}
+    count = [0]
+    
+    def link(parts, addr):
+        count[0] += 1
+        datagram = b"".join(bytes(part) for part in parts)
+        if count[0] % 7 == 0:
+            return  # lost
+        if count[0] % 11 == 0 and datagram[1] == 0x01:
+            datagram = datagram[:-1] + bytes([datagram[-1] ^ 0xFF])  # corrupted chunk
+        wire.append((addr, datagram))
+    
+    a = TransferEngine(link, lambda cmd, **kw: notes['a'].append((cmd, kw)), wheel, str(tmp_path / "a"),
+                       chunk_size=1000, window=8, timeout=1.0, clock=clock)
+    b = TransferEngine(link, lambda cmd, **kw: notes['b'].append((cmd, kw)), wheel, str(tmp_path / "b"),
+                       chunk_size=1000, window=8, timeout=1.0, clock=clock)
+    a.open('b', 'alice')
+    b.open('a', 'bob')
+    data = os.urandom(50_000)
+    (tmp_path / "blob.bin").write_bytes(data)
+    a.offer(str(tmp_path / "blob.bin"))
+    # The offer goes out once a helper thread has hashed the file
+    while not wire:
+        time.sleep(0.001)
+    
+    while not notes['a'] or notes['a'][-1][0] == 'file_offered':
+        assert clock.now < 60
+        while wire:
+            addr, datagram = wire.pop(0)
+            (b if addr == 'b' else a).handle(parse_simp_message(datagram))
+        clock.now += 0.1
+        wheel.advance()
+    
+    assert notes['a'][-1][0] == 'file_sent' and notes['b'][-1][0] == 'file_received'
+    assert (tmp_path / "b" / "blob.bin").read_bytes() == data
+    assert a.stats()['file_retransmits'] > 0 and b.stats()['file_chunks_rejected'] > 0
+
+
+def test_transfer_offer_hashed_off_the_session_thread(tmp_path):
+    """offer() returns at once, the offer is sent when the hash is posted back."""
+    data = os.urandom(3 << 20)
+    (tmp_path / "big.bin").write_bytes(data)
+    sent, posted = [], []
+    engine = TransferEngine(lambda parts, addr: sent.append(b"".join(bytes(p) for p in parts)),
+                            lambda cmd, **kw: None, TimerWheel(), str(tmp_path),
+                            post=lambda fn, *args: posted.append((fn, args)))
+    engine.open(('127.0.0.1', 1), 'alice')
+    engine.offer(str(tmp_path / "big.bin"))
+    assert not sent
+    deadline = time.monotonic() + 5
+    while not posted:
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+    fn, args = posted.pop()
+    fn(*args)
+    offer = parse_simp_message(sent.pop())['payload'].decode('ascii')
+    assert f"sha256={hashlib.sha256(data).hexdigest()}" in offer
+    engine.close()
+    print("PASS: Offer hashed on a helper thread")
+
+
+def test_transfer_offer_with_bad_checksum_is_refused(tmp_path):
+    """An offer whose SHA-256 is not 64 hex digits never names a file on disk."""
+    sent = []
+    engine = TransferEngine(lambda parts, addr: sent.append(b"".join(bytes(p) for p in parts)),
+                            lambda cmd, **kw: None, TimerWheel(), str(tmp_path / "in"))
+    engine.open(('127.0.0.1', 1), 'bob')
+    for sha256 in ("/../../x" * 8, "A" * 64, "ab" * 31, ""):
+        offer = add_syn_options({'id': '0000000a', 'name': 'x', 'size': 3, 'sha256': sha256})
+        engine.handle({'operation': 0x02, 'payload': offer.encode('ascii')})
+        reply = parse_simp_message(sent.pop())
+        assert reply['operation'] == 0x08 and b'reason=bad_offer' in reply['payload']
+    assert not engine.incoming and not os.path.exists(tmp_path / "in")
+    print("PASS: Bad checksums refused")
+
+
+# =======================================================================
+# === BULK CODEC TESTS ===
+# =======================================================================
+
+def test_bulk_codec_matches_parse_simp_message(tmp_path):
+    """Headers decoded in bulk equal parse_simp_message(), and encoding them gives the log back."""
+    np = pytest.importorskip('numpy')
+    from simp_codec import DatagramLog, encode_records, index_records, summary
+    messages = [
+        build_simp_message(MessageType.CONTROL, 0x02, 0, "alice", "\x01ext=receipts\x01"),
+        build_simp_message(MessageType.CONTROL, 0x06, 0, "bob"),
+        build_simp_message(MessageType.CONTROL, 0x04, 0, "alice"),
+        build_simp_message(MessageType.CHAT, 0x01, 0, "alice", "hello"),
+        build_simp_message(MessageType.CONTROL, 0x04, 0, "bob"),
+        build_simp_message(MessageType.CHAT, 0x01, 1, "a" * 40, "x" * 300),
+    ]
+    path = tmp_path / "capture.simp"
+    path.write_bytes(b"".join(messages))
+    
+    with DatagramLog(str(path)) as log:
+        assert len(log) == len(messages)
+        for i, data in enumerate(messages):
+            expected = parse_simp_message(data)
+            h = log.headers[i]
+            assert (h['type'], h['operation'], h['seq'], h['length']) == \
+                (expected['type'], expected['operation'], expected['seq'], expected['length'])
+            assert h['username'].decode('ascii').strip() == expected['username']
+            assert log.message(i) == expected
+        h = log.headers
+        rebuilt = encode_records(h['type'], h['operation'], h['seq'], h['username'],
+                                 [log.payload(i) for i in range(len(log))])
+        info = summary(h)
+    assert rebuilt == path.read_bytes()
+    assert info['chat'] == 2 and info['ack_ratio'] == 1.0 and info['chat_by_user']['alice'] == 1
+    
+    # Header-only corpora take the array-only path
+    acks = encode_records(np.full(1000, 1), np.full(1000, 4), np.arange(1000) % 2, ["bob"] * 1000)
+    assert acks[:39] == build_simp_message(MessageType.CONTROL, 0x04, 0, "bob")
+    assert np.array_equal(index_records(acks), np.arange(0, 39000, 39))
+    with pytest.raises(ValueError):
+        index_records(path.read_bytes()[:-1])
+
+
+# =======================================================================
+# === HOT RESTART TESTS ===
+# =======================================================================
+
+def take_over(path: str) -> SimpDaemon:
+    """What simp_daemon.py --take-over does, in-process."""
+    conn, sockets, state = receive_handover(path)
+    successor = SimpDaemon(sockets=sockets, handover_socket=path)
+    successor.restore(state)
+    successor.start()
+    conn.sendall(b'ok')
+    conn.close()
+    return successor
+
+
+def test_hot_restart_keeps_session(make_daemon, make_client, make_peer, tmp_path):
+    """A successor inherits the sockets mid-chat: the unacked message, seq state and client carry over."""
+    print("\n[TEST] Hot restart")
+    path = str(tmp_path / 'handover.sock')
+    old = make_daemon(handover_socket=path, keepalive_interval=0)
+    old.auto_accept = True
+    client = make_client(old, 'quinn')
+    daemon_addr = ("127.0.0.1", old.daemon_port)
+    peer = make_peer()
+    peer.sendto(build_simp_message(MessageType.CONTROL, 0x02, 0, "rita"), daemon_addr)
+    assert parse_simp_message(peer.recvfrom(4096)[0])["operation"] == 0x06
+    peer.sendto(build_simp_message(MessageType.CONTROL, 0x04, 0, "rita"), daemon_addr)
+    client.expect('connected')
+    peer.sendto(build_simp_message(MessageType.CHAT, 0x01, 0, "rita", "before"), daemon_addr)
+    assert client.expect('message')['text'] == 'before'
+    # Our message is in flight when the restart happens
+    client.command('send', text='across', id='m-1')
+    chat = parse_simp_message(peer.recvfrom(4096)[0])
+    while chat["type"] != MessageType.CHAT.value:
+        chat = parse_simp_message(peer.recvfrom(4096)[0])
+    
+    successor = take_over(path)
+    try:
+        assert old.stopped.wait(TIMEOUT)
+        assert successor.daemon_port == daemon_addr[1] and successor.client_port == old.client_port
+        assert successor.in_chat and successor.session_id == old.session_id and successor.unacked
+        
+        # The peer notices nothing: its ACK completes the message, a repeat of "before" is a duplicate
+        peer.sendto(build_simp_message(MessageType.CONTROL, 0x04, chat["seq"], "rita"), daemon_addr)
+        assert client.expect('delivered')['id'] == 'm-1'
+        peer.sendto(build_simp_message(MessageType.CHAT, 0x01, 0, "rita", "before"), daemon_addr)
+        peer.sendto(build_simp_message(MessageType.CHAT, 0x01, 1, "rita", "after"), daemon_addr)
+        assert client.expect('message')['text'] == 'after'
+        client.command('send', text='next')
+        while (msg := parse_simp_message(peer.recvfrom(4096)[0]))["type"] != MessageType.CHAT.value:
+            pass
+        assert msg["seq"] == 1 - chat["seq"] and msg["payload"] == "next"
+        assert os.path.exists(path)  # the successor can be taken over in turn
+    finally:
+        successor.stop()
+    print("PASS: Session survived the restart")
+
+
+def test_failed_handover_resumes(make_daemon, make_client, tmp_path):
+    """A successor that never confirms leaves the old daemon serving."""
+    path = str(tmp_path / 'handover.sock')
+    old = make_daemon(handover_socket=path)
+    client = make_client(old, 'quinn')
+    conn, sockets, state = receive_handover(path)
+    assert state['username'] == 'quinn'
+    for sock in sockets:
+        sock.close()
+    conn.close()
+    
+    wait_until(lambda: old.ready.is_set() and all(thread.is_alive() for thread in old.listeners))
+    client.command('stats')
+    assert client.expect('stats')['in_chat'] == '0'
+    assert not old.stopped.is_set()
+
+
+# =======================================================================
+# === TRANSPORT TESTS ===
+# =======================================================================
+
+def test_memory_transport_chat(make_daemon):
+    """Daemons on a MemoryNetwork chat without any socket, the clients being endpoints too."""
+    print("\n[TEST] Memory transport")
+    net = MemoryNetwork()
+    alice_daemon = make_daemon(host='10.0.0.1', transport=net, keepalive_interval=0)
+    bob_daemon = make_daemon(host='10.0.0.2', transport=net, keepalive_interval=0)
+    bob_daemon.auto_accept = True
+
+    def client(daemon, username):
+        endpoint = net.bind('10.0.0.100')
+        daemon_addr = daemon.client_transport.local_address()
+
+        def command(cmd, **kwargs):
+            endpoint.send(build_client_daemon_message(cmd, **kwargs).encode('ascii'), daemon_addr)
+
+        def expect(wanted):
+            while True:
+                item = endpoint.receive(timeout=TIMEOUT)
+                assert item, f"No {wanted} notification"
+                msg = parse_client_daemon_message(item[0].decode('ascii'))
+                if msg['command'] == wanted:
+                    return msg
+
+        command('connect', username=username)
+        expect('ok')
+        return command, expect
+
+    alice_command, alice_expect = client(alice_daemon, 'alice')
+    bob_command, bob_expect = client(bob_daemon, 'bob')
+    alice_command('invite', ip='10.0.0.2', port=bob_daemon.daemon_port)
+    assert alice_expect('connected')['username'] == 'bob'
+    bob_expect('connected')
+    for i in range(20):
+        alice_command('send', text=f"message {i}", id=str(i))
+    assert [bob_expect('message')['text'] for _ in range(20)] == [f"message {i}" for i in range(20)]
+    alice_expect('delivered')
+    alice_command('quit')
+    bob_expect('disconnected')
+    assert net.delivered > 40 and alice_daemon.stats()['delivered'] >= 1
+    print(f"PASS: Memory transport, {net.delivered} datagrams")
+
+
+def test_batched_transport_file_transfer(make_daemon, make_client, tmp_path):
+    """With the batched transport a file window leaves in a few sendmmsg() calls."""
+    print("\n[TEST] Batched transport")
+    data = os.urandom(200_000)
+    source = tmp_path / "data.bin"
+    source.write_bytes(data)
+    alice_daemon = make_daemon(transport='batched')
+    bob_daemon = make_daemon(transport='batched', download_dir=str(tmp_path / "in"), accept_files=True)
+    bob_daemon.auto_accept = True
+    alice, bob = make_client(alice_daemon, 'alice'), make_client(bob_daemon, 'bob')
+    alice.command('invite', ip='127.0.0.1', port=bob_daemon.daemon_port)
+    alice.expect('connected')
+    bob.expect('connected')
+    alice.command('sendfile', path=str(source))
+    alice.expect('file_sent')
+    bob.expect('file_received')
+    assert (tmp_path / "in" / "data.bin").read_bytes() == data
+    chunks = -(-len(data) // FILE_CHUNK_SIZE)
+    transport = alice_daemon.daemon_transport
+    # Every chunk is sent and ACKed: one call per datagram would take twice as many
+    assert transport.batched and transport.calls < 2 * chunks
+    print(f"PASS: Batched transport, {chunks} chunks in {transport.calls} calls")
+
+
+# =======================================================================
+# === SIMULATION TESTS ===
+# =======================================================================
+
+def test_simulation_lossless_link():
+    """On a clean link every exchange takes its modelled delay, serialization included."""
+    print("\n[TEST] Simulation: Lossless link")
+    run = simulate({'delay': 0.05, 'bandwidth': 1e6, 'rate': 5, 'duration': 20, 'busy_probes': 3})
+    result = run['result']
+    assert result['connected'] and result['delivered'] == 100 and not result['session_lost']
+    assert result['retransmits'] == 0 and result['send_rejected'] == result['send_failed'] == 0
+    # One RTT for the handshake and for a refused SYN, one way for the FIN
+    assert 100 < result['connect_ms'] < 105 and 100 < result['busy_p50_ms'] < 105
+    assert result['busy_rejections'] == 3 and 50 < result['fin_ms'] < 52
+    # 100 characters of text plus headers at 1 Mbit/s: about 1.5 ms on top of the delay
+    assert 50 < result['lat_p50_ms'] <= result['lat_p99_ms'] < 53
+    assert abs(result['throughput_msg_s'] - 5) < 0.1
+    assert result['sim_s'] > 20 and result['wall_s'] < 5
+    print(f"PASS: {result['sim_s']:.0f} virtual seconds in {result['wall_s']:.2f} s")
+
+
+def test_simulation_sweep_loss_and_timeout():
+    """Loss costs retransmissions, a longer timeout costs latency, and a seed gives the same run."""
+    print("\n[TEST] Simulation: Sweep")
+    grid = {'loss': [0.0, 0.1], 'timeout': [0.2, 1.0], 'rate': [2], 'duration': [60], 'busy_probes': [0]}
+    runs = {(run['config']['loss'], run['config']['timeout']): run['result'] for run in sweep(grid)}
+    assert len(runs) == 4
+    assert runs[0.0, 0.2]['retransmits'] == runs[0.0, 1.0]['retransmits'] == 0
+    lossy_fast, lossy_slow = runs[0.1, 0.2], runs[0.1, 1.0]
+    for result in (lossy_fast, lossy_slow):
+        assert result['retransmits'] > 0
+        assert result['delivered'] + result['send_rejected'] + result['send_failed'] == 120
+    assert lossy_slow['lat_p99_ms'] > lossy_fast['lat_p99_ms']
+    again = simulate({'loss': 0.1, 'timeout': 0.2, 'rate': 2, 'duration': 60, 'busy_probes': 0})['result']
+    again['wall_s'] = lossy_fast['wall_s']
+    assert again == lossy_fast
+    print(f"PASS: Sweep, p99 {lossy_fast['lat_p99_ms']:.0f} ms vs {lossy_slow['lat_p99_ms']:.0f} ms")
+
+
+def crossed_invitations(alice_auto_accept: bool) -> tuple:
+    """Alice invites bob over a slow link while carol, close by, invites alice."""
+    sim = Simulator()
+    network = SimNetwork(sim, delay=0.02)
+    network.set_link('10.0.0.1', '10.0.0.2', delay=0.5)
+    alice, bob, carol = (SimNode(sim, network, f"10.0.0.{i}", name)
+                         for i, name in enumerate(('alice', 'bob', 'carol'), 1))
+    alice.daemon.auto_accept = alice_auto_accept
+    notes = {name: [] for name in ('alice', 'bob', 'carol')}
+    for name, node in (('alice', alice), ('bob', bob), ('carol', carol)):
+        for command in ('connected', 'disconnected', 'error'):
+            node.on(command, notes[name].append)
+    bob.on('invitation', lambda msg: bob.command('accept'))
+    sim.schedule(0.01, lambda: alice.command('invite', ip='10.0.0.2', port=DAEMON_PORT))
+    sim.schedule(0.02, lambda: carol.command('invite', ip='10.0.0.1', port=DAEMON_PORT))
+    sim.schedule(0.08, alice.command, 'accept')
+    sim.run(until=5)
+    return alice.daemon, bob.daemon, carol.daemon, notes
+
+
+def test_simulation_late_syn_ack_does_not_hijack():
+    """A SYN+ACK for an outstanding invitation never takes over, or strands, another handshake."""
+    print("\n[TEST] Simulation: Late SYN+ACK")
+    # Accepting carol while our invitation to bob is pending is refused, bob's answer wins
+    alice, bob, carol, notes = crossed_invitations(False)
+    assert alice.chat_partner == ('10.0.0.2', DAEMON_PORT) and bob.chat_partner == ('10.0.0.1', DAEMON_PORT)
+    assert notes['alice'][0]['message'] == "Still waiting for an answer to our invitation"
+    # Carol is refused once alice's session opens, not left to time out
+    assert not carol.in_chat and not carol.connecting
+    assert [msg['message'] for msg in notes['carol']] == ["User already in another chat"]
+    # Auto-accepted, carol's session wins: alice withdraws the invitation and FINs bob's SYN+ACK
+    alice, bob, carol, notes = crossed_invitations(True)
+    assert alice.chat_partner == ('10.0.0.3', DAEMON_PORT) and carol.chat_partner == ('10.0.0.1', DAEMON_PORT)
+    assert not alice.connecting and not bob.in_chat and not bob.invitations
+    assert [msg['command'] for msg in notes['bob']] == []
+    print("PASS: Late SYN+ACK refused")
+
+
+def test_simulation_lost_acks_end_the_session():
+    """When every ACK for a message is lost the session ends, a later message is never taken for it."""
+    print("\n[TEST] Simulation: Lost ACKs")
+    sim = Simulator()
+    network = SimNetwork(sim, delay=0.02)
+    alice, bob = (SimNode(sim, network, f"10.0.0.{i}", name, timeout=0.2) for i, name in ((1, 'alice'), (2, 'bob')))
+    shown, notes = [], []
+    bob.on('invitation', lambda msg: bob.command('accept'))
+    bob.on('message', lambda msg: shown.append(msg['text']))
+    for command in ('delivered', 'disconnected', 'error'):
+        alice.on(command, notes.append)
+
+    def drop_acks(loss: float):
+        network.set_link('10.0.0.2', '10.0.0.1', both=False, loss=loss)
+
+    sim.schedule(0, lambda: alice.command('invite', ip='10.0.0.2', port=DAEMON_PORT))
+    sim.schedule(0.5, drop_acks, 1.0)
+    sim.schedule(0.5, lambda: alice.command('send', text='M1', id='1'))
+    sim.schedule(2.0, drop_acks, 0.0)
+    for i, at in ((2, 2.0), (3, 2.1)):
+        sim.schedule(at, lambda i=i: alice.command('send', text=f"M{i}", id=str(i)))
+    sim.run(until=5)
+    assert shown == ['M1']
+    assert [(msg['command'], msg.get('reason')) for msg in notes[:1]] == [('disconnected', 'timeout')]
+    assert not any(msg['command'] == 'delivered' for msg in notes)
+    assert not alice.daemon.in_chat and not bob.daemon.in_chat
+    print("PASS: Session ended after lost ACKs")
+
+
+# =======================================================================
+# === IMPAIRMENT PROXY TESTS ===
+# =======================================================================
+
+def run_through_proxy(count: int, **impairments) -> list:
+    """Send count datagrams through a fresh proxy and return what arrives."""
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(('127.0.0.1', 0))
+    sink.settimeout(0.3)
+    proxy = ImpairmentProxy(('127.0.0.1', 0), sink.getsockname(), **impairments)
+    proxy.start()
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    arrived = []
+    try:
+        for i in range(count):
+            sender.sendto(build_simp_message(MessageType.CHAT, 0x01, i % 2, "proxy", str(i)), proxy.listen_addr)
+            time.sleep(0.001)
+        while True:
+            arrived.append(parse_simp_message(sink.recvfrom(4096)[0])['payload'])
+    except socket.timeout:
+        pass
+    finally:
+        proxy.stop()
+        sender.close()
+        sink.close()
+    return arrived
+
+
+def test_impairment_proxy_is_reproducible():
+    """The same seed drops and duplicates the same datagrams."""
+    first = run_through_proxy(100, loss=0.2, duplicate=0.1, seed=7)
+    second = run_through_proxy(100, loss=0.2, duplicate=0.1, seed=7)
+    assert sorted(first) == sorted(second)
+    assert 60 < len(first) < 100
+    print("PASS: Proxy impairments reproducible")
+
+
+def test_impairment_proxy_delay_and_reorder():
+    """Every datagram is delayed, some are overtaken by their successors."""
+    started = time.monotonic()
+    arrived = run_through_proxy(50, delay=0.05, reorder=0.3, seed=3)
+    assert sorted(arrived, key=int) == [str(i) for i in range(50)]
+    assert arrived != sorted(arrived, key=int), "Expected some reordering"
+    assert time.monotonic() - started >= 0.05
+    print("PASS: Proxy delay and reordering")
+
+
 # =======================================================================
 # === CLIENT INTERACTION TESTS ===
 # =======================================================================
 
+def test_client_core_programmatic_api(client_conn_setup):
+    """ClientCore can be driven without the terminal UI: invite, send and on_message."""
+    print("\n[TEST] Client core API")
+    temp_sock = client_conn_setup
+    core = ClientCore(daemon_port=temp_sock.getsockname()[1])
+    received = []
+    core.on_message(received.append)
+    
+    def answer_connect():
+        data, addr = temp_sock.recvfrom(4096)
+        temp_sock.sendto(build_client_daemon_message('ok').encode('ascii'), addr)
+    threading.Thread(target=answer_connect, daemon=True).start()
+    
+    try:
+        assert core.connect('bot')
+        core.invite('127.0.0.2', first_message='hi')
+        data, client_addr = temp_sock.recvfrom(4096)
+        msg = parse_client_daemon_message(data.decode('ascii'))
+        assert msg['command'] == 'invite' and msg['text'] == 'hi'
+        
+        for notification in [build_client_daemon_message('connected', username='remote'),
+                             build_client_daemon_message('message', username='remote', text='yo')]:
+            temp_sock.sendto(notification.encode('ascii'), client_addr)
+        for _ in range(10):
+            if received:
+                break
+            core.poll(timeout=TIMEOUT)
+        assert core.in_chat and received[0]['text'] == 'yo'
+        
+        assert core.send('hello')
+        data, _ = temp_sock.recvfrom(4096)
+        assert parse_client_daemon_message(data.decode('ascii'))['text'] == 'hello'
+        print("PASS: Client core API")
+    finally:
+        core.close()
+
+
+def test_renderer_coalesces_frames():
+    """A burst of lines is one write per frame, and the prompt with the typed input stays last."""
+    print("\n[TEST] Renderer: Coalesced frames")
+    now = [100.0]
+    writes = []
+
+    class Stream(io.StringIO):
+        def write(self, text):
+            writes.append(text)
+            return super().write(text)
+
+    stream = Stream()
+    renderer = Renderer(stream, fps=10, ansi=True, clock=lambda: now[0])
+    renderer.prompt("You: ")
+    renderer.flush()
+    renderer.set_input("hel")
+    renderer.flush()
+    assert writes == ["You: "]
+    now[0] += 0.1
+    renderer.flush()
+    assert writes == ["You: ", "\r\x1b[KYou: hel"]
+
+    # 1000 messages arriving within one frame interval: at most one more write
+    for i in range(1000):
+        renderer.line(f"[bob]: {i}")
+        renderer.flush()
+        now[0] += 0.00005
+    assert len(writes) == 2 and 0 < renderer.timeout() <= 0.1
+    now[0] += 0.1
+    renderer.flush()
+    assert len(writes) == 3 and renderer.timeout() is None
+    frame = writes[-1]
+    assert frame.startswith("\r\x1b[K[bob]: 0\n") and frame.endswith("[bob]: 999\nYou: hel")
+
+    # Enter keeps the typed line on screen above the incoming ones
+    renderer.set_input("hello")
+    renderer.commit_input()
+    renderer.line("[bob]: hi")
+    now[0] += 0.1
+    renderer.flush()
+    assert writes[-1] == "\r\x1b[KYou: hello\n[bob]: hi\nYou: "
+
+    # Without a terminal the prompt line is ended instead of erased
+    plain = Renderer(io.StringIO(), fps=0, ansi=False)
+    plain.prompt("> ")
+    plain.flush()
+    plain.line("a")
+    plain.flush()
+    plain.commit_input()
+    plain.flush()
+    assert plain.stream.getvalue() == "> \na\n> \n> "
+
+    headless = Renderer(io.StringIO(), headless=True)
+    headless.prompt("> ")
+    headless.line("x")
+    headless.flush(force=True)
+    assert headless.stream.getvalue() == "" and headless.lines_rendered == 1
+    print("PASS: Renderer coalesced frames")
+
+
 def test_client_connect_command(client_conn_setup):
     """Test client sends 'connect' after username input."""
     print("\n[TEST] Client: Connect (Username input)")
@@ -242,7 +1682,7 @@ def test_client_connect_command(client_conn_setup):
     username = "testuser"
     
     # Start client (will send username and then 'connect' command)
-    client_proc = start_client(username=username) 
+    client_proc = start_client(username=username, port=temp_sock.getsockname()[1]) 
 
     try:
         # The client automatically sends 'connect'
@@ -259,7 +1699,7 @@ def test_client_invite_and_send(client_conn_setup):
     temp_sock = client_conn_setup
     username = "testuser_invite"
     
-    client_proc = start_client(username=username) 
+    client_proc = start_client(username=username, port=temp_sock.getsockname()[1]) 
     
     try:
         # 1. Handle initial 'connect' command (client is now in idle_mode, blocked on input)
@@ -277,19 +1717,8 @@ def test_client_invite_and_send(client_conn_setup):
              pytest.fail("Client address not captured for simulation")
 
         temp_sock.sendto(connected_msg.encode('ascii'), client_addr)
-        time.sleep(0.5) # Wait for client's listener thread to receive the message
-
-        # --- CRITICAL FIX: Inject commands in a sequence to switch modes and send message ---
-        # The client is currently blocked on 'Enter choice:' in idle_mode.
-        # Sending a newline breaks idle_mode's input().
-        # The client detects self.in_chat=True, enters chat_mode, and blocks on chat input.
-        # The next input is the message payload.
-        
-        # We need to explicitly break the blocking input and then send the chat message
-        
-        client_proc.stdin.write('\n')
-        client_proc.stdin.flush()
-        time.sleep(1) # Wait for client to exit idle_mode and enter chat_mode
+        # The client switches to chat mode as soon as the notification arrives
+        wait_for_output(client_proc, "Chat established")
         
         # 4. Drive client to send 'send' command: [test message]
         input_sequence_send = ['test message']
@@ -303,13 +1732,51 @@ def test_client_invite_and_send(client_conn_setup):
         client_proc.wait(timeout=1)
 
 
+def test_client_holds_lines_while_daemon_busy(client_conn_setup):
+    """Typing on while a message is unacknowledged sends it; lines the daemon has no room for wait for credit."""
+    print("\n[TEST] Client: Busy daemon")
+    temp_sock = client_conn_setup
+    client_proc = start_client(username="testuser_busy", port=temp_sock.getsockname()[1])
+    
+    def next_send() -> dict:
+        data, _ = temp_sock.recvfrom(4096)
+        msg = parse_client_daemon_message(data.decode('ascii'))
+        assert msg['command'] == 'send'
+        return msg
+    
+    try:
+        client_addr = run_client_action_test(client_proc, 'connect', [], temp_sock)
+        temp_sock.sendto(build_client_daemon_message('connected', username='remote_user').encode('ascii'), client_addr)
+        wait_for_output(client_proc, "Chat established")
+        
+        # No 'delivered' for the first line, the second goes out anyway
+        client_proc.stdin.write("first\nsecond\n")
+        client_proc.stdin.flush()
+        assert [next_send()['text'] for _ in range(2)] == ['first', 'second']
+        # The daemon's buffer was full for the second, and the third is typed while it is busy
+        temp_sock.sendto(build_client_daemon_message('busy', queued=1, id=2).encode('ascii'), client_addr)
+        wait_for_output(client_proc, "sending once it is ready: second")
+        client_proc.stdin.write("third\n")
+        client_proc.stdin.flush()
+        wait_for_output(client_proc, "sending once it is ready: third")
+        
+        temp_sock.sendto(build_client_daemon_message('credit', available=8).encode('ascii'), client_addr)
+        assert [(msg['text'], msg['id']) for msg in (next_send(), next_send())] == [('second', '2'), ('third', '3')]
+        print("PASS: Held lines sent on credit")
+    finally:
+        client_proc.stdin.write('q\nq\n')
+        client_proc.stdin.flush()
+        client_proc.terminate()
+        client_proc.wait(timeout=1)
+
+
 def test_client_quit_chat(client_conn_setup):
     """Test client's ability to quit the chat."""
     print("\n[TEST] Client: Quit Chat")
     temp_sock = client_conn_setup
     username = "testuser_quit"
     
-    client_proc = start_client(username=username)
+    client_proc = start_client(username=username, port=temp_sock.getsockname()[1])
     
     try:
         # 1. Handle initial 'connect' command
@@ -322,14 +1789,8 @@ def test_client_quit_chat(client_conn_setup):
              pytest.fail("Client address not captured for simulation")
 
         temp_sock.sendto(connected_msg.encode('ascii'), client_addr)
-        time.sleep(0.5) # Wait for client's listener thread to receive the message
-        
-        # --- CRITICAL FIX ---
-        # Unblock the client's current input() call
-        client_proc.stdin.write('\n')
-        client_proc.stdin.flush()
-        time.sleep(1) # Wait for client to enter chat_mode
-        # --- CRITICAL FIX END ---
+        # The client switches to chat mode as soon as the notification arrives
+        wait_for_output(client_proc, "Chat established")
 
         # 3. Drive client to send 'quit' command: [q] (Quit chat)
         input_sequence_quit = ['q']